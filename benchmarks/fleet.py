@@ -0,0 +1,124 @@
+"""Synthetic GCE fleets, for benchmarking purposes."""
+
+import random
+
+
+def instance_resource(i, project="bench-project", zone="us-central1-b"):
+    """Returns a full, realistically sized instance resource, as listed by
+       `gcloud compute instances list --format=json`."""
+    rng = random.Random(i)
+    zone_url = f"https://www.googleapis.com/compute/v1/projects/{project}/zones/{zone}"
+    name = f"instance-{i}"
+    return {
+        "canIpForward": False,
+        "cpuPlatform": "Intel Cascade Lake",
+        "creationTimestamp": "2020-05-25T07:40:46.359-07:00",
+        "deletionProtection": False,
+        "disks": [{
+            "autoDelete": True,
+            "boot": True,
+            "deviceName": name,
+            "diskSizeGb": "100",
+            "guestOsFeatures": [{"type": "VIRTIO_SCSI_MULTIQUEUE"}, {"type": "UEFI_COMPATIBLE"}],
+            "index": 0,
+            "interface": "SCSI",
+            "kind": "compute#attachedDisk",
+            "licenses": ["https://www.googleapis.com/compute/v1/projects/debian-cloud/global/"
+                         "licenses/debian-10-buster"],
+            "mode": "READ_WRITE",
+            "source": f"{zone_url}/disks/{name}",
+            "type": "PERSISTENT"
+        }],
+        "fingerprint": "%016x" % rng.getrandbits(64),
+        "id": str(rng.getrandbits(63)),
+        "kind": "compute#instance",
+        "labelFingerprint": "%016x" % rng.getrandbits(64),
+        "labels": {"env": "bench", "team": f"team-{i % 7}", "role": f"role-{i % 13}"},
+        "machineType": f"{zone_url}/machineTypes/n1-standard-4",
+        "metadata": {
+            "fingerprint": "%016x" % rng.getrandbits(64),
+            "items": [
+                {"key": "startup-script", "value": "#!/bin/bash\n" + "echo bench\n" * 40},
+                {"key": "ssh-keys", "value": "\n".join(
+                    f"user{k}:ssh-rsa {'A' * 372} user{k}@bench" for k in range(3))},
+            ],
+            "kind": "compute#metadata"
+        },
+        "name": name,
+        "networkInterfaces": [{
+            "accessConfigs": [{
+                "kind": "compute#accessConfig",
+                "name": "external-nat",
+                "natIP": f"34.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+                "networkTier": "PREMIUM",
+                "type": "ONE_TO_ONE_NAT"
+            }],
+            "fingerprint": "%016x" % rng.getrandbits(64),
+            "kind": "compute#networkInterface",
+            "name": "nic0",
+            "network": f"https://www.googleapis.com/compute/v1/projects/{project}/global/"
+                       "networks/default",
+            "networkIP": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            "subnetwork": f"https://www.googleapis.com/compute/v1/projects/{project}/regions/"
+                          "us-central1/subnetworks/default"
+        }],
+        "scheduling": {"automaticRestart": True, "onHostMaintenance": "MIGRATE",
+                       "preemptible": False},
+        "selfLink": f"{zone_url}/instances/{name}",
+        "serviceAccounts": [{
+            "email": f"{rng.getrandbits(40)}-compute@developer.gserviceaccount.com",
+            "scopes": ["https://www.googleapis.com/auth/devstorage.read_only",
+                       "https://www.googleapis.com/auth/logging.write",
+                       "https://www.googleapis.com/auth/monitoring.write",
+                       "https://www.googleapis.com/auth/servicecontrol",
+                       "https://www.googleapis.com/auth/service.management.readonly",
+                       "https://www.googleapis.com/auth/trace.append"]
+        }],
+        "shieldedInstanceConfig": {"enableIntegrityMonitoring": True, "enableSecureBoot": False,
+                                   "enableVtpm": True},
+        "startRestricted": False,
+        "status": "RUNNING" if i % 10 else "TERMINATED",
+        "tags": {"fingerprint": "%016x" % rng.getrandbits(64), "items": ["http-server"]},
+        "zone": zone_url
+    }
+
+
+def fleet(size, project="bench-project"):
+    """Returns SIZE instance resources"""
+    return [instance_resource(i, project=project) for i in range(size)]
+
+
+def hostname(i, project="bench-project", zone="us-central1-b"):
+    """Hostname of instance I, following `gcloud compute config-ssh` conventions"""
+    return f"instance-{i}.{zone}.{project}"
+
+
+def external_ip(i, generation=0):
+    """External IP of instance I. Instances get a new IP with each GENERATION."""
+    return f"34.{(i // 65536 + generation * 64) % 256}.{i // 256 % 256}.{i % 256}"
+
+
+def ssh_config_text(size, projects=10, generation=0, handwritten=0):
+    """Returns an SSH config with SIZE hosts spread over PROJECTS projects, as written by
+       `gcloud compute config-ssh`, after a few hand written hosts (and HANDWRITTEN more)"""
+    lines = ["Host bastion\n", "    HostName bastion.example.com\n", "    User admin\n", "\n",
+             "Host *\n", "    ServerAliveInterval 60\n", "\n"]
+    for i in range(handwritten):
+        lines += [f"Host server-{i}\n", f"    HostName server-{i}.example.com\n",
+                  "    User admin\n", "\n"]
+    lines += ["# Google Compute Engine Section\n",
+              "#\n",
+              "# The following has been auto-generated by \"gcloud compute config-ssh\"\n",
+              "# to make accessing your Google Compute Engine virtual machines easier.\n",
+              "#\n"]
+    for i in range(size):
+        lines += ["\n",
+                  f"Host {hostname(i, project=f'bench-project-{i % projects}')}\n",
+                  f"    HostName {external_ip(i, generation)}\n",
+                  "    IdentityFile /home/bench/.ssh/google_compute_engine\n",
+                  "    UserKnownHostsFile=/home/bench/.ssh/google_compute_known_hosts\n",
+                  f"    HostKeyAlias=compute.{1000000 + i}\n",
+                  "    IdentitiesOnly=yes\n",
+                  "    CheckHostIP=no\n"]
+    lines += ["\n", "# End of Google Compute Engine Section\n"]
+    return "".join(lines)
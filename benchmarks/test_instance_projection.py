@@ -0,0 +1,36 @@
+"""Compares instance listings payloads with and without field projection.
+
+Run with `python -m pytest benchmarks/test_instance_projection.py`."""
+
+import json
+
+import pytest
+
+from gcloud_sync_ssh.backends.fake import apply_projection
+from gcloud_sync_ssh.gcloud_instances import _INSTANCE_FIELDS
+
+from fleet import fleet
+
+
+_FLEET_SIZE = 5000
+
+
+@pytest.fixture(scope="module")
+def payloads():
+    full = fleet(_FLEET_SIZE)
+    return {"full": json.dumps(full),
+            "projected": json.dumps(apply_projection(full, _INSTANCE_FIELDS))}
+
+
+@pytest.mark.parametrize("kind", ["full", "projected"])
+def test_listing_parse(benchmark, payloads, kind):
+    payload = payloads[kind]
+    benchmark.extra_info["instances"] = _FLEET_SIZE
+    benchmark.extra_info["bytes"] = len(payload)
+    result = benchmark(json.loads, payload)
+    assert len(result) == _FLEET_SIZE
+
+
+def test_projection_shrinks_payload(payloads):
+    # A projected listing should be an order of magnitude smaller
+    assert len(payloads["projected"]) * 10 < len(payloads["full"])
@@ -0,0 +1,128 @@
+"""Times the SSH configuration pipeline (parse, template inference, updates, removals, diff
+and save) on configurations of 100 to 50k hosts, and parsing of 200k lines configurations.
+
+Run with `python -m pytest benchmarks/test_ssh_config_scale.py` (add `--run-slow` for 50k
+hosts, and diffs of 10k hosts). Save a baseline with `--benchmark-save=baseline`, then
+compare changes against it with `--benchmark-compare --benchmark-compare-fail=mean:25%`,
+which fails on slowdowns."""
+
+import pytest
+
+from gcloud_sync_ssh.host_config import HostConfig
+from gcloud_sync_ssh.ssh_config import SSHConfig
+
+from fleet import external_ip, hostname, ssh_config_text
+
+
+_PROJECTS = 10
+
+_SIZES = [100, 1000, 10000, pytest.param(50000, marks=pytest.mark.slow)]
+# Rendering diffs grows faster than linearly: 10k hosts already take seconds
+_DIFF_SIZES = [100, 1000, pytest.param(10000, marks=pytest.mark.slow),
+               pytest.param(50000, marks=pytest.mark.slow)]
+
+
+def _rounds(size):
+    return max(1, 10000 // size)
+
+
+def _hostname(i):
+    return hostname(i, project=f"bench-project-{i % _PROJECTS}")
+
+
+@pytest.fixture(scope="module", params=_SIZES)
+def config_path(request, tmp_path_factory):
+    size = request.param
+    path = tmp_path_factory.mktemp(f"config_{size}").joinpath("config")
+    path.write_text(ssh_config_text(size, projects=_PROJECTS))
+    return str(path)
+
+
+def _size(config):
+    return len([hostname for hostname in config._hosts if hostname.startswith("instance-")])
+
+
+def _churn(config, size):
+    """A day in the life of a fleet: 10% of instances get a new IP, 1% are created and 1%
+       vanish"""
+    template = HostConfig.default_config()
+    for i in range(0, size, 10):
+        config.update_host(_hostname(i), external_ip(i, generation=1), 1000000 + i)
+    for i in range(size, size + max(1, size // 100)):
+        config.update_host(_hostname(i), external_ip(i), 1000000 + i, template)
+    for i in range(5, size, 100):
+        config.remove_host(_hostname(i))
+
+
+def test_parse(benchmark, config_path):
+    config = benchmark(SSHConfig, config_path)
+    benchmark.extra_info["hosts"] = _size(config)
+
+
+@pytest.mark.parametrize("hosts, handwritten", [(1000, 49000), (25000, 0)],
+                         ids=["mostly-handwritten", "mostly-managed"])
+def test_parse_200k_lines(benchmark, tmp_path, hosts, handwritten):
+    """Hand written hosts take 4 lines, managed ones 8"""
+    path = tmp_path.joinpath("config")
+    path.write_text(ssh_config_text(hosts, projects=_PROJECTS, handwritten=handwritten))
+    config = benchmark.pedantic(SSHConfig, args=(str(path),), rounds=3)
+    benchmark.extra_info["lines"] = len(config._lines)
+    assert _size(config) == hosts
+
+
+def test_infer_host_config(benchmark, config_path):
+    config = SSHConfig(config_path)
+    benchmark.extra_info["hosts"] = _size(config)
+    inferred = benchmark(config.infer_host_config)
+    assert inferred.IdentitiesOnly
+
+
+def test_update_hosts(benchmark, config_path):
+    """Every instance gets a new IP"""
+    def update(config, size):
+        for i in range(size):
+            config.update_host(_hostname(i), external_ip(i, generation=1), 1000000 + i)
+
+    def setup():
+        config = SSHConfig(config_path)
+        return (config, _size(config)), {}
+
+    benchmark.pedantic(update, setup=setup, rounds=_rounds(_size(SSHConfig(config_path))))
+
+
+def test_remove_hosts(benchmark, config_path):
+    """10% of instances vanish"""
+    def remove(config, size):
+        config.remove_hosts(_hostname(i) for i in range(0, size, 10))
+
+    def setup():
+        config = SSHConfig(config_path)
+        return (config, _size(config)), {}
+
+    benchmark.pedantic(remove, setup=setup, rounds=_rounds(_size(SSHConfig(config_path))))
+
+
+@pytest.mark.parametrize("config_path", _DIFF_SIZES, indirect=True)
+def test_diff(benchmark, config_path):
+    def diff(config):
+        return list(config.diff())
+
+    def setup():
+        config = SSHConfig(config_path)
+        _churn(config, _size(config))
+        return (config,), {}
+
+    lines = benchmark.pedantic(diff, setup=setup,
+                               rounds=_rounds(_size(SSHConfig(config_path))))
+    assert lines
+
+
+def test_save(benchmark, config_path, tmp_path):
+    def setup():
+        config = SSHConfig(config_path)
+        _churn(config, _size(config))
+        config._path = str(tmp_path.joinpath("config"))
+        return (config,), {}
+
+    benchmark.pedantic(lambda config: config.save(), setup=setup,
+                       rounds=_rounds(_size(SSHConfig(config_path))))
@@ -0,0 +1,68 @@
+"""Times instance enumeration and synchronization of fleets of 1k and 10k instances spread
+over 10 projects, against an in-memory backend: no gcloud startup, no network.
+
+Run with `python -m pytest benchmarks/test_sync_scale.py`."""
+
+import pytest
+
+from gcloud_sync_ssh.backends import FakeBackend, set_backend
+from gcloud_sync_ssh.changeset import ChangeSet
+from gcloud_sync_ssh.cli import _enumerate_instances, _sync_instances
+from gcloud_sync_ssh.host_config import HostConfig
+from gcloud_sync_ssh.ssh_config import SSHConfig
+from gcloud_sync_ssh.util.aio import run
+
+from fleet import instance_resource, ssh_config_text
+
+
+_PROJECTS = [f"bench-project-{i}" for i in range(10)]
+
+
+@pytest.fixture(scope="module", params=[1000, 10000])
+def fleet_size(request):
+    return request.param
+
+
+@pytest.fixture(scope="module")
+def backend(fleet_size):
+    backend = FakeBackend(instances=[instance_resource(i, project=_PROJECTS[i % len(_PROJECTS)])
+                                     for i in range(fleet_size)])
+    previous_backend = set_backend(backend)
+    yield backend
+    set_backend(previous_backend)
+
+
+@pytest.fixture(scope="module")
+def config_path(fleet_size, tmp_path_factory):
+    # An up to date configuration: only TERMINATED instances get removed
+    path = tmp_path_factory.mktemp(f"config_{fleet_size}").joinpath("config")
+    path.write_text(ssh_config_text(fleet_size, projects=len(_PROJECTS)))
+    return str(path)
+
+
+def test_enumerate_instances(benchmark, backend, fleet_size):
+    def enumerate_instances():
+        host_dicts = {}
+        run(_enumerate_instances(_PROJECTS, [], host_dicts.__setitem__))
+        return host_dicts
+
+    host_dicts = benchmark(enumerate_instances)
+    benchmark.extra_info["instances"] = fleet_size
+    assert sum(len(host_dict) for host_dict in host_dicts.values()) == fleet_size
+
+
+def test_sync(benchmark, backend, fleet_size, config_path):
+    def sync(ssh_config):
+        changeset = ChangeSet()
+
+        def apply(project_id, host_dict):
+            changeset.extend(_sync_instances(project_id, host_dict, ssh_config,
+                                             no_remove_stopped=False, no_remove_vanished=False))
+        run(_enumerate_instances(_PROJECTS, [], apply))
+        ssh_config.apply(changeset, HostConfig.default_config())
+
+    def setup():
+        return (SSHConfig(config_path),), {}
+
+    benchmark.extra_info["instances"] = fleet_size
+    benchmark.pedantic(sync, setup=setup, rounds=3)
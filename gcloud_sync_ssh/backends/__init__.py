@@ -0,0 +1,21 @@
+from .base import Backend
+from .compute_api import ComputeAPIBackend, ComputeAPIError
+from .fake import FakeBackend
+from .gcloud import GCloudBackend
+
+
+BACKENDS = {"gcloud": GCloudBackend, "api": ComputeAPIBackend}
+
+_backend = GCloudBackend()
+
+
+def get_backend():
+    """Returns the backend used to list GCP resources"""
+    return _backend
+
+
+def set_backend(backend):
+    """Sets the backend used to list GCP resources, returns the previous one"""
+    global _backend
+    previous_backend, _backend = _backend, backend
+    return previous_backend
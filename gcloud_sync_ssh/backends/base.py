@@ -0,0 +1,60 @@
+from abc import ABC, abstractmethod
+
+from ..util.cmd import acmd, cmd
+
+
+class Backend(ABC):
+    """What gcloud_sync_ssh needs from GCP and gcloud: listing projects and instances,
+       reading and setting gcloud configuration values, and authenticating.
+
+       How projects and instances are listed is up to subclasses. Configuration and
+       credentials belong to gcloud whatever the listings go through, so the other methods
+       run gcloud unless overridden.
+
+       Methods take an optional ENV, the environment variables that gcloud would be run with
+       (i.e. {"CLOUDSDK_CORE_ACCOUNT": ...}, see cmd). Failures of gcloud invocations are
+       raised as subprocess.CalledProcessError."""
+
+    async def list_instances(self, project_id, fields=None, name_regex=None, env=None):
+        """Returns a list of instance resources, see iter_instances"""
+        return [instance async for instance in
+                self.iter_instances(project_id, fields=fields, name_regex=name_regex,
+                                    env=env)]
+
+    @abstractmethod
+    async def iter_instances(self, project_id, fields=None, name_regex=None, env=None):
+        """Yields instance resources for project PROJECT_ID.
+
+           FIELDS optionally restricts resources to some keys, in gcloud projection syntax.
+           NAME_REGEX optionally restricts instances to those whose name matches it."""
+
+    @abstractmethod
+    async def list_projects(self, env=None):
+        """Returns a list of project resources reachable with the active account"""
+
+    async def config_get(self, key, env=None):
+        """Returns the value of configuration property KEY (i.e. "core/project"), or None"""
+        return await acmd(["gcloud", "config", "get-value", key], structured=True,
+                          readonly=True, env=env)
+
+    def config_set(self, key, value):
+        """Sets configuration property KEY in the active configuration"""
+        cmd(["gcloud", "config", "set", key, value])
+
+    async def list_accounts(self, env=None):
+        """Returns a list of the accounts gcloud has credentials for, as
+           {"account": ..., "status": "ACTIVE" or ""} dicts"""
+        return await acmd("gcloud auth list", structured=True, readonly=True, env=env)
+
+    def login(self, account_id):
+        """Makes ACCOUNT_ID the active account, obtaining credentials when gcloud has none.
+           The user may be prompted, or a browser opened."""
+        cmd(["gcloud", "auth", "login", account_id])
+
+    def activate_service_account(self, key_file_path):
+        """Makes the service account whose key file is KEY_FILE_PATH the active account"""
+        cmd(["gcloud", "auth", "activate-service-account", f"--key-file={key_file_path}"])
+
+    def close(self):
+        """Releases resources held by this backend"""
+        pass
@@ -0,0 +1,286 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import http.client
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from loguru import logger
+
+from ..util.cmd import cmd, forget_memo
+from ..util.cmd_stats import stats
+from ..util.retry import TRANSIENT_HTTP_STATUSES, get_retry_policy
+from ..util.tracing import span
+from .base import Backend
+
+
+_COMPUTE_ENDPOINT = "https://compute.googleapis.com/compute/v1/"
+_RESOURCE_MANAGER_ENDPOINT = "https://cloudresourcemanager.googleapis.com/v1/"
+
+# Errors that a pooled connection raises when the server closed it while it was idle
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError,
+                            BrokenPipeError)
+
+
+class ComputeAPIError(RuntimeError):
+    """Raised when the API answers with an HTTP error status, or can't be reached
+       (status is None then)"""
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}" if status else message)
+        self.status = status
+        self.message = message
+
+
+def _endpoint(property_name, default):
+    # Honor gcloud's api_endpoint_overrides/* properties, set from the environment
+    endpoint = os.getenv(f"CLOUDSDK_API_ENDPOINT_OVERRIDES_{property_name.upper()}") or default
+    return endpoint if endpoint.endswith("/") else f"{endpoint}/"
+
+
+class _ConnectionPool(object):
+    """A thread-safe pool of keep-alive HTTP(S) connections.
+
+       Idle connections are kept per (scheme, host:port), up to MAXSIZE of each."""
+    def __init__(self, maxsize=8, timeout=60):
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, netloc):
+        conn_class = http.client.HTTPSConnection if scheme == "https" else \
+            http.client.HTTPConnection
+        return conn_class(netloc, timeout=self._timeout)
+
+    @contextmanager
+    def connection(self, scheme, netloc, fresh=False):
+        """Yields a connection, then puts it back into the pool unless an error occured.
+
+           fresh=True bypasses idle connections."""
+        key = (scheme, netloc)
+        conn = None
+        if not fresh:
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+        reused = conn is not None
+        if not reused:
+            conn = self._new_connection(scheme, netloc)
+
+        try:
+            yield conn, reused
+        except BaseException:
+            conn.close()
+            raise
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._maxsize:
+                idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def request(self, method, url, headers={}):
+        """Performs a request and returns a (status, body) tuple.
+
+           A request that fails on a reused connection is retried once on a fresh one,
+           as the server may have closed it in the meantime."""
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        fresh = False
+        while True:
+            try:
+                with self.connection(parts.scheme, parts.netloc, fresh=fresh) as (conn, reused):
+                    conn.request(method, path, headers=headers)
+                    response = conn.getresponse()
+                    return response.status, response.read()
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                fresh = True
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+def _partial_response_fields(fields):
+    """Translates gcloud projection keys into a partial response `fields` selector"""
+    return ",".join(field.replace("[]", "").replace(".", "/") for field in fields)
+
+
+def _gcloud_access_token(env=None, refresh=False):
+    """An access token for the active account. REFRESH=True gets a new one, for when the
+       previous one expired."""
+    if refresh:
+        forget_memo("gcloud auth print-access-token", env=env)
+    res = cmd("gcloud auth print-access-token", readonly=True, env=env)
+    return res.stdout.strip()
+
+
+class ComputeAPIBackend(Backend):
+    """Lists GCP resources using the Compute Engine and Resource Manager REST APIs.
+
+       This saves a gcloud startup per call, and all calls share a pool of keep-alive
+       HTTPS connections. gcloud is still used (once per account) to obtain access tokens,
+       and for configuration and authentication.
+
+       Methods take an optional ENV, the environment variables that gcloud would be run with
+       (i.e. {"CLOUDSDK_CORE_ACCOUNT": ...}). It selects the access token to use.
+
+       Access tokens are forgotten whenever the active account may change (login...), and
+       renewed when the API rejects them (i.e. once expired)."""
+    def __init__(self, concurrency=8, token_provider=_gcloud_access_token):
+        self._compute_endpoint = _endpoint("compute", _COMPUTE_ENDPOINT)
+        self._resource_manager_endpoint = _endpoint("cloudresourcemanager",
+                                                    _RESOURCE_MANAGER_ENDPOINT)
+        self._retry_policy = get_retry_policy()
+        self._pool = _ConnectionPool(maxsize=concurrency,
+                                     timeout=self._retry_policy.timeout or 60)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._token_provider = token_provider
+        self._tokens = {}  # env => access token
+        self._token_lock = threading.Lock()
+
+    def _access_token(self, env=None, refresh=False):
+        key = tuple(sorted(env.items())) if env else None
+        with self._token_lock:
+            if refresh or key not in self._tokens:
+                self._tokens[key] = self._token_provider(env=env, refresh=refresh)
+            return self._tokens[key]
+
+    def _forget_tokens(self):
+        with self._token_lock:
+            self._tokens.clear()
+
+    def _request(self, url, headers):
+        """Blocking GET request returning a (status, body) tuple. Transient failures are
+           retried according to the retry policy (see util.retry)."""
+        attempts = self._retry_policy.retries + 1
+        invocation_started = time.monotonic()
+        for attempt in range(attempts):
+            started = time.monotonic()
+            try:
+                with span("api GET", cat="api", url=url):
+                    status, body = self._pool.request("GET", url, headers=headers)
+            except (OSError, http.client.HTTPException) as e:
+                # Includes socket timeouts
+                status, body, failure = None, None, str(e) or type(e).__name__
+            else:
+                failure = f"status {status}" if status in TRANSIENT_HTTP_STATUSES else None
+            stats.record("api GET", time.monotonic() - started, status == 200)
+
+            if not failure or attempt + 1 == attempts:
+                break
+            delay = self._retry_policy.delay(attempt)
+            logger.warning(f"api: GET {url} failed ({failure}), retrying in {delay:.1f}s")
+            stats.count("retries")
+            time.sleep(delay)
+
+        stats.record_invocation(["GET", url], time.monotonic() - invocation_started,
+                                0 if status == 200 else status or -1,
+                                len(body) if body else 0, retries=attempt)
+        if status is None:
+            logger.error(f"api: GET {url} failed: {failure}")
+            raise ComputeAPIError(None, failure)
+        return status, body
+
+    def _get(self, url, params={}, env=None):
+        """Blocking GET request returning decoded JSON"""
+        params = {k: v for k, v in params.items() if v is not None}
+        if params:
+            url = f"{url}?{urlencode(params)}"
+
+        def headers(refresh=False):
+            return {"Authorization": f"Bearer {self._access_token(env, refresh=refresh)}",
+                    "Accept": "application/json"}
+
+        logger.debug(f"api: GET {url}")
+        status, body = self._request(url, headers())
+        if status == 401:
+            logger.debug("api: access token rejected, getting a new one")
+            status, body = self._request(url, headers(refresh=True))
+        if status != 200:
+            try:
+                message = json.loads(body)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = body.decode("UTF-8", errors="replace")
+            logger.error(f"api: GET {url} status {status}\n{message}")
+            raise ComputeAPIError(status, message)
+        return json.loads(body)
+
+    def _list_pages(self, url, params={}, env=None):
+        """Blocking generator over all pages of a paginated list call"""
+        page_token = None
+        while True:
+            page = self._get(url, dict(params, pageToken=page_token), env=env)
+            yield page
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return
+
+    def _instances_request(self, project_id, fields=None, name_regex=None):
+        url = f"{self._compute_endpoint}projects/{project_id}/aggregated/instances"
+        params = {}
+        if name_regex:
+            params["filter"] = f"name eq '{name_regex}'"
+        if fields:
+            instance_fields = _partial_response_fields(fields)
+            params["fields"] = f"items/*/instances({instance_fields}),nextPageToken"
+        return url, params
+
+    def _projects(self, env=None):
+        url = f"{self._resource_manager_endpoint}projects"
+        projects = []
+        for page in self._list_pages(url, {"filter": "lifecycleState:ACTIVE"}, env=env):
+            projects += page.get("projects", [])
+        return projects
+
+    async def _in_executor(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    async def iter_instances(self, project_id, fields=None, name_regex=None, env=None):
+        """Yields instance resources for project PROJECT_ID page by page,
+           using instances.aggregatedList.
+
+           FIELDS optionally restricts resources to some keys, in gcloud projection syntax.
+           NAME_REGEX optionally restricts instances to those whose name matches it."""
+        url, params = self._instances_request(project_id, fields, name_regex)
+        page_token = None
+        while True:
+            page = await self._in_executor(self._get, url, dict(params, pageToken=page_token),
+                                           env)
+            for scope in page.get("items", {}).values():
+                for instance in scope.get("instances", []):
+                    yield instance
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def list_projects(self, env=None):
+        """Returns a list of project resources reachable with the active account,
+           using projects.list"""
+        return await self._in_executor(self._projects, env)
+
+    def config_set(self, key, value):
+        super().config_set(key, value)
+        self._forget_tokens()
+
+    def login(self, account_id):
+        super().login(account_id)
+        self._forget_tokens()
+
+    def activate_service_account(self, key_file_path):
+        super().activate_service_account(key_file_path)
+        self._forget_tokens()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pool.close()
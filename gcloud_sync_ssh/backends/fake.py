@@ -0,0 +1,101 @@
+import json
+import re
+from subprocess import CalledProcessError
+
+from .base import Backend
+
+
+def apply_projection(data, keys):
+    """Simplified gcloud projection: keeps only KEYS, like "a", "a.b" or "a[].b[].c"."""
+    if isinstance(data, list):
+        return [apply_projection(datum, keys) for datum in data]
+
+    result = {}
+    for key in keys:
+        head, _, tail = key.partition(".")
+        head = head.replace("[]", "")
+        if head in data:
+            result[head] = apply_projection(data[head], [tail]) if tail else data[head]
+    return result
+
+
+class FakeBackend(Backend):
+    """An in-memory backend, for tests and benchmarks: nothing is run, nothing is requested.
+
+       INSTANCES and PROJECTS are lists of resources, as gcloud would list them. Instances
+       belong to the project that appears in their zone URI.
+
+       CONFIG holds gcloud configuration properties, without their "core/" section (i.e.
+       "project", "account"). A few entries change how listings behave, like they do with
+       our stubbed gcloud:
+       - "accounts": accounts gcloud has credentials for
+       - "project_access": account => IDs of the projects it can reach (all by default)
+       - "disabled_apis": IDs of the projects where the Compute Engine API is disabled
+
+       Listing failures are raised as CalledProcessError, with gcloud's error messages.
+       All calls are recorded in `calls`, as (method name, arguments) tuples."""
+    def __init__(self, instances=[], projects=[], config={}):
+        self.instances = list(instances)
+        self.projects = list(projects)
+        self.config = dict(config)
+        self.calls = []
+
+    def _current_account(self, env):
+        return (env or {}).get("CLOUDSDK_CORE_ACCOUNT") or self.config.get("account")
+
+    def _reachable_projects(self, env):
+        """IDs of the projects the current account can reach, or None for all of them"""
+        return self.config.get("project_access", {}).get(self._current_account(env))
+
+    def _fail(self, args, message):
+        raise CalledProcessError(1, args, "", f"ERROR: ({'.'.join(args)}) {message}\n")
+
+    async def iter_instances(self, project_id, fields=None, name_regex=None, env=None):
+        self.calls.append(("iter_instances", (project_id, fields, name_regex, env)))
+        failing_command = ["gcloud", "compute", "instances", "list"]
+        reachable = self._reachable_projects(env)
+        if reachable is not None and project_id not in reachable:
+            self._fail(failing_command, "Some requests did not succeed:\n - Required "
+                       f"'compute.instances.list' permission for 'projects/{project_id}'")
+        if project_id in self.config.get("disabled_apis", []):
+            self._fail(failing_command, "Some requests did not succeed:\n - Compute Engine "
+                       f"API has not been used in project {project_id} before or it is "
+                       "disabled.")
+
+        for instance in self.instances:
+            if f"/projects/{project_id}/" not in instance["zone"]:
+                continue
+            if name_regex and not re.search(name_regex, instance["name"]):
+                continue
+            yield apply_projection(instance, fields) if fields else instance
+
+    async def list_projects(self, env=None):
+        self.calls.append(("list_projects", (env,)))
+        reachable = self._reachable_projects(env)
+        return [project for project in self.projects
+                if reachable is None or project["projectId"] in reachable]
+
+    async def config_get(self, key, env=None):
+        self.calls.append(("config_get", (key, env)))
+        section, _, name = key.rpartition("/")
+        value = (env or {}).get(f"CLOUDSDK_{section or 'core'}_{name}".upper())
+        return value or self.config.get(key.replace("core/", ""))
+
+    def config_set(self, key, value):
+        self.calls.append(("config_set", (key, value)))
+        self.config[key.replace("core/", "")] = value
+
+    async def list_accounts(self, env=None):
+        self.calls.append(("list_accounts", (env,)))
+        active = self._current_account(env)
+        return [{"account": account, "status": "ACTIVE" if account == active else ""}
+                for account in self.config.get("accounts", [])]
+
+    def login(self, account_id):
+        self.calls.append(("login", (account_id,)))
+        self.config["account"] = account_id
+
+    def activate_service_account(self, key_file_path):
+        self.calls.append(("activate_service_account", (key_file_path,)))
+        with open(key_file_path, "r") as f:
+            self.config["account"] = json.load(f)["client_email"]
@@ -0,0 +1,25 @@
+from ..util.cmd import acmd, acmd_stream
+from .base import Backend
+
+
+class GCloudBackend(Backend):
+    """Lists GCP resources by shelling out to gcloud. This is the default backend."""
+
+    async def iter_instances(self, project_id, fields=None, name_regex=None, env=None):
+        """Yields instance resources for project PROJECT_ID, while gcloud lists them.
+
+           FIELDS optionally restricts resources to some keys, in gcloud projection syntax.
+           NAME_REGEX optionally restricts instances to those whose name matches it.
+           ENV optionally sets environment variables for gcloud (see cmd)."""
+        list_args = ["gcloud", f"--project={project_id}", "--quiet",
+                     "compute", "instances", "list"]
+        if name_regex:
+            list_args.append(f"--filter=name~'{name_regex}'")
+        projection = ",".join(fields) if fields else None
+        async for instance in acmd_stream(list_args, projection=projection, env=env):
+            yield instance
+
+    async def list_projects(self, env=None):
+        """Returns a list of project resources reachable with the active account"""
+        return await acmd("gcloud --quiet projects list", structured=True, readonly=True,
+                          env=env)
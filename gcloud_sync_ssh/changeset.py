@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+
+class Change(namedtuple("Change", ["hostname", "project", "reason", "ip", "id"])):
+    """A change to a host of the SSH config. IP and ID are the instance's, when relevant."""
+
+
+class ChangeSet(object):
+    """Changes to make to an SSH config (see SSHConfig.apply): hosts to add, hosts whose IP
+       changed, and hosts to remove. Each change is tagged with a project and a reason."""
+    def __init__(self):
+        self.adds = []
+        self.updates = []
+        self.removals = []
+
+    def add(self, hostname, ip, id, project=None, reason="new instance"):
+        self.adds.append(Change(hostname, project, reason, ip, id))
+
+    def update_ip(self, hostname, ip, project=None, reason="IP changed"):
+        self.updates.append(Change(hostname, project, reason, ip, None))
+
+    def remove(self, hostname, project=None, reason="vanished"):
+        self.removals.append(Change(hostname, project, reason, None, None))
+
+    def extend(self, other):
+        """Adds the changes of OTHER, another ChangeSet"""
+        self.adds += other.adds
+        self.updates += other.updates
+        self.removals += other.removals
+
+    def __iter__(self):
+        """Yields (kind, change) tuples, kind being "add", "update" or "remove" """
+        for kind, changes in [("add", self.adds), ("update", self.updates),
+                              ("remove", self.removals)]:
+            for change in changes:
+                yield kind, change
+
+    def __len__(self):
+        return len(self.adds) + len(self.updates) + len(self.removals)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def summary(self):
+        return f"{len(self.adds)} added, {len(self.updates)} updated, " \
+            f"{len(self.removals)} removed"
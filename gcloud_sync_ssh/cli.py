@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-from contextlib import contextmanager, suppress
+import asyncio
+from contextlib import ExitStack, contextmanager, suppress
+import json
+import io
+import os
 import sys
 import typing
 
@@ -9,13 +13,24 @@ from loguru import logger
 from pydantic import ValidationError
 
 from . import __version__
-from .gcloud_auth import GCloudServiceAccountAuth, GCloudAccountIdAuth
+from .backends import ComputeAPIBackend, GCloudBackend, set_backend
+from .changeset import ChangeSet
+from .gcloud_auth import (GCloudAccountIdAuth, GCloudIsolatedAuth, GCloudServiceAccountAuth,
+                          account_env, list_accounts)
 from .gcloud_config import gcloud_config_get
-from .gcloud_instances import build_host_dict
-from .gcloud_projects import fetch_projects_data
+from .gcloud_instances import abuild_host_dict
+from .gcloud_projects import fetch_accounts_projects_data, fetch_projects_data
 from .host_config import HostConfig
+from .inventory import InventoryStore
+from .util.aio import run
 from .util.case_insensitive_dict import CaseInsensitiveDict
+from .util.cmd import clear_memo, set_concurrency_limit
+from .util.cmd_stats import stats
 from .util.globbing import has_pattern, matches_any
+from .util.profiling import Profiler
+from .util.retry import RetryPolicy, set_retry_policy
+from .util import tracing
+from .util.tracing import span
 from .ssh_config import SSHConfig, SSHConfigParseError
 
 
@@ -24,10 +39,52 @@ def nullcontext():
     yield
 
 
-def _sync_instances(project_id, instance_globs, ssh_config, host_template,
-                    no_remove_stopped, no_remove_vanished):
-    data = build_host_dict(project_id, instance_globs)
-
+async def _enumerate_instances(project_list, instance_globs, apply, project_envs={},
+                               unreachable_ttl=0, reprobe=False):
+    """Enumerates instances of all projects in PROJECT_LIST concurrently, then calls
+       APPLY(project_id, host_dict) for each project. Projects that couldn't be listed (see
+       abuild_host_dict) are left alone.
+
+       APPLY is called in PROJECT_LIST order regardless of which enumerations finish first,
+       so that the outcome is exactly the same as in a sequential run.
+       Concurrency is bounded by the util.cmd concurrency limit.
+       PROJECT_ENVS optionally maps projects to the gcloud environment to list them with.
+       See abuild_host_dict for UNREACHABLE_TTL and REPROBE."""
+    async def fetch(project_id):
+        logger.info(f"[{project_id}] Enumerating instances")
+        with span("fetch", project=project_id):
+            return await abuild_host_dict(project_id, instance_globs,
+                                          env=project_envs.get(project_id),
+                                          unreachable_ttl=unreachable_ttl, reprobe=reprobe)
+
+    tasks = [asyncio.ensure_future(fetch(project_id)) for project_id in project_list]
+    try:
+        for project_id, task in zip(project_list, tasks):
+            host_dict = await task
+            if host_dict is None:
+                logger.info(f"[{project_id}] Instances unknown, leaving its hosts as they are")
+                continue
+            with span("apply", project=project_id):
+                apply(project_id, host_dict)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _needs_apply(ssh_config, host, hd, no_remove_stopped):
+    """Returns True unless SSH_CONFIG already reflects host data HD for HOST"""
+    if hd['status'] == 'RUNNING' and hd['ip']:
+        return ssh_config.host_ip(host) != hd['ip']
+    if hd['status'] == 'TERMINATED' and not no_remove_stopped:
+        return host in ssh_config
+    return False
+
+
+def _sync_instances(project_id, data, ssh_config, no_remove_stopped, no_remove_vanished,
+                    inventory=None):
+    """Returns the ChangeSet that brings SSH_CONFIG in line with DATA, the instances of
+       PROJECT_ID. SSH_CONFIG itself is left untouched, see SSHConfig.apply."""
+    changeset = ChangeSet()
     host_statuses = [datum['status'] for datum in data.values()]
     status_recap_dict = {status: host_statuses.count(status) for status in set(host_statuses)}
     status_recap_list = [f"{status_recap_dict[status]} {status}"
@@ -35,43 +92,75 @@ def _sync_instances(project_id, instance_globs, ssh_config, host_template,
     status_recap = ", ".join(status_recap_list)
     logger.info(f"[{project_id}] Instance status: {status_recap}")
 
-    seen_hosts = set()
+    seen_hosts = set(data.keys())
+
+    if inventory is not None:
+        delta = inventory.diff(project_id, data)
+        inventory.stage(project_id, data)
+        if delta:
+            logger.info(f"[{project_id}] Since last run: {delta.summary()}")
+            for kind in ["added", "changed", "removed"]:
+                for host in getattr(delta, kind):
+                    logger.debug(f"[{project_id}] {host} {kind}")
+
+        # Only apply what changed since the last run - and whatever the config doesn't
+        # reflect (i.e. when it has been edited, or when changes weren't saved)
+        data = {host: hd for host, hd in data.items()
+                if host not in delta.unchanged or
+                _needs_apply(ssh_config, host, hd, no_remove_stopped)}
+
     for host, hd in data.items():
-        seen_hosts.add(host)
         # See https://cloud.google.com/compute/docs/instances/instance-life-cycle
         # for status state machine
 
         # We ignore transitional states and suspension-related cases
         if hd['status'] == 'RUNNING':
-            if hd['ip']:
-                ssh_config.update_host(host, ip=hd['ip'], id=hd['id'], template=host_template)
-            else:
+            if not hd['ip']:
                 # XXX there is an argument to be made for removing the instance here
                 pass
+            elif host not in ssh_config:
+                changeset.add(host, hd['ip'], hd['id'], project=project_id)
+            elif ssh_config.host_ip(host) != hd['ip']:
+                changeset.update_ip(host, hd['ip'], project=project_id)
 
         if hd['status'] == 'TERMINATED':
-            if not no_remove_stopped:
-                ssh_config.remove_host(host)
+            if not no_remove_stopped and host in ssh_config:
+                changeset.remove(host, project=project_id, reason="stopped")
 
     # Remove vanished/deleted instances
     if not no_remove_vanished:
         config_hosts = ssh_config.hosts_of_project(project_id)
-        for host in (set(config_hosts.keys()) - seen_hosts):
-            ssh_config.remove_host(host)
+        for host in sorted(set(config_hosts.keys()) - seen_hosts):
+            changeset.remove(host, project=project_id, reason="vanished")
 
+    return changeset
 
-def _prepare_auth_context(login=None, service_account=None):
+
+def _prepare_auth_context(login=None, service_account=None, isolated=False):
     ctx = nullcontext()
     if login:
         if service_account:
             logger.error("--login and --service-account cannot be used simultaneously")
             exit(1)
-        ctx = GCloudAccountIdAuth(login)
+        ctx = GCloudIsolatedAuth(account_id=login) if isolated else GCloudAccountIdAuth(login)
     elif service_account:
-        ctx = GCloudServiceAccountAuth(service_account)
+        ctx = GCloudIsolatedAuth(service_account_key_path=service_account) if isolated \
+            else GCloudServiceAccountAuth(service_account)
     return ctx
 
 
+def _commit_inventory(inventory):
+    """Persists instances listed during this run, once the SSH config reflects them"""
+    if inventory is not None:
+        inventory.commit()
+
+
+def _prepare_backend(backend_name, jobs):
+    if backend_name == "api":
+        return ComputeAPIBackend(concurrency=jobs)
+    return GCloudBackend()
+
+
 def _pp_validation_errors(ex):
     for err in ex.errors():
         t = err["type"]
@@ -82,6 +171,38 @@ def _pp_validation_errors(ex):
             logger.error(f"{t} in field {field} : {err['msg']}")
 
 
+def _save_trace(path):
+    tracer = tracing.disable()
+    if tracer:
+        tracer.save(path)
+        logger.info(f"Trace written to {path}")
+
+
+def _start_profile(cpu_only):
+    profiler = Profiler(cpu_only=cpu_only)
+    profiler.start()
+    return profiler
+
+
+def _save_profile(profiler, path, top):
+    profile_stats = profiler.stop()
+    profile_stats.dump_stats(os.path.expanduser(path))
+    logger.info(f"Profile written to {path}")
+    if top:
+        profile_stats.stream = io.StringIO()
+        profile_stats.sort_stats("tottime").print_stats(top)
+        click.echo(profile_stats.stream.getvalue())
+
+
+def _report_stats(show, json_path):
+    if show:
+        click.echo("\n".join(stats.report()))
+    if json_path:
+        with open(os.path.expanduser(json_path), "w") as fh:
+            json.dump(stats.to_dict(), fh, indent=2)
+        logger.info(f"Statistics written to {json_path}")
+
+
 def _build_host_template(inferred_kwargs={}, no_host_defaults=[], cli_kwargs=[]):
     """Prepares our template HostConfig for hosts we are going to discover"""
     # XXX: hosts we need to update don't use the template at all, but could, to batch edit)
@@ -142,10 +263,30 @@ def _build_host_template(inferred_kwargs={}, no_host_defaults=[], cli_kwargs=[])
               help="Perform gcloud auth to a specific account before running")
 @click.option("-s", "--service-account", type=str, metavar="AUTH_PATH",
               help="Perform gcloud auth to a specific service account before running")
+@click.option("--isolated-auth", is_flag=True, default=False,
+              help="Pass the --login/--service-account account to each gcloud invocation "
+              "instead of switching gcloud's active account. --login accounts must already "
+              "have credentials")
+@click.option("-a", "--account", type=str, multiple=True, metavar="ACCOUNT",
+              help="Synchronize projects reachable with a specific gcloud account "
+              "(can be specified several times)")
+@click.option("-A", "--all-accounts", is_flag=True, default=False,
+              help="Synchronize projects reachable with any account gcloud has credentials for")
 @click.option("-P", "--all-projects", is_flag=True,
               help="Synchronize instances in all reachable projects")
 @click.option("-p", "--project", type=str, multiple=True, metavar="PROJECT_NAME",
               help="Synchronize instances in a specific project (can be specified several times)")
+@click.option("--projects-ttl", type=click.IntRange(min=0), default=0, show_default=True,
+              metavar="SECONDS",
+              help="Reuse the reachable projects list for that long (0 disables caching)")
+@click.option("--refresh-projects", is_flag=True, default=False,
+              help="Don't reuse a previously cached reachable projects list")
+@click.option("--unreachable-ttl", type=click.IntRange(min=0), default=0, show_default=True,
+              metavar="SECONDS",
+              help="Skip projects where instances can't be listed (Compute Engine API "
+              "disabled, missing permissions) for that long (0 disables)")
+@click.option("--reprobe-projects", is_flag=True, default=False,
+              help="List instances of projects skipped because of --unreachable-ttl anyway")
 @click.option("-c", "--ssh-config", type=str,
               help="Path the SSH config file", metavar="CONFIG_PATH",
               default="~/.ssh/config")
@@ -174,12 +315,49 @@ Ex: "-kw StrictHostKeyChecking=" to remove the field
               help="Display 'Host' template and exit")
 @click.option("--no-backup", is_flag=True, default=False,
               help="Don't save SSH configuration backup.")
+@click.option("--no-inventory", is_flag=True, default=False,
+              help="Don't compare instances to those seen during the previous run.")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=4, show_default=True,
+              help="Run up to N gcloud commands concurrently", metavar="N")
+@click.option("--backend", type=click.Choice(["gcloud", "api"]), default="gcloud",
+              show_default=True,
+              help="List projects and instances with gcloud, or directly with GCP REST APIs")
+@click.option("--gcloud-timeout", type=click.IntRange(min=0), default=300, show_default=True,
+              metavar="SECONDS",
+              help="Kill gcloud listings (and API calls) that take longer (0 disables)")
+@click.option("--gcloud-retries", type=click.IntRange(min=0), default=2, show_default=True,
+              metavar="N",
+              help="Retry gcloud listings (and API calls) up to N times on transient failures")
+@click.option("--hedge", type=click.IntRange(min=1, max=99), metavar="PERCENTILE",
+              help="Start a duplicate gcloud listing when one takes longer than this "
+              "percentile of previous ones, and use the first to complete")
+@click.option("--stats", "show_stats", is_flag=True, default=False,
+              help="Display statistics about gcloud calls (and API calls) when done")
+@click.option("--stats-json", type=click.Path(dir_okay=False, writable=True),
+              metavar="STATS_PATH",
+              help="Write statistics about gcloud calls (and API calls), including each of "
+              "them, as JSON")
+@click.option("--profile", type=click.Path(dir_okay=False, writable=True),
+              metavar="PROFILE_PATH",
+              help="Profile the run with cProfile (worker threads included), write the "
+              ".pstats file and display the functions that took the longest")
+@click.option("--profile-top", type=click.IntRange(min=0), default=25, show_default=True,
+              metavar="N", help="Amount of functions displayed by --profile (0 displays none)")
+@click.option("--profile-cpu-only", is_flag=True, default=False,
+              help="Only attribute CPU time of gcloud_sync_ssh itself with --profile, "
+              "leaving out time spent waiting on gcloud")
+@click.option("--trace", type=click.Path(dir_okay=False, writable=True), metavar="TRACE_PATH",
+              help="Record how long each step and gcloud command takes, as a Chrome trace "
+              "(open it with https://ui.perfetto.dev or chrome://tracing)")
 def cli(instance_globs,
-        login, service_account,
-        all_projects, project,
+        login, service_account, isolated_auth, account, all_accounts,
+        all_projects, project, projects_ttl, refresh_projects, unreachable_ttl,
+        reprobe_projects, jobs, backend,
+        gcloud_timeout, gcloud_retries, hedge, show_stats, stats_json,
+        profile, profile_top, profile_cpu_only, trace,
         ssh_config, kwarg,
         version, debug_template, not_interactive,
-        no_inference, no_backup, no_host_defaults, no_host_key_alias,
+        no_inference, no_backup, no_inventory, no_host_defaults, no_host_key_alias,
         no_remove_stopped, no_remove_vanished):
     """An improved version of `gcloud compute config-ssh`.
        See https://github.com/mrzor/gcloud_sync_ssh/blob/master/README.md for more info."""
@@ -199,22 +377,49 @@ def cli(instance_globs,
         '<level>{message}</level>'  # Simpler format, but still pretty
     logger.add(sys.stderr, format=log_format, level="INFO")  # Change default log level
 
+    # Read-only gcloud results are only reused within a run, so are statistics
+    clear_memo()
+    stats.reset()
+
+    # Profile and record spans until we're done, whichever way that is
+    if profile:
+        profiler = _start_profile(profile_cpu_only)
+        click.get_current_context().call_on_close(
+            lambda: _save_profile(profiler, profile, profile_top))
+    if trace:
+        tracing.enable()
+        click.get_current_context().call_on_close(lambda: _save_trace(trace))
+    if show_stats or stats_json:
+        click.get_current_context().call_on_close(lambda: _report_stats(show_stats, stats_json))
+
     if project and all_projects:
         logger.error("--project and --all-projects cannot be used simultaneously")
         exit(1)
 
+    if account and all_accounts:
+        logger.error("--account and --all-accounts cannot be used simultaneously")
+        exit(1)
+
+    if (account or all_accounts) and (login or service_account):
+        logger.error("--account/--all-accounts and --login/--service-account "
+                     "cannot be used simultaneously")
+        exit(1)
+
     # Load config (exit before any IPC if it's wrong)
     try:
-        _ssh_config = SSHConfig(ssh_config)
+        with span("parse config"):
+            _ssh_config = SSHConfig(ssh_config)
     except SSHConfigParseError as e:
         logger.error(f"SSH Config parse error: {e}")
         exit(1)
 
     # Prepare Host template
-    inferred_kwargs = _ssh_config.infer_host_config().minidict() if not no_inference else {}
-    host_template = _build_host_template(inferred_kwargs=inferred_kwargs,
-                                         no_host_defaults=no_host_defaults,
-                                         cli_kwargs=kwarg)
+    with span("infer template"):
+        inferred_kwargs = _ssh_config.infer_host_config().minidict() \
+            if not no_inference else {}
+        host_template = _build_host_template(inferred_kwargs=inferred_kwargs,
+                                             no_host_defaults=no_host_defaults,
+                                             cli_kwargs=kwarg)
     if debug_template:
         logger.info("Displaying host template")
         print(''.join(host_template.lines()))
@@ -222,49 +427,110 @@ def cli(instance_globs,
         return
 
     # Prepare gcloud auth context
-    ctx = _prepare_auth_context(login=login, service_account=service_account)
+    ctx = _prepare_auth_context(login=login, service_account=service_account,
+                                isolated=isolated_auth)
+    env = getattr(ctx, "env", None)  # Only set for isolated auth
+
+    # Prepare gcloud invocations and listing backend
+    set_concurrency_limit(jobs)
+    previous_retry_policy = set_retry_policy(RetryPolicy(timeout=gcloud_timeout or None,
+                                                         retries=gcloud_retries,
+                                                         hedge_percentile=hedge))
+    _backend = _prepare_backend(backend, jobs)
+    previous_backend = set_backend(_backend)
 
-    # Try to obtain active project name if no projects are specified in options
-    if not all_projects and not project:
-        project = [gcloud_config_get("core/project")]
-        if not project[0]:
-            logger.error("could not determine an active project")
-            exit(1)
-
-    # Prepare project list
-    project_list = None
-    if not all_projects and not has_pattern(project):
-        # One or more simple --project options were passed, use "as is"
-        project_list = project
-    else:
-        assert all_projects or has_pattern(project)  # ? obviously
-        # Either we want all projects, or we have some patterns to match against all projects
-        logger.info("Enumerating reachable GCP projects")
-        if has_pattern(project):
-            project_list = [datum["projectId"] for datum in fetch_projects_data()
-                            if matches_any(datum["projectId"], project)]
-        else:
-            project_list = [datum["projectId"] for datum in fetch_projects_data()]
-
-    # Do what we're here to do
-    logger.info(f"Beginning instance enumeration in {len(project_list)} projects")
-    with ctx:  # Restoring our gcloud auth when we're done
-        for project in project_list:
-            logger.info(f"[{project}] Enumerating instances")
-            _sync_instances(project, instance_globs, _ssh_config, host_template,
-                            no_remove_stopped, no_remove_vanished)
+    try:
+        # Try to obtain active project name if no projects are specified in options
+        # (With several accounts, all their projects are synchronized by default)
+        if not all_projects and not project and not (account or all_accounts):
+            project = [gcloud_config_get("core/project", env=env)]
+            if not project[0]:
+                logger.error("could not determine an active project")
+                exit(1)
+
+        # Instances seen during the previous run
+        inventory = None
+        if not no_inventory:
+            inventory = InventoryStore(ssh_config)
+            # Closed however the run ends (declined changes, errors...)
+            click.get_current_context().call_on_close(inventory.close)
+
+        # Prepare project list
+        project_list = None
+        project_envs = {}
+        with span("enumerate projects"):
+            if account or all_accounts:
+                # Each project is listed with (the first of) the accounts that can reach it
+                accounts = list(account) or list_accounts()
+                logger.info(f"Enumerating GCP projects reachable with {len(accounts)} accounts")
+                accounts_projects = fetch_accounts_projects_data(accounts, ttl=projects_ttl,
+                                                                 refresh=refresh_projects)
+                project_envs = {datum["projectId"]: account_env(datum_account)
+                                for datum_account, datum in accounts_projects
+                                if not project or matches_any(datum["projectId"], project)}
+                project_list = list(project_envs.keys())
+            elif not all_projects and not has_pattern(project):
+                # One or more simple --project options were passed, use "as is"
+                project_list = project
+            else:
+                assert all_projects or has_pattern(project)  # ? obviously
+                # Either we want all projects, or we have some patterns to match against all
+                # projects
+                logger.info("Enumerating reachable GCP projects")
+                projects_data = fetch_projects_data(ttl=projects_ttl, refresh=refresh_projects,
+                                                    env=env)
+                if has_pattern(project):
+                    project_list = [datum["projectId"] for datum in projects_data
+                                    if matches_any(datum["projectId"], project)]
+                else:
+                    project_list = [datum["projectId"] for datum in projects_data]
+
+        if env:
+            project_envs = dict.fromkeys(project_list, env)
+
+        # Do what we're here to do
+        logger.info(f"Beginning instance enumeration in {len(project_list)} projects")
+
+        changeset = ChangeSet()
+
+        def apply(project_id, data):
+            changeset.extend(_sync_instances(project_id, data, _ssh_config, no_remove_stopped,
+                                             no_remove_vanished, inventory=inventory))
+
+        with ExitStack() as stack:  # Restoring our gcloud auth when we're done
+            with span("auth"):
+                stack.enter_context(ctx)
+            with span("enumerate instances"):
+                run(_enumerate_instances(project_list, instance_globs, apply,
+                                         project_envs=project_envs,
+                                         unreachable_ttl=unreachable_ttl,
+                                         reprobe=reprobe_projects))
+    finally:
+        set_backend(previous_backend)
+        _backend.close()
+        set_retry_policy(previous_retry_policy)
+    logger.info(stats.summary())
+
+    if changeset:
+        logger.info(f"Changes to SSH config: {changeset.summary()}")
+        for kind, change in changeset:
+            logger.debug(f"[{change.project}] {change.hostname}: {kind} ({change.reason})")
+    with span("apply changes"):
+        _ssh_config.apply(changeset, host_template)
 
     # Check what's new
     diff = _ssh_config.diff()
     if not diff:
         logger.info("No changes to SSH config")
+        _commit_inventory(inventory)
         return
 
     # Display diff and ask for confirmation
     if not not_interactive:
         logger.info("Displaying proposed changes as a diff before applying")
-        for line in diff:
-            click.echo(line)
+        with span("diff"):  # Lines are computed as they're displayed
+            for line in diff:
+                click.echo(line)
 
         confirmed = None
         try:
@@ -276,13 +542,15 @@ def cli(instance_globs,
             logger.info("User did not confirm changes. Exiting.")
             exit(0)
 
-    # Backup config file
-    if not no_backup:
-        backup_filename = _ssh_config.backup()
-        logger.info(f"Previous SSH config backed up to {backup_filename}")
+    with span("save"):
+        # Backup config file
+        if not no_backup:
+            backup_filename = _ssh_config.backup()
+            logger.info(f"Previous SSH config backed up to {backup_filename}")
 
-    # Finally save the rewritten confirm
-    config_filename = _ssh_config.save()
+        # Finally save the rewritten confirm
+        config_filename = _ssh_config.save()
     logger.info(f"Rewrote SSH config file at {config_filename}")
+    _commit_inventory(inventory)
 
     # We are done.
@@ -1,9 +1,26 @@
 import json
+import os
 
 from loguru import logger
 
+from .backends import get_backend
 from .gcloud_config import gcloud_config_get
-from .util.cmd import cmd
+from .util.aio import run
+
+
+def account_env(account_id):
+    """Environment that makes gcloud use ACCOUNT_ID, whatever its active account is"""
+    return {"CLOUDSDK_CORE_ACCOUNT": account_id}
+
+
+async def alist_accounts():
+    """Lists accounts gcloud has credentials for (see: gcloud auth list --help)"""
+    return [datum["account"] for datum in await get_backend().list_accounts()]
+
+
+def list_accounts():
+    """Synchronous version of alist_accounts"""
+    return run(alist_accounts())
 
 
 class _GCloudSavedAuth(object):
@@ -20,7 +37,7 @@ and restore the saved authentication upon exiting."""
 
     def __exit__(self, type, value, traceback):
         # Restore previously used authentication
-        cmd(["gcloud", "config", "set", "account", self.previously_used_account])
+        get_backend().config_set("account", self.previously_used_account)
         logger.trace(f"Restored previously used account '{self.previously_used_account}'")
 
 
@@ -41,8 +58,7 @@ class GCloudServiceAccountAuth(_GCloudSavedAuth):
         super().__enter__()  # Save current auth
 
         # Activate service account
-        cmd(["gcloud", "auth", "activate-service-account",
-             f"--key-file={self.service_account_key_path}"])
+        get_backend().activate_service_account(self.service_account_key_path)
         logger.trace(f"Authenticated with '{self.service_account_key_path}'")
 
 
@@ -57,4 +73,30 @@ class GCloudAccountIdAuth(_GCloudSavedAuth):
 
     def __enter__(self):
         super().__enter__()  # Save current auth
-        cmd(["gcloud", "auth", "login", self.account_id])  # Activate new auth
+        get_backend().login(self.account_id)  # Activate new auth
+
+
+class GCloudIsolatedAuth(object):
+    """A ContextManager that authenticates gcloud invocations one by one, through the
+       environment they are run with (see `env`). Global gcloud configuration is left
+       untouched, so that several runs (or Terraform, etc.) can use gcloud side by side.
+
+       Unlike with GCloudAccountIdAuth, the account must already have credentials in gcloud
+       (see: gcloud auth login --help). Service accounts are authenticated with their key
+       file directly (see: gcloud topic configurations, auth/credential_file_override)."""
+    def __init__(self, account_id=None, service_account_key_path=None):
+        assert bool(account_id) != bool(service_account_key_path)
+        self.env = {}
+        if service_account_key_path:
+            with open(service_account_key_path, "r") as f:
+                account_id = json.load(f)["client_email"]
+            self.env["CLOUDSDK_AUTH_CREDENTIAL_FILE_OVERRIDE"] = \
+                os.path.abspath(service_account_key_path)
+        self.env.update(account_env(account_id))
+
+    def __enter__(self):
+        logger.trace(f"Authenticating gcloud invocations with {self.env}")
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
@@ -1,7 +1,70 @@
-from .util.cmd import cmd
+import configparser
+import os
 
+from loguru import logger
 
-def gcloud_config_get(key):
-    """Retrieves a configuration value using gcloud config get-value"""
-    res = cmd(["gcloud", "config", "get-value", key], structured=True)
-    return res
+from .backends import get_backend
+from .util.aio import run
+
+
+def _gcloud_config_dir(environ):
+    """gcloud's user configuration directory: $CLOUDSDK_CONFIG, or ~/.config/gcloud
+       (%APPDATA%\\gcloud on Windows)"""
+    if environ.get("CLOUDSDK_CONFIG"):
+        return os.path.expanduser(environ["CLOUDSDK_CONFIG"])
+    if os.name == "nt" and environ.get("APPDATA"):
+        return os.path.join(environ["APPDATA"], "gcloud")
+    return os.path.join(os.path.expanduser("~"), ".config", "gcloud")
+
+
+def _active_config_name(environ, config_dir):
+    name = environ.get("CLOUDSDK_ACTIVE_CONFIG_NAME")
+    if not name:
+        try:
+            with open(os.path.join(config_dir, "active_config"), "r") as fh:
+                name = fh.read().strip()
+        except OSError:
+            pass
+    return name or "default"
+
+
+def gcloud_config_read(key, env=None):
+    """Resolves a configuration value like gcloud does, but without running it.
+
+       That is a CLOUDSDK_<SECTION>_<NAME> environment variable (ENV included, see cmd), or
+       the value in the active configuration file. Returns None when the value isn't set
+       there: gcloud may still know better (installation properties, defaults...)"""
+    environ = dict(os.environ, **env) if env else os.environ
+    section, _, name = key.rpartition("/")
+    section = section or "core"
+
+    value = environ.get(f"CLOUDSDK_{section}_{name}".upper())
+    if value:
+        return value
+
+    config_dir = _gcloud_config_dir(environ)
+    config_path = os.path.join(config_dir, "configurations",
+                               f"config_{_active_config_name(environ, config_dir)}")
+    parser = configparser.RawConfigParser()
+    try:
+        parser.read(config_path)
+    except configparser.Error as e:
+        logger.debug(f"Can't read gcloud configuration {config_path}: {e}")
+        return None
+    return parser.get(section, name, fallback=None) or None
+
+
+async def agcloud_config_get(key, env=None):
+    """Retrieves a configuration value, from gcloud configuration files when possible,
+       asking the backend (i.e. gcloud config get-value) otherwise"""
+    value = gcloud_config_read(key, env=env)
+    if value is not None:
+        logger.trace(f"gcloud config {key} read from configuration files")
+        return value
+
+    return await get_backend().config_get(key, env=env)
+
+
+def gcloud_config_get(key, env=None):
+    """Synchronous version of agcloud_config_get"""
+    return run(agcloud_config_get(key, env=env))
@@ -1,10 +1,43 @@
 import os
+import re
 from subprocess import CalledProcessError
 
 from loguru import logger
 
-from .util.cmd import cmd
-from .util.globbing import matches_any
+from .backends import ComputeAPIError, get_backend
+from .gcloud_config import agcloud_config_get
+from .util.aio import run
+from .util.disk_cache import JSONFileCache
+from .util.globbing import globs_to_regex, matches_any
+
+
+# The only instance fields we use, in gcloud projection syntax.
+# Asking for those only shrinks listings (and their parsing time) by an order of magnitude.
+_INSTANCE_FIELDS = ["name", "id", "status", "zone", "networkInterfaces[].accessConfigs[].natIP"]
+
+# Listing failures that won't go away by themselves, and their error messages
+# (from gcloud's stderr or the REST API)
+_UNREACHABLE_REASONS = [
+    ("api-disabled", re.compile(r"has not been used in project|or it is disabled|"
+                                r"SERVICE_DISABLED|accessNotConfigured", re.IGNORECASE)),
+    ("forbidden", re.compile(r"Required '[^']+' permission|PERMISSION_DENIED|\bforbidden\b",
+                             re.IGNORECASE)),
+    ("not-found", re.compile(r"The resource 'projects/[^']+' was not found", re.IGNORECASE)),
+]
+
+
+def _unreachable_projects_cache():
+    return JSONFileCache("unreachable_projects.json")
+
+
+def _unreachable_reason(error):
+    """Tells why listing instances failed for good ("api-disabled", "forbidden" or
+       "not-found"), or returns None when it may succeed next time"""
+    message = error.message if isinstance(error, ComputeAPIError) else error.stderr
+    for reason, regex in _UNREACHABLE_REASONS:
+        if message and regex.search(message):
+            return reason
+    return None
 
 
 def _instance_zone(instance_data):
@@ -27,8 +60,9 @@ def _instance_ip(instance_data):
 
     ips = []
 
-    for net_int in instance_data['networkInterfaces']:
-        ips += [ac.get("natIP", None)for ac in net_int['accessConfigs']]
+    # Projected listings omit keys that would be empty
+    for net_int in instance_data.get('networkInterfaces', []):
+        ips += [ac.get("natIP", None) for ac in net_int.get('accessConfigs', [])]
     ips = list(filter(None, ips))
 
     if len(ips) == 0:
@@ -45,36 +79,76 @@ def _instance_ip(instance_data):
     return ip
 
 
-def _fetch_instances_data(project_id):
+async def abuild_host_dict(project_id, instance_globs, env=None, unreachable_ttl=0,
+                           reprobe=False):
+    """Builds a <instance-fake-hostname> => {ip: <instance_ip>, id: <instance_id} map
+       for given project_id and globs.
+
+       Instances are processed one by one while the backend is still listing them.
+       env optionally sets environment variables for gcloud (see cmd).
+
+       With an UNREACHABLE_TTL (in seconds), projects where listing instances fails for good
+       (Compute Engine API disabled, missing permissions...) are remembered along with the
+       account used, and skipped for that long with that account. reprobe=True lists them
+       anyway.
+
+       Returns None for projects that weren't listed: those skipped, and those where listing
+       failed, for good or not (transient errors, timeouts, retries exhausted...). Their
+       instances are unknown, which is not the same as none."""
     assert project_id
-    list_args = ["gcloud", f"--project={project_id}", "--quiet", "compute", "instances", "list"]
+    result = {}
+
+    unreachable_cache, unreachable = None, None
+    if unreachable_ttl:
+        unreachable_cache = _unreachable_projects_cache()
+        unreachable = unreachable_cache.get(project_id, unreachable_ttl)
+        # The account only matters (and is only looked up) for projects known as unreachable
+        if unreachable and not reprobe and \
+                unreachable["account"] == await agcloud_config_get("core/account", env=env):
+            logger.warning(f"Skipping project {project_id}: {unreachable['reason']} "
+                           "(cached, see --reprobe-projects)")
+            return None
+
+    # Have the server filter instances when we can. Matching client side is still done,
+    # and is the only filtering when globs can't be translated to a regex.
+    name_regex = globs_to_regex(instance_globs)
+    if instance_globs and not name_regex:
+        logger.debug(f"Instance globs {instance_globs} can't be filtered server side")
+
+    instance_count = 0
+    instances = get_backend().iter_instances(project_id, fields=_INSTANCE_FIELDS,
+                                             name_regex=name_regex, env=env)
     try:
-        instances = cmd(list_args, structured=True)
-    except CalledProcessError:
+        async for instance_data in instances:
+            instance_count += 1
+            if not matches_any(instance_data['name'], instance_globs):
+                continue
+
+            minidata = {'ip': _instance_ip(instance_data),
+                        'id': instance_data['id'],
+                        'status': instance_data['status']}
+            result[_instance_hostname(project_id, instance_data)] = minidata
+    except (CalledProcessError, ComputeAPIError) as e:
+        reason = _unreachable_reason(e)
+        if unreachable_cache and reason:
+            account = await agcloud_config_get("core/account", env=env)
+            unreachable_cache.set(project_id, {"reason": reason, "account": account})
         if os.getenv("GCSS_RAISE_ON_INSTANCE_SYNC", None):
             raise
         else:
-            return []
+            return None
 
-    if len(instances) == 0:
-        project_label = f"project {project_id}" if project_id else "active project"
-        logger.warning(f"No instances in {project_label}")
+    if unreachable_cache and unreachable:
+        unreachable_cache.delete(project_id)  # Reachable (again, or with another account)
 
-    return instances
+    if instance_count == 0:
+        matching = "matching " if name_regex else ""
+        logger.warning(f"No {matching}instances in project {project_id}")
 
+    return result
 
-def build_host_dict(project_id, instance_globs):
-    """Builds a <instance-fake-hostname> => {ip: <instance_ip>, id: <instance_id} map
-       for given project_id and globs"""
-    result = {}
-
-    for instance_data in _fetch_instances_data(project_id):
-        if not matches_any(instance_data['name'], instance_globs):
-            continue
-
-        minidata = {'ip': _instance_ip(instance_data),
-                    'id': instance_data['id'],
-                    'status': instance_data['status']}
-        result[_instance_hostname(project_id, instance_data)] = minidata
 
-    return result
+def build_host_dict(project_id, instance_globs, env=None, unreachable_ttl=0, reprobe=False):
+    """Synchronous version of abuild_host_dict"""
+    return run(abuild_host_dict(project_id, instance_globs, env=env,
+                                unreachable_ttl=unreachable_ttl, reprobe=reprobe))
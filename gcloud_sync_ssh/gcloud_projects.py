@@ -1,6 +1,73 @@
-from .util.cmd import cmd
+import asyncio
+from subprocess import CalledProcessError
 
+from loguru import logger
 
-def fetch_projects_data():
-    projects = cmd("gcloud --quiet projects list", structured=True)
+from .backends import ComputeAPIError, get_backend
+from .gcloud_auth import account_env
+from .gcloud_config import agcloud_config_get
+from .util.aio import run
+from .util.cmd import clear_memo
+from .util.disk_cache import JSONFileCache
+
+
+def _projects_cache():
+    return JSONFileCache("projects.json")
+
+
+async def afetch_projects_data(ttl=0, refresh=False, env=None):
+    """Lists projects reachable with the active account (or the one set in ENV, see cmd).
+
+       With a TTL (in seconds), results are cached on disk per account, and reused for that
+       long. refresh=True ignores cached (or memoized) results, and caches fresh ones."""
+    if not ttl:
+        return await get_backend().list_projects(env=env)
+
+    if refresh:
+        clear_memo()
+
+    account = await agcloud_config_get("core/account", env=env) or ""
+    cache = _projects_cache()
+    if not refresh:
+        projects = cache.get(account, ttl)
+        if projects is not None:
+            logger.info(f"Using cached project list ({len(projects)} projects)")
+            return projects
+
+    projects = await get_backend().list_projects(env=env)
+    cache.set(account, projects)
     return projects
+
+
+def fetch_projects_data(ttl=0, refresh=False, env=None):
+    """Synchronous version of afetch_projects_data"""
+    return run(afetch_projects_data(ttl=ttl, refresh=refresh, env=env))
+
+
+async def afetch_accounts_projects_data(accounts, ttl=0, refresh=False):
+    """Lists projects reachable with any of ACCOUNTS, concurrently.
+
+       Returns (account, project resource) pairs. Projects reachable with several accounts
+       are only listed once, with the first of ACCOUNTS that reaches them. Accounts whose
+       projects can't be listed (i.e. expired credentials) are skipped."""
+    async def fetch(account):
+        try:
+            return await afetch_projects_data(ttl=ttl, refresh=refresh,
+                                              env=account_env(account))
+        except (CalledProcessError, ComputeAPIError):
+            logger.warning(f"Could not list projects of account {account}, skipping it")
+            return []
+
+    result = []
+    seen_project_ids = set()
+    for account, projects in zip(accounts, await asyncio.gather(*map(fetch, accounts))):
+        for datum in projects:
+            if datum["projectId"] not in seen_project_ids:
+                seen_project_ids.add(datum["projectId"])
+                result.append((account, datum))
+    return result
+
+
+def fetch_accounts_projects_data(accounts, ttl=0, refresh=False):
+    """Synchronous version of afetch_accounts_projects_data"""
+    return run(afetch_accounts_projects_data(accounts, ttl=ttl, refresh=refresh))
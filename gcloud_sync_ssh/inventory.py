@@ -0,0 +1,87 @@
+from collections import namedtuple
+import os
+import sqlite3
+
+from .util.disk_cache import cache_dir
+
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS hosts (
+    config TEXT NOT NULL,
+    project TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    ip TEXT,
+    id TEXT,
+    status TEXT,
+    PRIMARY KEY (config, project, hostname)
+)"""
+
+
+class InventoryDelta(namedtuple("InventoryDelta", ["added", "changed", "removed", "unchanged"])):
+    """Differences between two listings of a project, as hostname => host data dicts.
+
+       `removed` holds the previous host data, the other ones the new host data."""
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def summary(self):
+        return f"{len(self.added)} new, {len(self.changed)} changed, " \
+            f"{len(self.removed)} gone"
+
+
+class InventoryStore(object):
+    """Persists the instances seen in each project during the last run, so that new
+       listings can be compared to them.
+
+       Data is kept in a SQLite database, separately for each SSH config file.
+       New listings are staged with `stage`, and only persisted by `commit` - which should
+       happen once they are reflected in the saved SSH config."""
+    def __init__(self, config_path, path=None):
+        self._config = os.path.abspath(os.path.expanduser(config_path))
+        self.path = path or os.path.join(cache_dir(), "inventory.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30)
+        with self._db:
+            self._db.execute(_SCHEMA)
+        self._staged = {}
+
+    def load(self, project_id):
+        """Returns the hostname => host data dict persisted for PROJECT_ID"""
+        rows = self._db.execute("SELECT hostname, ip, id, status FROM hosts "
+                                "WHERE config = ? AND project = ?", (self._config, project_id))
+        return {hostname: {"ip": ip, "id": id, "status": status}
+                for hostname, ip, id, status in rows}
+
+    def diff(self, project_id, data):
+        """Compares DATA, a build_host_dict result, to what was persisted for PROJECT_ID"""
+        previous = self.load(project_id)
+        added, changed, unchanged = {}, {}, {}
+        for hostname, hd in data.items():
+            if hostname not in previous:
+                added[hostname] = hd
+            elif previous[hostname] != hd:
+                changed[hostname] = hd
+            else:
+                unchanged[hostname] = hd
+        removed = {hostname: hd for hostname, hd in previous.items() if hostname not in data}
+        return InventoryDelta(added, changed, removed, unchanged)
+
+    def stage(self, project_id, data):
+        """Stages DATA as the new listing for PROJECT_ID"""
+        self._staged[project_id] = data
+
+    def commit(self):
+        """Persists all staged listings in a single transaction"""
+        with self._db:
+            for project_id, data in self._staged.items():
+                self._db.execute("DELETE FROM hosts WHERE config = ? AND project = ?",
+                                 (self._config, project_id))
+                self._db.executemany(
+                    "INSERT INTO hosts (config, project, hostname, ip, id, status) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(self._config, project_id, hostname, hd["ip"], hd["id"], hd["status"])
+                     for hostname, hd in data.items()])
+        self._staged = {}
+
+    def close(self):
+        self._db.close()
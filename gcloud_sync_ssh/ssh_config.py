@@ -20,10 +20,10 @@ _END_MARKER = '# End of Google Compute Engine Section'
 _GCSS_COMMENT = """# This block has been generated by gcloud_sync_ssh
 # It should be safe to edit manually."""
 
-_RE_COMMENT = re.compile("^ *#")
-_RE_EMPTY = re.compile(r"^[ \t]*$")
-_RE_HOST = re.compile(r'^ *Host (.+)$')
-_RE_KV = re.compile(r'^(?P<WS> *)(?P<K>[^ =]+)[ =] *(?P<V>.+)$')  # V may be quoted
+_KV_PATTERN = r'(?P<WS> *)(?P<K>[^ =]+)[ =] *(?P<V>.+)$'  # V may be quoted
+_RE_KV = re.compile('^' + _KV_PATTERN)
+# Lines of the managed section: empty lines and comments, then Host lines, then keyword=value
+_RE_LINE = re.compile(r'^(?:[ \t]*$| *#| *Host (?P<H>.+)$|' + _KV_PATTERN + ')')
 _RE_PROJECT = re.compile(r'\.([^.]+)$')
 
 _GCLOUD_KW_ORDERING = ['HostName', 'IdentityFile', 'UserKnownHostsFile', 'HostKeyAlias',
@@ -34,18 +34,103 @@ class SSHConfigParseError(RuntimeError):
     pass
 
 
+def _split_lines(text):
+    """Splits TEXT in lines, like readlines does"""
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [f"{line}\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _find_line(text, prefix, start=0):
+    """Offset of the first line of TEXT that starts with PREFIX, from offset START (the
+       beginning of a line), or -1"""
+    if text.startswith(prefix, start):
+        return start
+    offset = text.find(f"\n{prefix}", start)
+    return offset + 1 if offset >= 0 else -1
+
+
+def _lines_before(text, offset, count):
+    """Offset of the line COUNT lines before the one at OFFSET (the beginning of a line)"""
+    for _ in range(count):
+        if offset == 0:
+            break
+        offset = text.rfind("\n", 0, offset - 1) + 1
+    return offset
+
+
+def _lines_after(text, offset, count):
+    """Offset of the line COUNT lines after the one at OFFSET (the beginning of a line)"""
+    for _ in range(count):
+        if offset >= len(text):
+            break
+        offset = text.find("\n", offset) + 1 or len(text)
+    return offset
+
+
+def _line_number(text, offset):
+    """Number of the line of TEXT at OFFSET, starting at 0"""
+    return text.count("\n", 0, offset)
+
+
+class _Block(object):
+    """A part of the managed section: a Host line and the lines that follow it, up to the
+       next Host line (or the end marker). Lines before the first Host line make up a block
+       without a host.
+
+       params maps keywords to {'line': <index in lines>, 'value': ..., 'indent': ...}"""
+    __slots__ = ("hostname", "lines", "params")
+
+    def __init__(self, hostname=None, lines=None):
+        self.hostname = hostname
+        self.lines = lines if lines is not None else []
+        self.params = CaseInsensitiveDict()
+
+    def strip_host(self):
+        """Removes the Host line and its params, leaving other lines (comments, blank
+           lines...) in place. Returns the amount of lines removed."""
+        owned = {0} | {param['line'] for param in self.params.values()}
+        self.lines = [line for i, line in enumerate(self.lines) if i not in owned]
+        self.hostname = None
+        self.params = CaseInsensitiveDict()
+        return len(owned)
+
+
 # from pdb import break_on_setattr
 # @break_on_setattr('dirty')
 class SSHConfig(object):
     """A helper class to manipulate ~/.ssh/config file that follows `gcloud compute config-ssh`
 conventions.
+
+The file contents are kept as read. Changes are made to the blocks of the managed section,
+which replace the original section when rendering: the text before it (up to and including
+the begin marker) and after it (from the end marker on) is never copied or split in lines.
 """
     def __init__(self, path):
         self._path = path
         with open(os.path.expanduser(path), 'r') as _fh:
-            self._lines = _fh.readlines()
-            self._original_lines = self._lines.copy()
-        self._parse()
+            self._parse(_fh.read())
+
+    def _section_lines(self):
+        """The lines that replace the original section, from offset _head to _tail"""
+        lines = list(self._opening)
+        for block in self._blocks:
+            lines += block.lines
+        return lines + self._closing
+
+    @property
+    def _lines(self):
+        """The file lines, as they would be saved"""
+        return _split_lines(self._original[:self._head]) + self._section_lines() + \
+            _split_lines(self._original[self._tail:])
+
+    def _text(self):
+        """The file contents, as they would be saved"""
+        return "".join([self._original[:self._head]] + self._section_lines() +
+                       [self._original[self._tail:]])
 
     def __repr__(self):
         res = [f"SSHConfig at {self._path}\n\n"]
@@ -57,105 +142,116 @@ conventions.
     # lines are interpreted as comments.  Arguments may optionally be enclosed in double quotes
     # (") in order to represent arguments containing spaces.  Configuration options may be sepa‐
     # rated by whitespace or optional whitespace and exactly one ‘=’ (...)
-    def _parse(self):
+    def _parse(self, text):
         # This could/should be rewritten to support Match directives, optionally with a proper
         # parser that matches the config grammar 100%. This version is good enough for what
         # appears in the SSH config block in practice.
+        self._original = text
+        self._opening = []  # Lines added before the blocks, when there was no section
+        self._closing = []  # Lines added after them, likewise
         self._hosts = {}
+        self._projects = {}  # project => hostnames, see hosts_of_project
         self.dirty = False
-        self._begin_line = None
-        self._end_line = None
-        current_host = None
-
-        for i, line in enumerate(self._lines):
-            if line.startswith(_BEGIN_MARKER):
-                if self._begin_line:
-                    raise SSHConfigParseError(f"Duplicate start marker in config on line {i}")
-                self._begin_line = i
-                continue
 
-            if line.startswith(_END_MARKER):
-                self._end_line = i
-                # We don't break here so we can detect if the file has several GCE blocks
-                # and report the error
-                continue
+        # We only concern ourselves with hosts defined between the two markers: they're
+        # searched for in the whole text at once, and only the lines between them are parsed
+        begin = _find_line(text, _BEGIN_MARKER)
+        if begin < 0:
+            end = _find_line(text, _END_MARKER)
+            if end >= 0:
+                raise SSHConfigParseError("Mismatched markers. Begin marker missing ; "
+                                          f"end marker at line {_line_number(text, end)}")
 
-            # XXX split for better test coverage
-            if not line or _RE_EMPTY.match(line) or _RE_COMMENT.match(line):
-                continue
+            # XXX this is outside parsing scope
+            # Config doesnt have our fenced block - create one at the end
+            last = text.rfind("\n") + 1  # Where the last line starts, in case it's unterminated
+            self._head, self._tail = last, len(text)
+            self._opening = [f"{text[last:]}\n", f"{_BEGIN_MARKER}\n"]
+            self._blocks = [_Block(lines=[f"{_GCSS_COMMENT}\n"])]
+            self._closing = [f"{_END_MARKER}\n"]
+            self.dirty = True
+            return
 
-            # We only concern ourselves with hosts defined between
-            # the two markers. We skip while we're not within.
-            if self._begin_line is None:
-                continue
-            if self._begin_line is not None and self._end_line is not None:
-                continue
+        begin_line = _line_number(text, begin)
+        section = text.find("\n", begin) + 1 or len(text)
+        duplicate = _find_line(text, _BEGIN_MARKER, section)
+        if duplicate >= 0:
+            raise SSHConfigParseError("Duplicate start marker in config on line "
+                                      f"{_line_number(text, duplicate)}")
+
+        end = _find_line(text, _END_MARKER, section)
+        if end < 0:
+            raise SSHConfigParseError("Mismatched markers. End marker missing ; "
+                                      f"begin marker at line {begin_line}")
+
+        self._head, self._tail = section, end
+        block = _Block()
+        self._blocks = [block]
+
+        for i, line in enumerate(_split_lines(text[section:end]), begin_line + 1):
+            match = _RE_LINE.match(line)
+            token = match.lastgroup if match else None  # H, V (keyword=value) or None
 
             # Match 'Host' lines
-            host_match = _RE_HOST.match(line)
-            if host_match:
-                current_host = host_match[1].strip()
-                self._hosts[current_host] = {'line': i, 'params': CaseInsensitiveDict()}
+            if token == 'H':
+                block = _Block(match['H'].strip(), [line])
+                self._blocks.append(block)
+                self._add_host(block)
                 continue
 
+            block.lines.append(line)
+
             # Match any other keyword=value line
-            kv_match = _RE_KV.match(line)
-            if kv_match:
-                if not current_host:
-                    logger.debug(f"Keyword `{kv_match['K']}` assignment "
+            if token == 'V':
+                if not block.hostname:
+                    logger.debug(f"Keyword `{match['K']}` assignment "
                                  f"outside of Host block at line {i}")
                     continue
 
-                self._hosts[current_host]['params'][kv_match['K']] = {
-                    'line': i,
-                    'value': kv_match['V'],
-                    'indent': kv_match['WS']
+                block.params[match['K']] = {
+                    'line': len(block.lines) - 1,
+                    'value': match['V'],
+                    'indent': match['WS']
                 }
                 continue
 
-            logger.debug(f"Can't match line #{i}: {line}")
-
-        # XXX this is outside parsing scope
-        if self._begin_line is None and self._end_line is None:
-            # Config doesnt have our fenced block - create one at the end
-            self._lines.append("\n")
-            self._lines.append(f"{_BEGIN_MARKER}\n")
-            self._begin_line = len(self._lines) - 1
-            self._lines.append(f"{_GCSS_COMMENT}\n")
-            self._lines.append(f"{_END_MARKER}\n")
-            self._end_line = len(self._lines) - 1
-            self.dirty = True
-
-        if self._begin_line is None:
-            raise SSHConfigParseError("Mismatched markers. Begin marker missing ; "
-                                      f"end marker at line {self._end_line}")
+            if not match:
+                logger.debug(f"Can't match line #{i}: {line}")
 
-        if self._end_line is None:
-            raise SSHConfigParseError("Mismatched markers. End marker missing ; "
-                                      f"begin marker at line {self._begin_line}")
+    def _add_host(self, block):
+        """Registers the host of BLOCK, and indexes it by project"""
+        self._hosts[block.hostname] = block
+        match = _RE_PROJECT.search(block.hostname)
+        if match:
+            self._projects.setdefault(match[1], set()).add(block.hostname)
 
     def _append_host(self, hostname, ip, id, template):
-        # XXX this should register to self._hosts for consistency (even if it's useless)
-        #     (The easiest way to do this in a foolproof way is to reparse)
         assert isinstance(template, HostConfig), "template must be a HostConfig instance"
         template.HostName = ip  # XXX this mutates an argument. it's bad.
         template.HostKeyAlias = f"compute.{id}"  # XXX likewise
-        new_lines = ["\n", f"Host {hostname}\n"] + template.lines(ordering=_GCLOUD_KW_ORDERING)
-        for new_line in new_lines:
-            self._lines.insert(self._end_line, new_line)
-            self._end_line += 1
+        self._blocks.append(_Block(lines=["\n"]))
+        block = _Block(hostname, [f"Host {hostname}\n"])
+        for line in template.lines(ordering=_GCLOUD_KW_ORDERING):
+            block.lines.append(line)
+            kv_match = _RE_KV.match(line)
+            if kv_match:
+                block.params[kv_match['K']] = {'line': len(block.lines) - 1,
+                                               'value': kv_match['V'],
+                                               'indent': kv_match['WS']}
+        self._blocks.append(block)
+        self._add_host(block)
         self.dirty = True
 
     def _edit_host_ip(self, hostname, ip):
-        params = self._hosts[hostname]["params"]
-        param = params["Hostname"]  # we store the ip in the hostname parameter. confusing.
+        block = self._hosts[hostname]
+        param = block.params["Hostname"]  # we store the ip in the hostname parameter. confusing.
 
         # exit early if nothing should change
         if ip == param["value"]:
             return
 
         self.dirty = True
-        self._lines[param["line"]] = f"{param['indent']}{params._k('Hostname')} {ip}\n"
+        block.lines[param["line"]] = f"{param['indent']}{block.params._k('Hostname')} {ip}\n"
         param["value"] = ip
 
     def update_host(self, hostname, ip, id, template={}):
@@ -164,51 +260,58 @@ conventions.
         else:
             self._append_host(hostname, ip, id, template)
 
-    def _host_lines(self, hostname):
-        assert hostname in self._hosts
-        r = [self._hosts[hostname]['line']]
-        r += [pd['line'] for pd in self._hosts[hostname]["params"].values()]
-        return sorted(r, reverse=True)
+    def __contains__(self, hostname):
+        return hostname in self._hosts
+
+    def host_ip(self, hostname):
+        """Returns the HostName (i.e. the IP) configured for HOSTNAME, or None"""
+        block = self._hosts.get(hostname)
+        param = block.params.get("Hostname") if block else None
+        return param["value"] if param else None
 
     def hosts_of_project(self, project_name):
         """Returns host entries in this config filtered by GCP project name"""
-        def matches_project(hostname):
-            match = _RE_PROJECT.search(hostname)
-            return project_name == match[1] if match else False
-        return {k: v for k, v in self._hosts.items() if matches_project(k)}
+        return {hostname: self._hosts[hostname]
+                for hostname in self._projects.get(project_name, ())}
 
     def remove_host(self, hostname):
         if hostname not in self._hosts:
             return None
 
-        # Remove Host line
-        lines_to_remove = self._host_lines(hostname)
-        for i in lines_to_remove:
-            del self._lines[i]
-
-        # Remove associated kwarg lines
-        offset_to_substract = len(lines_to_remove)
-        last_line_to_remove = lines_to_remove[-1]
-        for host, data in self._hosts.items():
-            if data['line'] > last_line_to_remove:
-                data['line'] -= offset_to_substract
-
-                for ph in data['params'].values():
-                    ph['line'] -= offset_to_substract
-
-        # Remove from internal structures
-        del self._hosts[hostname]
+        # Remove the Host line and its params. Other lines of the block stay where they are.
+        removed = self._hosts.pop(hostname).strip_host()
+        match = _RE_PROJECT.search(hostname)
+        if match:
+            self._projects[match[1]].discard(hostname)
 
         # Set dirty
         self.dirty = True
 
         # Return amount of lines deleted
-        return offset_to_substract
-
-    # XXX: Aggressive removal based on hostname parsing allows removing _deleted_ instances
-    #      as well
-    # def remove_hosts(self, project_name, whitelist=[]):
-    #    pass
+        return removed
+
+    def apply(self, changeset, template={}):
+        """Applies CHANGESET (see changeset.ChangeSet): removed hosts are stripped from their
+           block (see remove_hosts), updated hosts get their new IP, then added hosts are
+           appended using TEMPLATE (see update_host). Other lines are left untouched."""
+        self.remove_hosts(change.hostname for change in changeset.removals)
+        for change in changeset.updates:
+            if change.hostname in self._hosts:
+                self._edit_host_ip(change.hostname, change.ip)
+        for change in changeset.adds:
+            self.update_host(change.hostname, change.ip, change.id, template)
+
+    def remove_hosts(self, hostnames):
+        """Removes several hosts at once, then drops the blocks left empty in a single pass.
+           Returns the amount of lines deleted, 0 if none of HOSTNAMES was there."""
+        removed = 0
+        for hostname in hostnames:
+            removed += self.remove_host(hostname) or 0
+
+        if removed:
+            self._blocks = [block for i, block in enumerate(self._blocks)
+                            if i == 0 or block.hostname or block.lines]
+        return removed
 
     # XXX: Restore this very superior version based on icdiff whenever they ship to PyPY
     # def diff(self, **diff_args):
@@ -231,9 +334,17 @@ conventions.
     def diff(self, **diff_args):
         if not self.dirty:
             return None
-        return pretty_diff(self._original_lines, self._lines,
-                           fromdesc=self._path, todesc="proposed changes",
-                           context_lines=2)
+
+        # Only the section changes: diff it, with the lines around it needed for context
+        context_lines = 2
+        start = _lines_before(self._original, self._head, context_lines)
+        stop = _lines_after(self._original, self._tail, context_lines)
+        before = _split_lines(self._original[start:stop])
+        after = _split_lines(self._original[start:self._head]) + self._section_lines() + \
+            _split_lines(self._original[self._tail:stop])
+        return pretty_diff(before, after, fromdesc=self._path, todesc="proposed changes",
+                           context_lines=context_lines,
+                           line_offset=_line_number(self._original, start))
 
     def backup(self, tag=None, filename=None):
         tag = tag if tag else datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -245,14 +356,20 @@ conventions.
         return backup_filename
 
     def save(self):
+        text = self._text()
         with open(os.path.expanduser(self._path), "w") as fh:
-            for line in self._lines:
-                fh.write(line)
+            fh.write(text)
             fh.flush()
 
-        self._original_lines = self._lines.copy()
+        # What was saved becomes the original. Blocks are left as they are, but whatever
+        # was added around them is now part of the text before and after the section.
+        self._head += len("".join(self._opening))
+        self._tail = len(text) - (len(self._original) - self._tail) - len("".join(self._closing))
+        if self._opening:  # The section was created: its header holds _GCSS_COMMENT as one line
+            self._blocks[0].lines = _split_lines("".join(self._blocks[0].lines))
+        self._original = text
+        self._opening, self._closing = [], []
         self.dirty = False
-        self._parse()
         return self._path
 
     def infer_host_config(self):
@@ -260,21 +377,21 @@ conventions.
            configuration."""
         if len(self._hosts) == 0:
             return HostConfig()
-        first_host = list(self._hosts.values())[0]
+        first_host = next(iter(self._hosts.values()))
 
         # Find keywords defined for all hosts
-        common_keys = set(first_host['params'].keys())
+        common_keys = set(first_host.params.keys())
         for host in self._hosts.values():
-            common_keys &= set(host['params'].keys())
+            common_keys &= set(host.params.keys())
 
         # For each of the common keywords, find those whose argument is stable (does not change
         # between different kwargs)
         stable_kwargs = {}
         for k in common_keys:
             stable = True
-            v = first_host['params'][k]['value']
+            v = first_host.params[k]['value']
             for host in self._hosts.values():
-                stable &= host['params'][k]['value'] == v
+                stable &= host.params[k]['value'] == v
             if stable:
                 stable_kwargs[k] = v
         return HostConfig(**stable_kwargs)
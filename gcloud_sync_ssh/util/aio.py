@@ -0,0 +1,27 @@
+import asyncio
+
+
+def run(coro):
+    """Runs coroutine CORO in a fresh event loop and returns its result.
+
+       This is asyncio.run on Python 3.7+. We are 3.6+, hence the fallback."""
+    if hasattr(asyncio, "run"):
+        return asyncio.run(coro)
+
+    loop = asyncio.new_event_loop()  # pragma: no cover
+    try:  # pragma: no cover
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:  # pragma: no cover
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def current_task():
+    """Returns the asyncio Task running this code, or None outside of one"""
+    try:
+        if hasattr(asyncio, "current_task"):
+            return asyncio.current_task()
+        return asyncio.Task.current_task()  # pragma: no cover
+    except RuntimeError:
+        return None  # No running event loop
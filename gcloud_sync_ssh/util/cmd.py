@@ -1,41 +1,104 @@
+import asyncio
+import codecs
+from contextlib import suppress
+import functools
 import json
 import os
+import signal
 import subprocess
+import time
+import weakref
 
 from loguru import logger
 
+from .cmd_stats import command_kind, stats
+from .json_stream import JSONArrayStreamDecoder
+from .retry import get_retry_policy, is_transient
+from .tracing import span
 
-# NB: I want this to be compatible with Python 3.6+
-def cmd(args, check=True, pipe=True, cwd=None,
-        encoding="UTF-8", debuglog=True, structured=False):
-    """A helper to run subprocess commands.
 
-       pipe=True will 'swallow' stdout/stderr in memory
-       (and can later be check using res.stdout/res.stderr)
+# Maximum amount of subprocesses acmd runs at once, across the whole process
+_concurrency_limit = 8
+_semaphores = weakref.WeakKeyDictionary()  # event loop => asyncio.Semaphore
 
-       pipe=False will reuse current process stderr/stdin
+# Results of successful read-only commands, see `readonly` in cmd
+_memo = {}
+
+
+def set_concurrency_limit(limit):
+    """Sets the maximum amount of subprocesses that acmd runs at the same time."""
+    global _concurrency_limit
+    assert limit >= 1
+    _concurrency_limit = limit
+    _semaphores.clear()
+
+
+def _semaphore():
+    # asyncio primitives are bound to an event loop (before Python 3.10)
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(_concurrency_limit)
+    return _semaphores[loop]
+
+
+def clear_memo():
+    """Forgets all memoized command results"""
+    _memo.clear()
+
+
+def forget_memo(args, cwd=None, encoding="UTF-8", env=None):
+    """Forgets the memoized result of read-only command ARGS (run without structured or
+       projection), so that it is run again next time"""
+    _memo.pop(_memo_key(_prepare_args(args, False, None), cwd, encoding, env), None)
 
-       structured=True adds `--format=json` to the arguments and returns the parsed
-       JSON output instead of the subprocess result."""
 
+def _memo_key(args, cwd, encoding, env):
+    return (tuple(args), cwd, encoding, tuple(sorted(env.items())) if env else None)
+
+
+def _memo_lookup(key, readonly, pipe, debuglog):
+    """Returns a memoized CompletedProcess when there is one. Calls that aren't read-only
+       invalidate all memoized results, as they may change what read-only calls return."""
+    if not readonly:
+        _memo.clear()
+        return None
+
+    if not pipe:
+        return None
+
+    res = _memo.get(key)
+    if res is not None and debuglog:
+        logger.debug(f"cmd (memoized): {' '.join(res.args)}")
+    return res
+
+
+def _memo_store(key, res, readonly, pipe):
+    if readonly and pipe and res.returncode == 0:
+        _memo[key] = res
+
+
+def _child_env(env):
+    """Environment of subprocesses: ours, plus ENV overrides"""
+    if not env:
+        return os.environ
+    child_env = os.environ.copy()
+    child_env.update(env)
+    return child_env
+
+
+def _prepare_args(args, structured, projection):
     if isinstance(args, str):
         args = args.split(" ")
 
     if structured:
-        args.append("--format=json")
+        json_format = f"json({projection})" if projection else "json"
+        args = list(args) + [f"--format={json_format}"]
 
-    args_str = ' '.join(args)
+    return args
 
-    # This can be elegantly replaced by capture_output=pipe in Python 3.7+
-    stdout, stderr = None, None
-    if pipe:
-        stdout, stderr = subprocess.PIPE, subprocess.PIPE
 
-    if debuglog:
-        logger.debug(f"cmd: {args_str}")
-
-    res = subprocess.run(args, stdout=stdout, stderr=stderr,
-                         cwd=cwd, env=os.environ, encoding=encoding)
+def _finalize(res, args_str, check, pipe, encoding, structured):
+    """Checks and post-processes a CompletedProcess, common to cmd and acmd."""
     if check:
         if res.returncode != 0:
             if pipe and encoding:
@@ -48,3 +111,380 @@ def cmd(args, check=True, pipe=True, cwd=None,
         return json.loads(res.stdout)
 
     return res
+
+
+def _stderr_text(res):
+    if isinstance(res.stderr, bytes):
+        return res.stderr.decode("UTF-8", errors="replace")
+    return res.stderr
+
+
+def _output_size(data, encoding):
+    """Size in bytes of (possibly decoded) captured output"""
+    if not data:
+        return 0
+    return len(data.encode(encoding)) if isinstance(data, str) else len(data)
+
+
+def _should_retry(res, timed_out, attempt, attempts):
+    return res.returncode != 0 and attempt + 1 < attempts and \
+        is_transient(res.returncode, _stderr_text(res), timed_out=timed_out)
+
+
+def _log_retry(args_str, res, timed_out, delay):
+    reason = "timed out" if timed_out else f"exit code {res.returncode}"
+    logger.warning(f"cmd `{args_str}` failed ({reason}), retrying in {delay:.1f}s")
+    stats.count("retries")
+
+
+def _earliest(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+# NB: I want this to be compatible with Python 3.6+
+def cmd(args, check=True, pipe=True, cwd=None,
+        encoding="UTF-8", debuglog=True, structured=False, projection=None, readonly=False,
+        env=None):
+    """A helper to run subprocess commands.
+
+       pipe=True will 'swallow' stdout/stderr in memory
+       (and can later be check using res.stdout/res.stderr)
+
+       pipe=False will reuse current process stderr/stdin
+
+       structured=True adds `--format=json` to the arguments and returns the parsed
+       JSON output instead of the subprocess result.
+
+       projection restricts structured output to some keys, using gcloud projection syntax
+       (i.e. "name,networkInterfaces[].networkIP" adds `--format=json(name,...)`).
+
+       readonly=True tells the command has no side effects: its (successful, piped) result
+       is memoized and reused by identical read-only calls. Running any command that is not
+       read-only (i.e. `gcloud config set`) forgets memoized results.
+       Read-only commands also follow the retry policy (see util.retry): they get killed
+       after a timeout, and transient failures are retried. Other commands may wait on the
+       user (i.e. `gcloud auth login`), and are run once, without a timeout.
+
+       env is a dict of environment variables set for this command only, on top of the
+       current environment (i.e. {"CLOUDSDK_CORE_ACCOUNT": ...})."""
+    args = _prepare_args(args, structured, projection)
+    args_str = ' '.join(args)
+
+    memo_key = _memo_key(args, cwd, encoding, env)
+    res = _memo_lookup(memo_key, readonly, pipe, debuglog)
+    if res is not None:
+        return _finalize(res, args_str, check, pipe, encoding, structured)
+
+    # This can be elegantly replaced by capture_output=pipe in Python 3.7+
+    stdout, stderr = None, None
+    if pipe:
+        stdout, stderr = subprocess.PIPE, subprocess.PIPE
+
+    policy = get_retry_policy()
+    attempts = policy.retries + 1 if readonly else 1
+    timeout = policy.timeout if readonly else None
+    invocation_started = time.monotonic()
+    for attempt in range(attempts):
+        if debuglog:
+            logger.debug(f"cmd: {args_str}")
+
+        started = time.monotonic()
+        timed_out = False
+        try:
+            with span(command_kind(args), cat="cmd", cmd=args_str, attempt=attempt):
+                res = subprocess.run(args, stdout=stdout, stderr=stderr, cwd=cwd,
+                                     env=_child_env(env), encoding=encoding, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # subprocess.run killed it already
+            timed_out = True
+            err = f"timed out after {timeout}s" if pipe else None
+            if err and not encoding:
+                err = err.encode()
+            res = subprocess.CompletedProcess(args, -signal.SIGKILL, "" if pipe else None, err)
+            stats.count("timeouts")
+        stats.record(command_kind(args), time.monotonic() - started, res.returncode == 0)
+
+        if not _should_retry(res, timed_out, attempt, attempts):
+            break
+        delay = policy.delay(attempt)
+        _log_retry(args_str, res, timed_out, delay)
+        time.sleep(delay)
+
+    stats.record_invocation(args, time.monotonic() - invocation_started, res.returncode,
+                            _output_size(res.stdout, encoding),
+                            _output_size(res.stderr, encoding), retries=attempt)
+    _memo_store(memo_key, res, readonly, pipe)
+    return _finalize(res, args_str, check, pipe, encoding, structured)
+
+
+def _kill(proc):
+    with suppress(ProcessLookupError):
+        proc.kill()
+
+
+async def _acmd_attempt(args, args_str, pipe, cwd, env, timeout, debuglog):
+    """Runs ARGS once, within the concurrency limit, and kills it after TIMEOUT seconds.
+       Returns a (returncode, stdout, stderr, timed_out) tuple. Outputs are bytes."""
+    stdout, stderr = None, None
+    if pipe:
+        stdout, stderr = asyncio.subprocess.PIPE, asyncio.subprocess.PIPE
+
+    async with _semaphore():
+        if debuglog:
+            logger.debug(f"cmd: {args_str}")
+
+        with span(command_kind(args), cat="cmd", cmd=args_str):
+            proc = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr,
+                                                        cwd=cwd, env=_child_env(env))
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), timeout)
+                return proc.returncode, out, err, False
+            except asyncio.TimeoutError:
+                _kill(proc)
+                await proc.wait()
+                err = f"timed out after {timeout}s".encode() if pipe else None
+                return proc.returncode, b"" if pipe else None, err, True
+            except asyncio.CancelledError:
+                _kill(proc)
+                await proc.wait()
+                raise
+
+
+async def _acmd_hedged(attempt, hedge_after):
+    """Awaits ATTEMPT(), or with HEDGE_AFTER (seconds), the first successful one of two
+       ATTEMPT() started that far apart. The second one is only started when the concurrency
+       limit allows it right away."""
+    primary = asyncio.ensure_future(attempt())
+    tasks = [primary]
+    try:
+        if hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done and not _semaphore().locked():
+                stats.count("hedges")
+                tasks.append(asyncio.ensure_future(attempt()))
+
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # A failure only wins once there's nothing else to wait for
+            winner = next((task for task in done if task.result()[0] == 0), None)
+            if winner is None and not pending:
+                winner = done.pop()
+            if winner is not None:
+                if winner is not primary:
+                    stats.count("hedge_wins")
+                return winner.result()
+    finally:
+        # Cancelled attempts kill their subprocess
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _hedge_after(policy, kind):
+    if policy.hedge_percentile is None:
+        return None
+    return stats.latency_percentile(kind, policy.hedge_percentile)
+
+
+async def acmd(args, check=True, pipe=True, cwd=None,
+               encoding="UTF-8", debuglog=True, structured=False, projection=None,
+               readonly=False, env=None):
+    """The asyncio counterpart of cmd. Arguments and results are the same.
+
+       At most `set_concurrency_limit` subprocesses run at once. If the calling task
+       gets cancelled (i.e. on Ctrl-C), the subprocess is killed before the
+       cancellation propagates.
+
+       Read-only commands may also be hedged, see util.retry.RetryPolicy."""
+    args = _prepare_args(args, structured, projection)
+    args_str = ' '.join(args)
+
+    memo_key = _memo_key(args, cwd, encoding, env)
+    res = _memo_lookup(memo_key, readonly, pipe, debuglog)
+    if res is not None:
+        return _finalize(res, args_str, check, pipe, encoding, structured)
+
+    policy = get_retry_policy()
+    attempts = policy.retries + 1 if readonly else 1
+    timeout = policy.timeout if readonly else None
+    kind = command_kind(args)
+    attempt_fn = functools.partial(_acmd_attempt, args, args_str, pipe, cwd, env, timeout,
+                                   debuglog)
+    loop = asyncio.get_event_loop()
+    invocation_started = loop.time()
+    for attempt in range(attempts):
+        started = loop.time()
+        hedge_after = _hedge_after(policy, kind) if readonly else None
+        returncode, out, err, timed_out = await _acmd_hedged(attempt_fn, hedge_after)
+        if timed_out:
+            stats.count("timeouts")
+        stats.record(kind, loop.time() - started, returncode == 0)
+        output_sizes = _output_size(out, None), _output_size(err, None)
+
+        if pipe and encoding:
+            out, err = out.decode(encoding), err.decode(encoding)
+        res = subprocess.CompletedProcess(args, returncode, out, err)
+
+        if not _should_retry(res, timed_out, attempt, attempts):
+            break
+        delay = policy.delay(attempt)
+        _log_retry(args_str, res, timed_out, delay)
+        await asyncio.sleep(delay)
+
+    stats.record_invocation(args, loop.time() - invocation_started, res.returncode,
+                            *output_sizes, retries=attempt)
+    _memo_store(memo_key, res, readonly, pipe)
+    return _finalize(res, args_str, check, pipe, encoding, structured)
+
+
+async def _spawn_listing(args, cwd, env):
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                cwd=cwd, env=_child_env(env))
+    return proc, asyncio.ensure_future(proc.stderr.read())
+
+
+async def _kill_listing(proc, stderr_task):
+    stderr_task.cancel()
+    _kill(proc)
+    await proc.wait()
+
+
+async def _stream_attempt(args, args_str, cwd, env, encoding, chunk_size, debuglog,
+                          timeout, hedge_after, outcome):
+    """Runs a JSON listing once, and yields its elements. Sets "res" (a CompletedProcess),
+       "timed_out", "decoder" and "stdout_bytes" in OUTCOME once the listing is over.
+
+       The listing is killed after TIMEOUT seconds. With HEDGE_AFTER (seconds), a second
+       identical listing is started if the first one hasn't output anything by then, when
+       the concurrency limit allows it right away. The first to output something wins."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout if timeout else None
+
+    def remaining():
+        return max(0.0, deadline - loop.time()) if deadline is not None else None
+
+    sem = _semaphore()
+    async with sem:
+        with span(command_kind(args), cat="cmd", cmd=args_str):
+            if debuglog:
+                logger.debug(f"cmd: {args_str}")
+
+            candidates = [await _spawn_listing(args, cwd, env)]
+            proc, stderr_task = candidates[0]
+            reads = [asyncio.ensure_future(proc.stdout.read(chunk_size))]
+            hedge_slot = False
+            decoder = JSONArrayStreamDecoder()
+            text_decoder = codecs.getincrementaldecoder(encoding)()
+            timed_out = False
+            received = 0
+            try:
+                if hedge_after is not None:
+                    done, _ = await asyncio.wait(reads, timeout=_earliest(hedge_after, remaining()))
+                    if not done and not sem.locked() and remaining() != 0.0:
+                        await sem.acquire()
+                        hedge_slot = True
+                        stats.count("hedges")
+                        hedge = await _spawn_listing(args, cwd, env)
+                        candidates.append(hedge)
+                        reads.append(asyncio.ensure_future(hedge[0].stdout.read(chunk_size)))
+
+                done, _ = await asyncio.wait(reads, timeout=remaining(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+
+                # Losers go away
+                winner = next(i for i, read in enumerate(reads) if read.done())
+                proc, stderr_task = candidates[winner]
+                chunk = reads[winner].result()
+                for i, (other, other_stderr_task) in enumerate(candidates):
+                    if i != winner:
+                        reads[i].cancel()
+                        await _kill_listing(other, other_stderr_task)
+                candidates = [candidates[winner]]
+                if hedge_slot:
+                    sem.release()
+                    hedge_slot = False
+                if winner:
+                    stats.count("hedge_wins")
+
+                while chunk:
+                    received += len(chunk)
+                    for element in decoder.feed(text_decoder.decode(chunk)):
+                        yield element
+                    chunk = await asyncio.wait_for(proc.stdout.read(chunk_size), remaining())
+                decoder.feed(text_decoder.decode(b"", final=True))
+                err = await asyncio.wait_for(stderr_task, remaining())
+                await asyncio.wait_for(proc.wait(), remaining())
+            except asyncio.TimeoutError:
+                timed_out = True
+                err = f"timed out after {timeout}s".encode()
+            finally:
+                # Timed out, cancelled, or the consumer stopped early
+                for read in reads:
+                    read.cancel()
+                for candidate in candidates:
+                    if candidate[0].returncode is None:
+                        await _kill_listing(*candidate)
+                if hedge_slot:
+                    sem.release()
+
+    outcome["res"] = subprocess.CompletedProcess(args, proc.returncode, None,
+                                                 err.decode(encoding, errors="replace"))
+    outcome["timed_out"] = timed_out
+    outcome["decoder"] = decoder
+    outcome["stdout_bytes"] = received
+
+
+async def acmd_stream(args, check=True, cwd=None, encoding="UTF-8", debuglog=True,
+                      projection=None, chunk_size=65536, env=None):
+    """A streaming version of acmd(..., structured=True), for commands that output a JSON
+       array. This is an async generator that yields array elements one by one, as soon as
+       they are decoded, while the command is still running.
+
+       check has the same semantics as in acmd, but CalledProcessError can only be raised
+       once all the output has been consumed.
+
+       Listings are considered read-only, but are not memoized. They follow the retry policy
+       (see util.retry), except that failures are only retried when nothing was yielded."""
+    args = _prepare_args(args, True, projection)
+    args_str = ' '.join(args)
+
+    policy = get_retry_policy()
+    attempts = policy.retries + 1
+    kind = command_kind(args)
+    loop = asyncio.get_event_loop()
+    invocation_started = loop.time()
+    for attempt in range(attempts):
+        started = loop.time()
+        outcome = {}
+        yielded = False
+        elements = _stream_attempt(args, args_str, cwd, env, encoding, chunk_size, debuglog,
+                                   policy.timeout, _hedge_after(policy, kind), outcome)
+        try:
+            async for element in elements:
+                yielded = True
+                yield element
+        finally:
+            await elements.aclose()
+
+        res = outcome["res"]
+        if outcome["timed_out"]:
+            stats.count("timeouts")
+        stats.record(kind, loop.time() - started, res.returncode == 0)
+
+        if yielded or not _should_retry(res, outcome["timed_out"], attempt, attempts):
+            break
+        delay = policy.delay(attempt)
+        _log_retry(args_str, res, outcome["timed_out"], delay)
+        await asyncio.sleep(delay)
+
+    stats.record_invocation(args, loop.time() - invocation_started, res.returncode,
+                            outcome["stdout_bytes"], _output_size(res.stderr, encoding),
+                            retries=attempt)
+    _finalize(res, args_str, check, True, encoding, False)
+    if res.returncode == 0:
+        outcome["decoder"].close()
@@ -0,0 +1,195 @@
+from collections import defaultdict, namedtuple
+import re
+import threading
+
+
+_RE_PROJECT_URL = re.compile(r"/projects/([^/?]+)")
+
+
+def command_kind(args):
+    """Groups commands by what they do, regardless of their options
+       (i.e. "gcloud compute instances list" for all projects)"""
+    return " ".join(arg for arg in args if not arg.startswith("-"))
+
+
+def command_project(args):
+    """The project a command (or API call URL) is about, or None"""
+    for i, arg in enumerate(args):
+        if arg.startswith("--project="):
+            return arg[len("--project="):]
+        if arg == "--project" and i + 1 < len(args):
+            return args[i + 1]
+        match = _RE_PROJECT_URL.search(arg) if "://" in arg else None
+        if match:
+            return match[1]
+    return None
+
+
+def percentile(values, p):
+    """Nearest-rank percentile P (0-100) of VALUES, or None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))  # ceil
+    return ordered[int(rank) - 1]
+
+
+class Invocation(namedtuple("Invocation", ["args", "duration", "returncode", "stdout_bytes",
+                                           "stderr_bytes", "retries"])):
+    """A command (or API call) as a whole: DURATION (seconds) includes its RETRIES"""
+    @property
+    def kind(self):
+        return command_kind(self.args)
+
+    @property
+    def project(self):
+        return command_project(self.args)
+
+
+def _latency_columns(durations):
+    return [f"{sum(durations):.2f}s", f"{percentile(durations, 50):.2f}s",
+            f"{percentile(durations, 95):.2f}s", f"{max(durations):.2f}s"]
+
+
+def _format_table(rows):
+    """Left aligns the first column, right aligns the others"""
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return [" ".join([row[0].ljust(widths[0])] +
+                     [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]).rstrip()
+            for row in rows]
+
+
+class CommandStats(object):
+    """Latencies, retries, timeouts and hedges of the commands (and API calls) run by
+       gcloud_sync_ssh. Thread-safe, as API calls are made from worker threads.
+
+       Attempts (see record) are each run of a command, including retries and hedges, while
+       invocations (see record_invocation) are commands as a whole. summary() is about
+       attempts, report() and to_dict() are about invocations."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies = defaultdict(list)  # kind => successful call durations
+            self.failures = 0
+            self.retries = 0
+            self.timeouts = 0
+            self.hedges = 0
+            self.hedge_wins = 0
+            self.invocations = []
+
+    def record_invocation(self, args, duration, returncode, stdout_bytes=0, stderr_bytes=0,
+                          retries=0):
+        """Records a command as a whole, once it's done retrying (see Invocation)"""
+        invocation = Invocation(list(args), duration, returncode, stdout_bytes, stderr_bytes,
+                                retries)
+        with self._lock:
+            self.invocations.append(invocation)
+
+    def record(self, kind, duration, success=True):
+        """Records an attempt at running a KIND command"""
+        with self._lock:
+            if success:
+                self.latencies[kind].append(duration)
+            else:
+                self.failures += 1
+
+    def count(self, counter):
+        """Increments COUNTER: "retries", "timeouts", "hedges" or "hedge_wins" """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def latency_percentile(self, kind, p, min_samples=5):
+        """Percentile P of successful KIND latencies, or None without enough samples"""
+        with self._lock:
+            latencies = list(self.latencies.get(kind, []))
+        return percentile(latencies, p) if len(latencies) >= min_samples else None
+
+    @property
+    def attempts(self):
+        return sum(len(v) for v in self.latencies.values()) + self.failures
+
+    def summary(self):
+        """A one line summary, for logs"""
+        with self._lock:
+            latencies = [d for durations in self.latencies.values() for d in durations]
+            counters = f"{self.failures} failed, {self.retries} retried, " \
+                f"{self.timeouts} timed out, {self.hedges} hedged ({self.hedge_wins} won)"
+        attempts = len(latencies) + self.failures
+        if not latencies:
+            return f"gcloud call attempts: {attempts}, {counters}"
+        return f"gcloud call attempts: {attempts}, {counters} ; latency " \
+            f"p50 {percentile(latencies, 50):.2f}s, p95 {percentile(latencies, 95):.2f}s, " \
+            f"max {max(latencies):.2f}s"
+
+    def slowest_projects(self, top=5):
+        """The TOP projects that took the longest to deal with, as (project, seconds,
+           invocations) tuples"""
+        with self._lock:
+            invocations = list(self.invocations)
+        durations, counts = defaultdict(float), defaultdict(int)
+        for invocation in invocations:
+            if invocation.project:
+                durations[invocation.project] += invocation.duration
+                counts[invocation.project] += 1
+        slowest = sorted(durations.items(), key=lambda item: item[1], reverse=True)[:top]
+        return [(project, duration, counts[project]) for project, duration in slowest]
+
+    def report(self, top=5):
+        """Invocations aggregated by kind of command, followed by the TOP slowest projects,
+           as lines of text"""
+        with self._lock:
+            invocations = list(self.invocations)
+        if not invocations:
+            return ["No gcloud calls"]
+
+        by_kind = defaultdict(list)
+        for invocation in invocations:
+            by_kind[invocation.kind].append(invocation)
+        rows = [["command", "invocations", "failed", "retries", "total", "p50", "p95", "max",
+                 "received"]]
+        for kind, group in sorted(by_kind.items()) + [("all", invocations)]:
+            rows.append([kind, str(len(group)),
+                         str(sum(1 for i in group if i.returncode != 0)),
+                         str(sum(i.retries for i in group))] +
+                        _latency_columns([i.duration for i in group]) +
+                        [f"{sum(i.stdout_bytes for i in group)}B"])
+        lines = _format_table(rows)
+
+        slowest = self.slowest_projects(top)
+        if slowest:
+            lines.append("")
+            lines += _format_table([["slowest projects", "total", "invocations"]] +
+                                   [[project, f"{duration:.2f}s", str(count)]
+                                    for project, duration, count in slowest])
+        return lines
+
+    def to_dict(self, top=5):
+        """Summary of invocations and attempts, and invocations, for JSON exports"""
+        with self._lock:
+            invocations = list(self.invocations)
+            attempts = {counter: getattr(self, counter)
+                        for counter in ["failures", "retries", "timeouts", "hedges",
+                                        "hedge_wins"]}
+            attempts["count"] = sum(len(v) for v in self.latencies.values()) + self.failures
+        durations = [i.duration for i in invocations]
+        return {
+            "invocation_count": len(invocations),
+            "attempts": attempts,
+            "latency": {"total": sum(durations), "p50": percentile(durations, 50),
+                        "p95": percentile(durations, 95),
+                        "max": max(durations) if durations else None},
+            "stdout_bytes": sum(i.stdout_bytes for i in invocations),
+            "stderr_bytes": sum(i.stderr_bytes for i in invocations),
+            "slowest_projects": [{"project": project, "duration": duration,
+                                  "invocations": count}
+                                 for project, duration, count in self.slowest_projects(top)],
+            "invocations": [dict(i._asdict(), kind=i.kind, project=i.project)
+                            for i in invocations],
+        }
+
+
+# Stats of this process
+stats = CommandStats()
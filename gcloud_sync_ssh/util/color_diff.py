@@ -175,14 +175,33 @@ def terminal_width():
     return 80
 
 
-def pretty_diff(a, b, cols=None, fromdesc='', todesc='', context_lines=3):
+def _separated(diffs):
+    """Yields DIFFS, starting with a separator when they don't already"""
+    first = next(diffs, None)
+    if first is None:
+        return
+    if first[2] is not None:
+        yield None, None, None
+    yield first
+    yield from diffs
+
+
+def pretty_diff(a, b, cols=None, fromdesc='', todesc='', context_lines=3, line_offset=0):
+    """Side by side diff of lines A and B. Line numbers are shifted by LINE_OFFSET, for when
+       A and B are excerpts: they must then hold at least CONTEXT_LINES lines before their
+       first difference, and the diff is the same as the one of whole files."""
     cols = terminal_width() if not cols else cols
     half_col = (cols // 2) - 3 - 7  # 3 because of center ' | ', 7 because of line numbers
 
     a = [line.rstrip('\n') for line in a]
     b = [line.rstrip('\n') for line in b]
-    table = _make_table(fromdesc, todesc, difflib._mdiff(a, b, context_lines))
+    diffs = difflib._mdiff(a, b, context_lines)
+    if line_offset:
+        diffs = _separated(diffs)  # Lines before the excerpts were left out
+    table = _make_table(fromdesc, todesc, diffs)
 
     for linenum, left, right in table:
+        if isinstance(linenum, int):
+            linenum += line_offset
         text = _colorize(f"{_rpad(left, half_col)} | {_rpad(right, half_col)}")
         yield _add_line_numbers(linenum, text)
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import time
+
+from loguru import logger
+
+
+def cache_dir():
+    """Returns the directory where gcloud_sync_ssh persists cached data.
+
+       That is $GCSS_CACHE_DIR if set, $XDG_CACHE_HOME/gcloud_sync_ssh otherwise,
+       defaulting to ~/.cache/gcloud_sync_ssh."""
+    path = os.getenv("GCSS_CACHE_DIR")
+    if not path:
+        xdg_cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        path = os.path.join(xdg_cache_home, "gcloud_sync_ssh")
+    return path
+
+
+def atomic_write(path, data):
+    """Writes string DATA to PATH atomically: readers see either the old or the new contents,
+       never a partially written file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="UTF-8") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _is_entry(entry):
+    """Tells whether ENTRY looks like what JSONFileCache.set stores"""
+    return isinstance(entry, dict) and "value" in entry and \
+        isinstance(entry.get("timestamp"), (int, float))
+
+
+class JSONFileCache(object):
+    """A key => JSON value cache persisted in a single JSON file.
+
+       Entries are timestamped so they can be expired. The file is rewritten atomically
+       on every update. An unreadable file is treated as an empty cache, and malformed
+       entries as missing ones."""
+    def __init__(self, filename):
+        self.path = os.path.join(cache_dir(), filename)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="UTF-8") as fh:
+                data = json.load(fh)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning(f"Ignoring corrupted cache file {self.path}")
+            return {}
+
+    def get(self, key, ttl):
+        """Returns the value cached for KEY if it is less than TTL seconds old, else None"""
+        entry = self._load().get(key)
+        if not _is_entry(entry) or time.time() - entry["timestamp"] >= ttl:
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        """Caches VALUE for KEY"""
+        data = self._load()
+        data[key] = {"timestamp": time.time(), "value": value}
+        atomic_write(self.path, json.dumps(data))
+
+    def delete(self, key):
+        data = self._load()
+        if data.pop(key, None) is not None:
+            atomic_write(self.path, json.dumps(data))
@@ -38,3 +38,62 @@ def has_pattern(str_or_strlist):
        False otherwise."""
     strlist = [str_or_strlist] if isinstance(str_or_strlist, str) else str_or_strlist
     return len([s for s in strlist if looks_like_pattern(s)]) > 0
+
+
+# Characters that mean the same thing in a glob and in a regular expression, and that don't
+# need quoting in gcloud/API filter expressions. Instance names only use a subset of them.
+_PLAIN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+
+
+def glob_to_regex(glob):
+    """Translates fnmatch style GLOB into an equivalent, unanchored RE2 regular expression.
+
+       Only globs made of plain characters (letters, digits, '_' and '-'), '*', '?' and
+       simple '[...]' / '[!...]' sets are translated. Returns None for anything else."""
+    result = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        i += 1
+        if c == "*":
+            result.append(".*")
+        elif c == "?":
+            result.append(".")
+        elif c == "[":
+            end = glob.find("]", i)
+            if end == -1:
+                return None  # fnmatch treats this '[' as a literal
+            chars = glob[i:end]
+            negated = chars.startswith("!")
+            if negated:
+                chars = chars[1:]
+            if not chars or not _PLAIN_CHARS.issuperset(chars):
+                return None
+            result.append(f"[{'^' if negated else ''}{chars}]")
+            i = end + 1
+        elif c in _PLAIN_CHARS:
+            result.append(c)
+        else:
+            return None
+    return "".join(result)
+
+
+def globs_to_regex(globs):
+    """Translates fnmatch style GLOBS into a single anchored RE2 regular expression that
+       matches exactly when matches_any would.
+
+       Returns None when there are no GLOBS (everything matches), when one of them can't
+       be translated by glob_to_regex, or when the result is not a valid regular expression
+       (i.e. with a '[z-a]' range)."""
+    if not globs:
+        return None
+
+    regexes = [glob_to_regex(glob) for glob in globs]
+    if None in regexes:
+        return None
+    regex = f"^(?:{'|'.join(regexes)})$"
+    try:
+        re.compile(regex)
+    except re.error:
+        return None
+    return regex
@@ -0,0 +1,66 @@
+import json
+
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_END = _WHITESPACE + ",]"
+
+
+class JSONArrayStreamDecoder(object):
+    """Incrementally decodes a top-level JSON array, one element at a time.
+
+       Feed it text as it arrives, and it returns the elements that are complete so far.
+       Only the current, incomplete element is kept buffered."""
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"  # start => first => item => separator => ... => end
+
+    def _skip_whitespace(self):
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+            self._pos += 1
+        return self._pos < len(self._buffer)
+
+    def _expect(self, chars):
+        c = self._buffer[self._pos]
+        if c not in chars:
+            raise ValueError(f"Unexpected {c!r} in JSON array stream, expected one of {chars!r}")
+        self._pos += 1
+        return c
+
+    def feed(self, text):
+        """Feeds TEXT to the decoder and returns a list of newly decoded elements"""
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        elements = []
+
+        while self._skip_whitespace():
+            if self._state == "start":
+                self._expect("[")
+                self._state = "first"
+            elif self._state in ("first", "item"):
+                if self._state == "first" and self._buffer[self._pos] == "]":
+                    self._pos += 1
+                    self._state = "end"
+                    continue
+                try:
+                    element, end = self._decoder.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    break  # Incomplete element, wait for more text
+                if isinstance(element, (int, float)) and \
+                        (end == len(self._buffer) or self._buffer[end] not in _NUMBER_END):
+                    break  # Numbers may continue in the next chunk (i.e. "-1" then ".5")
+                elements.append(element)
+                self._pos = end
+                self._state = "separator"
+            elif self._state == "separator":
+                self._state = "item" if self._expect(",]") == "," else "end"
+            else:
+                raise ValueError("Trailing data after JSON array")
+
+        return elements
+
+    def close(self):
+        """Checks that the array was complete"""
+        if self._state != "end":
+            raise ValueError("Truncated JSON array stream")
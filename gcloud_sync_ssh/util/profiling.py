@@ -0,0 +1,49 @@
+import cProfile
+import pstats
+import sys
+import threading
+import time
+
+
+# From 3.12 on, cProfile relies on sys.monitoring: a single profiler sees every thread, and
+# no other profiler can run alongside it
+_PER_THREAD = sys.version_info < (3, 12)
+
+
+class Profiler(object):
+    """cProfile for the thread that starts it, and for threads started afterwards (i.e. API
+       requests workers). Profiles of each thread are merged when stopping.
+
+       With CPU_ONLY, functions are only attributed the CPU time of their thread, leaving
+       out time spent waiting (on subprocesses, the network, the user...)."""
+    def __init__(self, cpu_only=False):
+        self._timer = None
+        if cpu_only:
+            self._timer = getattr(time, "thread_time", time.process_time) if _PER_THREAD \
+                else time.process_time
+        self._lock = threading.Lock()
+        self._profilers = []
+
+    def _enable_new(self):
+        profiler = cProfile.Profile(self._timer) if self._timer else cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def _thread_started(self, frame, event, arg):
+        # First profiling event of a new thread: its own profiler takes over from here
+        self._enable_new()
+
+    def start(self):
+        self._enable_new()
+        if _PER_THREAD:
+            threading.setprofile(self._thread_started)
+
+    def stop(self):
+        """Stops profiling, and returns the merged profiles as a pstats.Stats"""
+        threading.setprofile(None)
+        with self._lock:
+            profilers, self._profilers = self._profilers, []
+        for profiler in profilers:
+            profiler.disable()
+        return pstats.Stats(*profilers)
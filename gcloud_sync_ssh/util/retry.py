@@ -0,0 +1,75 @@
+import random
+import re
+
+
+# stderr of failures that are worth retrying: throttling and server side errors, as reported
+# by gcloud, and network hiccups
+_RE_TRANSIENT = re.compile("|".join([
+    r"\bHTTP(?:Error)? (?:429|5\d\d)\b",
+    r"(?i:\bcode)['\"]?: ?['\"]?(?:429|5\d\d)\b",
+    r"Rate Limit Exceeded",
+    r"\b(?:rateLimitExceeded|backendError|internalError)\b",
+    r"\b(?:UNAVAILABLE|DEADLINE_EXCEEDED)\b",
+    r"(?i:connection (?:reset|aborted|refused))",
+    r"(?i:\b(?:read|write|connect)(?: operation)? timed out)",
+    r"Temporary failure in name resolution",
+]))
+
+# HTTP statuses of failures that are worth retrying
+TRANSIENT_HTTP_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_transient(returncode, stderr, timed_out=False):
+    """Tells whether a failed command is worth retrying, based on its exit code and stderr.
+
+       Commands we killed on timeout (TIMED_OUT) are transient failures. Commands killed by
+       other signals (i.e. SIGINT, on Ctrl-C) are not."""
+    if returncode == 0:
+        return False
+    if timed_out:
+        return True
+    return bool(stderr and _RE_TRANSIENT.search(stderr))
+
+
+class RetryPolicy(object):
+    """How read-only commands are run: TIMEOUT (seconds) after which they are killed, amount
+       of RETRIES of transient failures, and exponential BACKOFF (seconds) between them.
+
+       With HEDGE_PERCENTILE, a second identical command is started when the first one
+       takes longer than that percentile of previous latencies of the same command. The
+       first to complete wins."""
+    def __init__(self, timeout=None, retries=0, backoff=0.5, max_backoff=10.0,
+                 hedge_percentile=None):
+        assert retries >= 0
+        assert hedge_percentile is None or 0 < hedge_percentile < 100
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+
+    def delay(self, attempt):
+        """Seconds to wait before retrying after failed attempt #ATTEMPT (starting at 0).
+
+           Exponential backoff with "full jitter", so that concurrent retries spread out."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def __repr__(self):
+        return f"RetryPolicy(timeout={self.timeout}, retries={self.retries}, " \
+            f"backoff={self.backoff}, max_backoff={self.max_backoff}, " \
+            f"hedge_percentile={self.hedge_percentile})"
+
+
+_policy = RetryPolicy()
+
+
+def get_retry_policy():
+    return _policy
+
+
+def set_retry_policy(policy):
+    """Sets the RetryPolicy used from now on. Returns the previous one."""
+    global _policy
+    assert isinstance(policy, RetryPolicy)
+    previous, _policy = _policy, policy
+    return previous
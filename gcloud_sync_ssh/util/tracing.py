@@ -0,0 +1,94 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+import weakref
+
+from .aio import current_task
+
+
+class Tracer(object):
+    """Records spans as Chrome trace events ("complete" events, see the Trace Event Format
+       specification). Traces can be viewed with Perfetto (ui.perfetto.dev) or in
+       chrome://tracing.
+
+       Each asyncio task gets its own (synthetic) thread id, so that spans of concurrent
+       tasks show up on separate tracks. Code running outside of tasks is attributed to its
+       thread."""
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._task_tids = weakref.WeakKeyDictionary()
+        self._thread_tids = {}
+        self._next_tid = 0
+        self.events = []
+
+    def _new_tid(self, name):
+        tid = self._next_tid
+        self._next_tid += 1
+        self.events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                            "args": {"name": name}})
+        return tid
+
+    def _tid(self):
+        task = current_task()
+        if task is not None:
+            if task not in self._task_tids:
+                self._task_tids[task] = self._new_tid(f"task {self._next_tid}")
+            return self._task_tids[task]
+
+        thread = threading.current_thread()
+        if thread.ident not in self._thread_tids:
+            self._thread_tids[thread.ident] = self._new_tid(thread.name)
+        return self._thread_tids[thread.ident]
+
+    def _us(self, timestamp):
+        return round((timestamp - self._origin) * 1e6, 1)
+
+    def complete(self, name, cat, start, end, args):
+        """Records a span that lasted from START to END (time.perf_counter timestamps)"""
+        with self._lock:
+            self.events.append({"name": name, "cat": cat, "ph": "X", "pid": self._pid,
+                                "tid": self._tid(), "ts": self._us(start),
+                                "dur": self._us(end) - self._us(start), "args": args})
+
+    def save(self, path):
+        with self._lock:
+            data = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(os.path.expanduser(path), "w") as fh:
+            json.dump(data, fh)
+
+
+_tracer = None
+
+
+def enable():
+    """Starts recording spans, and returns the Tracer that records them"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    """Stops recording spans, and returns the Tracer that recorded them (if any)"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextmanager
+def span(name, cat="phase", **args):
+    """Records the execution of the with block as a span, when tracing is enabled.
+       ARGS are attached to the span."""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.complete(name, cat, start, time.perf_counter(), args)
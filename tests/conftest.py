@@ -1,13 +1,22 @@
 import contextlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 import logging
 import os
+import re
 import shutil
+from socketserver import ThreadingMixIn
+import threading
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlsplit
 
 import pytest
 from _pytest.logging import caplog as _caplog  # noqa:F401
 from loguru import logger
 
 from json_dict import JsonDict
+from gcloud_sync_ssh.backends import FakeBackend, set_backend
+from gcloud_sync_ssh.util.cmd import clear_memo
 
 
 # Loguru/Pytest caplog replacement fixture
@@ -22,6 +31,14 @@ def caplog(_caplog):  # noqa:F811
     logger.remove(handler_id)
 
 
+# Memoized read-only commands must not leak from one test to the other
+@pytest.fixture(autouse=True)
+def _clear_cmd_memo():
+    clear_memo()
+    yield
+    clear_memo()
+
+
 DB_NAMES = {"cmd_log", "config", "instances", "projects"}
 
 
@@ -65,9 +82,12 @@ class StubbedGCloudContext:
     # XXX is there a way to create a tmpfs for this (/tmp may or may not be a tmpfs in practice)
     def __init__(self, tmp_path):
         self._saved_db_path = None
+        self._saved_cache_dir = None
+        self._saved_gcloud_config = None
         self._saved_path = None
         self.tmp_path = tmp_path
         self._db_path = tmp_path.joinpath("db")
+        self.gcloud_config_dir = tmp_path.joinpath("gcloud_config")
 
     def __enter__(self):
         # XXX this now could be implemented using a cascade of a couple of env_override contexts
@@ -76,6 +96,14 @@ class StubbedGCloudContext:
         self._saved_db_path = os.getenv("GCLOUD_DB_PATH", "")
         os.environ["GCLOUD_DB_PATH"] = str(self._db_path)
 
+        # Keep our own caches away from the user's
+        self._saved_cache_dir = os.getenv("GCSS_CACHE_DIR", "")
+        os.environ["GCSS_CACHE_DIR"] = str(self.tmp_path.joinpath("cache"))
+
+        # Keep the user's gcloud configuration files out of reach too (see gcloud_config_read)
+        self._saved_gcloud_config = os.getenv("CLOUDSDK_CONFIG", "")
+        os.environ["CLOUDSDK_CONFIG"] = str(self.gcloud_config_dir)
+
         # Setup PATH
         self._saved_path = os.getenv('PATH', "")
         here_path = os.path.dirname(__file__)
@@ -89,6 +117,8 @@ class StubbedGCloudContext:
         # Restore saved values
         os.environ['PATH'] = self._saved_path
         os.environ['GCLOUD_DB_PATH'] = self._saved_db_path
+        os.environ['GCSS_CACHE_DIR'] = self._saved_cache_dir
+        os.environ['CLOUDSDK_CONFIG'] = self._saved_gcloud_config
         logger.trace(f"SGCC[{id(self)}].__exit__")
 
     def _db_json_path(self, tablename):
@@ -102,6 +132,14 @@ class StubbedGCloudContext:
         return os.path.dirname(os.path.abspath(__file__)) + \
             f"/configfiles/{basename}"
 
+    def write_gcloud_configuration(self, name, contents, activate=True):
+        """Writes a gcloud configuration file (INI contents), optionally making it active"""
+        configurations_dir = self.gcloud_config_dir.joinpath("configurations")
+        configurations_dir.mkdir(parents=True, exist_ok=True)
+        configurations_dir.joinpath(f"config_{name}").write_text(contents)
+        if activate:
+            self.gcloud_config_dir.joinpath("active_config").write_text(name)
+
     def db(self, tablename):
         """Return a JsonDict for a specific 'tablename' i.e. a single json file."""
         assert tablename in DB_NAMES
@@ -131,3 +169,197 @@ class StubbedGCloudContext:
 def stubbed_gcloud_ctx(tmp_path):
     with StubbedGCloudContext(tmp_path) as ctx:
         yield ctx
+
+
+# In-process counterpart of the stubbed gcloud setup/teardown
+# (Prefer usage as a fixture)
+@pytest.helpers.register
+class FakedGCloudContext(StubbedGCloudContext):
+    """
+    Same as StubbedGCloudContext, except that stub files are served in-process by a
+    FakeBackend (self.backend), which the CLI uses as well. The config, instances and
+    projects "tables" are those of the backend.
+
+    Our stubbed gcloud is still on PATH: anything that runs it shows up in cmd_log.
+
+    Prefer the faked_gcloud_ctx fixture to using this as is.
+    """
+    def __init__(self, tmp_path):
+        super().__init__(tmp_path)
+        self.backend = FakeBackend()
+
+    def __enter__(self):
+        super().__enter__()
+        self._previous_backend = set_backend(self.backend)
+        self._cli_backend = patch("gcloud_sync_ssh.cli._prepare_backend",
+                                  lambda backend_name, jobs: self.backend)
+        self._cli_backend.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cli_backend.stop()
+        set_backend(self._previous_backend)
+        super().__exit__(exc_type, exc_value, traceback)
+
+    @contextlib.contextmanager
+    def _table(self, tablename):
+        yield getattr(self.backend, tablename)
+
+    def db(self, tablename):
+        if tablename == "cmd_log":
+            return super().db(tablename)
+        assert tablename in DB_NAMES
+        return self._table(tablename)
+
+    def seed_db(self, tablename, seed_basename):
+        with open(self.stub_path(seed_basename), "r") as f:
+            setattr(self.backend, tablename, json.load(f))
+
+
+@pytest.fixture
+def faked_gcloud_ctx(tmp_path):
+    with FakedGCloudContext(tmp_path) as ctx:
+        yield ctx
+
+
+@pytest.fixture(params=["stubbed", "faked"])
+def gcloud_ctx(request, tmp_path):
+    """Plays tests with both our stubbed gcloud (end to end) and FakeBackend"""
+    context_class = {"stubbed": StubbedGCloudContext,
+                     "faked": FakedGCloudContext}[request.param]
+    with context_class(tmp_path) as ctx:
+        yield ctx
+
+
+# Stubbed GCP REST APIs
+# (Prefer usage as a fixture)
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is 3.7+
+    daemon_threads = True
+
+
+class _StubbedAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.stub.record(self)
+        url = urlsplit(self.path)
+        token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+        if token in self.server.stub.expired_tokens:
+            status, body = 401, {"error": {"code": 401, "message": "Invalid credentials"}}
+        else:
+            status, body = self.server.stub.respond(url.path, parse_qs(url.query))
+        payload = json.dumps(body).encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.helpers.register
+class StubbedComputeAPI:
+    """
+    Context-manager running a local HTTP server that stands in for the Compute Engine and
+    Resource Manager REST APIs. It serves the same stub files as our stubbed gcloud, as
+    aggregated lists with a page size of PAGE_SIZE.
+
+    The gcloud api_endpoint_overrides properties are set (through the environment) to point
+    at it while the context is active.
+
+    Prefer the stubbed_compute_api fixture to using this as is.
+    """
+    def __init__(self, page_size=1):
+        self.page_size = page_size
+        self.instances = []
+        self.projects = []
+        self.requests = []
+        self.tokens = []  # Access token of each request
+        self.expired_tokens = set()  # Access tokens answered with 401
+        self.client_addresses = set()
+        self.errors = {}  # project => (status, message)
+        self.error_counts = {}  # project => amount of times errors[project] is returned
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _StubbedAPIHandler)
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        self._overrides = contextlib.ExitStack()
+        for prop, path in [("COMPUTE", "compute/v1"), ("CLOUDRESOURCEMANAGER", "v1")]:
+            self._overrides.enter_context(
+                env_override(f"CLOUDSDK_API_ENDPOINT_OVERRIDES_{prop}", f"{self.url}/{path}/"))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._overrides.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def seed(self, kind, seed_basename):
+        """Loads a stub file into self.instances or self.projects"""
+        path = os.path.dirname(os.path.abspath(__file__)) + f"/stubfiles/{seed_basename}.json"
+        with open(path, "r") as f:
+            setattr(self, kind, json.load(f))
+
+    def record(self, handler):
+        with self._lock:
+            self.requests.append(handler.path)
+            self.tokens.append(handler.headers.get("Authorization", "").replace("Bearer ", "", 1))
+            self.client_addresses.add(handler.client_address)
+
+    def _page(self, items, query):
+        start = int(query.get("pageToken", ["0"])[0])
+        end = start + self.page_size
+        next_page_token = str(end) if end < len(items) else None
+        return items[start:end], next_page_token
+
+    def respond(self, path, query):
+        parts = path.strip("/").split("/")
+        if parts[-2:] == ["aggregated", "instances"]:
+            project = parts[-3]
+            if project in self.errors and self.error_counts.get(project, 1) > 0:
+                if project in self.error_counts:
+                    self.error_counts[project] -= 1
+                status, message = self.errors[project]
+                return status, {"error": {"code": status, "message": message}}
+            # Same rough selection as our stubbed gcloud
+            selected_instances = [i for i in self.instances if project in i["zone"]]
+            if "filter" in query:
+                # Only name eq '<regex>' filters are supported
+                filter_match = re.match(r"^name eq '(.*)'$", query["filter"][0])
+                assert filter_match
+                selected_instances = [i for i in selected_instances
+                                      if re.fullmatch(filter_match[1], i["name"])]
+            page, next_page_token = self._page(selected_instances, query)
+            items = {}
+            for instance in page:
+                zone = "zones/" + instance["zone"].rsplit("/", 1)[-1]
+                items.setdefault(zone, {"instances": []})["instances"].append(instance)
+            items.setdefault("zones/empty-zone-a", {"warning": {"code": "NO_RESULTS_ON_PAGE"}})
+            body = {"items": items}
+        elif parts[-1] == "projects":
+            page, next_page_token = self._page(self.projects, query)
+            body = {"projects": page}
+        else:
+            return 404, {"error": {"code": 404, "message": f"Not found: {path}"}}
+
+        if next_page_token:
+            body["nextPageToken"] = next_page_token
+        return 200, body
+
+
+@pytest.fixture
+def stubbed_compute_api():
+    with StubbedComputeAPI() as api:
+        yield api
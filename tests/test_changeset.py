@@ -0,0 +1,28 @@
+from gcloud_sync_ssh.changeset import Change, ChangeSet
+
+
+def test_empty():
+    changeset = ChangeSet()
+    assert not changeset
+    assert len(changeset) == 0
+    assert list(changeset) == []
+    assert changeset.summary() == "0 added, 0 updated, 0 removed"
+
+
+def test_changes():
+    changeset = ChangeSet()
+    changeset.add("a.z.p", "1.1.1.1", "1", project="p")
+    changeset.remove("b.z.p", project="p", reason="stopped")
+
+    other = ChangeSet()
+    other.update_ip("c.z.q", "3.3.3.3", project="q")
+    changeset.extend(other)
+
+    assert changeset
+    assert len(changeset) == 3
+    assert list(changeset) == [
+        ("add", Change("a.z.p", "p", "new instance", "1.1.1.1", "1")),
+        ("update", Change("c.z.q", "q", "IP changed", "3.3.3.3", None)),
+        ("remove", Change("b.z.p", "p", "stopped", None, None)),
+    ]
+    assert changeset.summary() == "1 added, 1 updated, 1 removed"
@@ -1,10 +1,15 @@
 import json
 import os
+import pstats
 import re
 
 from click.testing import CliRunner
+import pytest
 
 from gcloud_sync_ssh.cli import cli
+from gcloud_sync_ssh.inventory import InventoryStore
+from gcloud_sync_ssh.ssh_config import SSHConfig
+from gcloud_sync_ssh.util.disk_cache import JSONFileCache
 
 ###############################################################################
 #
@@ -264,44 +269,44 @@ def test_simple_run_2(caplog, stubbed_gcloud_ctx):
     assert_simple_run_I1(caplog, stubbed_gcloud_ctx, result)
 
 
-def test_simple_run_3(caplog, stubbed_gcloud_ctx):
+def test_simple_run_3(caplog, gcloud_ctx):
     # This time, using an instance list that contains instances from other project that
     # we're not selecting (this is probably redundant with some other test)
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    config_path = prep_simple_ctx(gcloud_ctx, instances="instances_2")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive"])
-    assert_simple_run_I1(caplog, stubbed_gcloud_ctx, result)
+    assert_simple_run_I1(caplog, gcloud_ctx, result)
 
 
-def test_simple_run_4(caplog, stubbed_gcloud_ctx):
+def test_simple_run_4(caplog, gcloud_ctx):
     # Cover the "no diff" case by doing the simple_run twice
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    config_path = prep_simple_ctx(gcloud_ctx)
     CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive"])  # discarded
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive"])
     assert result.exit_code == 0
     assert "No changes to SSH config" in caplog.messages
 
 
-def test_simple_run_5(caplog, stubbed_gcloud_ctx):
+def test_simple_run_5(caplog, gcloud_ctx):
     # Cover the "no backup case"
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    config_path = prep_simple_ctx(gcloud_ctx)
     CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive", "--no-backup"])
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive"])
     assert result.exit_code == 0
     assert len([line for line in caplog.messages if "config backed up" in line]) == 0
 
 
-def test_interactive_run_1(caplog, stubbed_gcloud_ctx):
+def test_interactive_run_1(caplog, gcloud_ctx):
     """Single project - empty configuration passed - interactive"""
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    config_path = prep_simple_ctx(gcloud_ctx)
     result = CliRunner().invoke(cli, ["--ssh-config", config_path], input="yes")
-    assert_simple_run_I1(caplog, stubbed_gcloud_ctx, result)
+    assert_simple_run_I1(caplog, gcloud_ctx, result)
     assert "proposed changes as a diff" in result.output
     assert "Save changes?" in result.output
 
 
-def test_interactive_run_2(caplog, stubbed_gcloud_ctx):
+def test_interactive_run_2(caplog, gcloud_ctx):
     """Single project - empty configuration passed - interactive"""
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    config_path = prep_simple_ctx(gcloud_ctx)
     result = CliRunner().invoke(cli, ["--ssh-config", config_path], input="no")
     assert result.exit_code == 0
     assert "proposed changes as a diff" in result.output
@@ -309,30 +314,30 @@ def test_interactive_run_2(caplog, stubbed_gcloud_ctx):
     assert "did not confirm changes. Exiting." in result.output
 
 
-def test_multiproject_run_1(caplog, stubbed_gcloud_ctx):
+def test_multiproject_run_1(caplog, gcloud_ctx):
     # Using pattern
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    config_path = prep_simple_ctx(gcloud_ctx, instances="instances_2")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-*"])
-    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+    assert_simple_run_I2(caplog, gcloud_ctx, result)
 
 
-def test_multiproject_run_2(caplog, stubbed_gcloud_ctx):
+def test_multiproject_run_2(caplog, gcloud_ctx):
     # Using --all-projects
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    config_path = prep_simple_ctx(gcloud_ctx, instances="instances_2")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--all-projects"])
-    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+    assert_simple_run_I2(caplog, gcloud_ctx, result)
 
 
-def test_removal_run_1(caplog, stubbed_gcloud_ctx):
+def test_removal_run_1(caplog, gcloud_ctx):
     # In this test we swap 'status' instances 1 and 2
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx,
+    config_path = prep_simple_ctx(gcloud_ctx,
                                   instances="instances_3", sshconfig="exhibit_5")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-1"])
     assert result.exit_code == 0
-    with stubbed_gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
+    with gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
         conflines = f.readlines()
         assert len([line for line in conflines if "stubbed_instance_1" in line]) == 0
         assert len([line for line in conflines if "127.127.127.3" in line]) == 0
@@ -340,15 +345,15 @@ def test_removal_run_1(caplog, stubbed_gcloud_ctx):
         assert len([line for line in conflines if "stubbed_instance_2" in line]) == 0
 
 
-def test_removal_run_2(caplog, stubbed_gcloud_ctx):
+def test_removal_run_2(caplog, gcloud_ctx):
     # Similar to removal_run_1, we swap 'status' instances 1 and 2
     # But this time we cover the "--no-remove-stopped" flag
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx,
+    config_path = prep_simple_ctx(gcloud_ctx,
                                   instances="instances_3", sshconfig="exhibit_5")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-1", "--no-remove-stopped"])
     assert result.exit_code == 0
-    with stubbed_gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
+    with gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
         conflines = f.readlines()
         assert len([line for line in conflines if "stubbed_instance_1" in line]) == 1
         assert len([line for line in conflines if "127.127.127.3" in line]) == 1
@@ -356,37 +361,37 @@ def test_removal_run_2(caplog, stubbed_gcloud_ctx):
         assert len([line for line in conflines if "stubbed_instance_2" in line]) == 0
 
 
-def test_removal_run_3(caplog, stubbed_gcloud_ctx):
+def test_removal_run_3(caplog, gcloud_ctx):
     # Similar to removal_run_1, but this time we setup the stubs to remove deleted instances
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx,
+    config_path = prep_simple_ctx(gcloud_ctx,
                                   instances="instances_0", sshconfig="exhibit_5")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-1"])
     assert result.exit_code == 0
-    with stubbed_gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
+    with gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
         conflines = f.readlines()
         assert len(conflines) == 3  # i.e. we removed the instance
 
 
-def test_removal_run_4(caplog, stubbed_gcloud_ctx):
+def test_removal_run_4(caplog, gcloud_ctx):
     # Similar to removal_run_1, but this time we setup the stubs to remove deleted instances
     # And with the flag to _not_ remove it
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx,
+    config_path = prep_simple_ctx(gcloud_ctx,
                                   instances="instances_0", sshconfig="exhibit_5")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-1",
                                       "--no-remove-vanished"])
     assert result.exit_code == 0
-    with stubbed_gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
+    with gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
         conflines = f.readlines()
         assert len([line for line in conflines if "stubbed_instance_1" in line]) == 1
 
 
-def test_noop_unreachable_1(stubbed_gcloud_ctx):
+def test_noop_unreachable_1(gcloud_ctx):
     # I don't have machines set up this way but I suspect this may happen in the wild
     # (for instance, if you have some sort of jumpbox setup).
     # GCSS could help you in that case - but won't right now.
-    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_4")
+    config_path = prep_simple_ctx(gcloud_ctx, instances="instances_4")
     result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
                                       "--project", "stub-project-1"])
     assert result.exit_code == 0
@@ -434,3 +439,360 @@ def test_auth_2(caplog, stubbed_gcloud_ctx):
     # Assert that we restored the initially set account
     with stubbed_gcloud_ctx.db("config") as db:
         assert db['account'] == 'test-before@gmail.com'
+
+
+def _assert_global_auth_untouched(caplog, stubbed_gcloud_ctx, account):
+    mutating_cmds = ["gcloud auth login", "gcloud auth activate", "gcloud config set"]
+    assert not [m for m in caplog.messages
+                if any(m.startswith(f"cmd: {c}") for c in mutating_cmds)]
+    with stubbed_gcloud_ctx.db("config") as db:
+        assert db['account'] == account
+
+
+def test_isolated_auth_1(caplog, stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com"})
+    stubbed_gcloud_ctx.seed_db("projects", "projects_1")
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--login", "test-b@gmail.com",
+                                      "--isolated-auth", "--projects-ttl", "60"])
+    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+    _assert_global_auth_untouched(caplog, stubbed_gcloud_ctx, "test-a@gmail.com")
+
+    # gcloud saw the account we asked for
+    assert JSONFileCache("projects.json").get("test-b@gmail.com", 60)
+
+
+def test_isolated_auth_2(caplog, stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-before@gmail.com"})
+    stubbed_gcloud_ctx.seed_db("projects", "projects_1")
+
+    sa_email = "dummy-sa@dummy-proj.iam.gserviceaccount.com"
+    with stubbed_gcloud_ctx.tmpfile("credentials.json") as f:
+        sa_path = f.name
+        f.write(json.dumps({"client_email": sa_email}))
+        f.flush()
+
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--service-account", sa_path,
+                                      "--isolated-auth", "--projects-ttl", "60"])
+    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+    _assert_global_auth_untouched(caplog, stubbed_gcloud_ctx, "test-before@gmail.com")
+    assert JSONFileCache("projects.json").get(sa_email, 60)
+
+
+def prep_accounts_ctx(stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"accounts": ["test-a@gmail.com", "test-b@gmail.com", "test-c@gmail.com"],
+                   "account": "test-a@gmail.com",
+                   "project_access": {
+                       "test-a@gmail.com": ["stub-project-1"],
+                       "test-b@gmail.com": ["stub-project-1", "stub-project-2"],
+                       "test-c@gmail.com": ["stub-project-2", "stub-project-3"]}})
+    return prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+
+
+def _backend_calls(faked_gcloud_ctx, method):
+    return [args for call, args in faked_gcloud_ctx.backend.calls if call == method]
+
+
+def test_all_accounts_run(caplog, faked_gcloud_ctx, raise_on_gcloud_instance_sync):
+    config_path = prep_accounts_ctx(faked_gcloud_ctx)
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-accounts"])
+    assert_simple_run_I2(caplog, faked_gcloud_ctx, result)
+    assert "Enumerating GCP projects reachable with 3 accounts" in caplog.messages
+    _assert_global_auth_untouched(caplog, faked_gcloud_ctx, "test-a@gmail.com")
+
+    # Each project was listed once (with an account that can reach it)
+    assert len(_backend_calls(faked_gcloud_ctx, "list_projects")) == 3
+    assert len(_backend_calls(faked_gcloud_ctx, "iter_instances")) == 3
+
+
+def test_accounts_run(caplog, stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
+    config_path = prep_accounts_ctx(stubbed_gcloud_ctx)
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "-a", "test-a@gmail.com", "-a", "test-c@gmail.com",
+                                      "-p", "stub-project-[12]"])
+    assert result.exit_code == 0
+    assert "Beginning instance enumeration in 2 projects" in caplog.messages
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert "gcloud --project=stub-project-3 --quiet compute instances list" \
+            not in " ".join(db.values())
+
+
+def test_accounts_invalid_invocation(caplog, stubbed_gcloud_ctx):
+    result = CliRunner().invoke(cli, ["-a", "x", "--all-accounts"])
+    assert result.exit_code == 1
+    result = CliRunner().invoke(cli, ["-A", "--login", "x"])
+    assert result.exit_code == 1
+
+
+def test_transient_failure_run(caplog, stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"transient_failures": {"stub-project-1": 1}})
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive"])
+    assert_simple_run_I1(caplog, stubbed_gcloud_ctx, result)
+    assert [m for m in caplog.messages
+            if m.startswith("gcloud call attempts: 3, 1 failed, 1 retried")]
+
+
+def test_transient_failure_no_retries(caplog, stubbed_gcloud_ctx):
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"transient_failures": {"stub-project-1": 1}})
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--gcloud-retries", "0"])
+    assert result.exit_code == 0
+    assert "503 Service Unavailable" in caplog.text
+    assert "No changes to SSH config" in caplog.messages
+
+
+def test_unreachable_projects_run(caplog, faked_gcloud_ctx):
+    config_path = prep_simple_ctx(faked_gcloud_ctx, instances="instances_2")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com", "disabled_apis": ["stub-project-3"]})
+    ttl = ["--unreachable-ttl", "86400"]
+    for args in [ttl, ttl, ttl + ["--reprobe-projects"], []]:
+        result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                          "--all-projects"] + args)
+        assert result.exit_code == 0
+
+    assert len([args for args in _backend_calls(faked_gcloud_ctx, "iter_instances")
+                if args[0] == "stub-project-3"]) == 3
+    skipped = [r for r in caplog.records if r.message == "Skipping project stub-project-3: "
+               "api-disabled (cached, see --reprobe-projects)"]
+    assert [r.levelname for r in skipped] == ["WARNING"]
+
+
+def test_unreachable_projects_keep_hosts(caplog, faked_gcloud_ctx):
+    # Hosts of projects that can't be listed are neither removed, nor forgotten by the
+    # inventory
+    host = "stubbed_instance_3.us-central1-b.stub-project-2"
+    config_path = prep_simple_ctx(faked_gcloud_ctx, instances="instances_2")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com"})
+    args = ["--ssh-config", config_path, "--not-interactive", "--no-backup", "--all-projects",
+            "--unreachable-ttl", "86400"]
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"disabled_apis": ["stub-project-2"]})
+    for _ in range(2):  # Failing, then skipped
+        assert CliRunner().invoke(cli, args).exit_code == 0
+        assert host in SSHConfig(config_path)
+    assert "Skipping project stub-project-2: api-disabled " \
+        "(cached, see --reprobe-projects)" in caplog.messages
+
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"disabled_apis": []})
+    caplog.clear()
+    assert CliRunner().invoke(cli, args + ["--reprobe-projects"]).exit_code == 0
+    assert "No changes to SSH config" in caplog.messages
+    assert not [m for m in caplog.messages if "stub-project-2] Since last run" in m]
+
+
+def test_transient_failure_keeps_hosts(caplog, stubbed_gcloud_ctx):
+    # A listing that fails, even transiently, doesn't tell instances are gone
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    args = ["--ssh-config", config_path, "--not-interactive", "--no-backup",
+            "--gcloud-retries", "0"]
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    hosts = list(SSHConfig(config_path).hosts_of_project("stub-project-1"))
+    assert hosts
+
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"transient_failures": {"stub-project-1": 1}})
+    caplog.clear()
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    assert "[stub-project-1] Instances unknown, leaving its hosts as they are" \
+        in caplog.messages
+    assert "No changes to SSH config" in caplog.messages
+    assert list(SSHConfig(config_path).hosts_of_project("stub-project-1")) == hosts
+
+
+def test_timeout_keeps_hosts(caplog, stubbed_gcloud_ctx):
+    # A listing killed on timeout doesn't tell instances are gone either
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx)
+    args = ["--ssh-config", config_path, "--not-interactive", "--no-backup",
+            "--gcloud-timeout", "1", "--gcloud-retries", "1"]
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    hosts = list(SSHConfig(config_path).hosts_of_project("stub-project-1"))
+    assert hosts
+
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"slow_listings": {"stub-project-1": 5}})
+    caplog.clear()
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    assert len([m for m in caplog.messages if "failed (timed out), retrying" in m]) == 1
+    assert "No changes to SSH config" in caplog.messages
+    assert list(SSHConfig(config_path).hosts_of_project("stub-project-1")) == hosts
+
+
+def test_multiproject_run_jobs(caplog, faked_gcloud_ctx):
+    # Concurrent enumeration must yield the exact same config as a sequential run
+    results = {}
+    for jobs in ["1", "3"]:
+        config_path = prep_simple_ctx(faked_gcloud_ctx, instances="instances_2")
+        result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                          "--no-backup", "--all-projects", "--jobs", jobs])
+        assert result.exit_code == 0
+        with faked_gcloud_ctx.tmpfile("ssh_config", mode="rt") as f:
+            results[jobs] = f.read()
+
+    assert results["1"] == results["3"]
+    assert "127.127.127.6" in results["3"]
+
+
+def test_api_backend_run(caplog, stubbed_gcloud_ctx, stubbed_compute_api):
+    # Same as test_multiproject_run_2, through the REST API backend
+    stubbed_compute_api.seed("instances", "instances_2")
+    stubbed_compute_api.seed("projects", "projects_1")
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--backend", "api"])
+    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+
+    # gcloud was not used for listing anything
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert "gcloud auth print-access-token" in db.values()
+        assert not [c for c in db.values() if " list" in c]
+
+
+def test_api_backend_login_run(caplog, stubbed_gcloud_ctx, stubbed_compute_api):
+    # Projects are listed before logging in: instances must still be listed as the account
+    # we logged in with
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"accounts": ["test-a@gmail.com", "test-b@gmail.com"],
+                   "account": "test-a@gmail.com"})
+    stubbed_compute_api.seed("instances", "instances_2")
+    stubbed_compute_api.seed("projects", "projects_1")
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--backend", "api",
+                                      "--login", "test-b@gmail.com"])
+    assert_simple_run_I2(caplog, stubbed_gcloud_ctx, result)
+
+    tokens = {path.split("?")[0]: token
+              for path, token in zip(stubbed_compute_api.requests, stubbed_compute_api.tokens)}
+    assert [token for path, token in tokens.items() if path.endswith("/projects")] == \
+        ["stub-access-token-test-a@gmail.com"]
+    assert {token for path, token in tokens.items() if path.endswith("/instances")} == \
+        {"stub-access-token-test-b@gmail.com"}
+
+
+def test_projects_cache(caplog, faked_gcloud_ctx):
+    config_path = prep_simple_ctx(faked_gcloud_ctx, instances="instances_2")
+    for args in [["--projects-ttl", "60"], ["--projects-ttl", "60"],
+                 ["--projects-ttl", "60", "--refresh-projects"], []]:
+        result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                          "--all-projects"] + args)
+        assert result.exit_code == 0
+
+    assert len(_backend_calls(faked_gcloud_ctx, "list_projects")) == 3
+    assert "Using cached project list (3 projects)" in caplog.messages
+
+
+def test_inventory_run(caplog, faked_gcloud_ctx):
+    config_path = prep_simple_ctx(faked_gcloud_ctx)
+    args = ["--ssh-config", config_path, "--not-interactive", "--no-backup"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert "[stub-project-1] Since last run: 2 new, 0 changed, 0 gone" in caplog.messages
+
+    # Nothing changed
+    caplog.clear()
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert not [m for m in caplog.messages if "Since last run" in m]
+    assert "No changes to SSH config" in caplog.messages
+
+    # Nothing changed, but the config was edited: it is fixed nonetheless
+    with open(config_path, "r") as f:
+        contents = f.read()
+    with open(config_path, "w") as f:
+        f.write(contents.replace("127.127.127.3", "127.0.0.1"))
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    with open(config_path, "r") as f:
+        assert f.read() == contents
+
+    # The IP changes
+    caplog.clear()
+    prep_simple_ctx(faked_gcloud_ctx, instances="instances_3", sshconfig="exhibit_5")
+    result = CliRunner().invoke(cli, args + ["--project", "stub-project-1"])
+    assert result.exit_code == 0
+    assert "[stub-project-1] Since last run: 0 new, 2 changed, 0 gone" in caplog.messages
+
+
+def test_inventory_declined_run(caplog, faked_gcloud_ctx, monkeypatch):
+    closed = []
+    close = InventoryStore.close
+    monkeypatch.setattr(InventoryStore, "close", lambda self: closed.append(self) or close(self))
+
+    config_path = prep_simple_ctx(faked_gcloud_ctx)
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path], input="no")
+    assert result.exit_code == 0
+    assert "did not confirm changes. Exiting." in result.output
+    assert len(closed) == 1
+
+    # Nothing was committed: the next run still sees the instances as new
+    assert InventoryStore(config_path).load("stub-project-1") == {}
+
+
+def test_trace(caplog, stubbed_gcloud_ctx, tmp_path):
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    trace_path = tmp_path / "trace.json"
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--trace", str(trace_path)])
+    assert result.exit_code == 0
+    assert f"Trace written to {trace_path}" in caplog.messages
+
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    phases = {e["name"] for e in spans if e["cat"] == "phase"}
+    assert {"parse config", "infer template", "auth", "enumerate projects",
+            "enumerate instances", "fetch", "apply", "save"} <= phases
+    assert {e["args"]["project"] for e in spans if e["name"] == "fetch"} == \
+        {"stub-project-1", "stub-project-2", "stub-project-3"}
+    assert [e for e in spans if e["cat"] == "cmd"
+            and e["name"] == "gcloud compute instances list"]
+
+
+def test_stats(caplog, stubbed_gcloud_ctx, tmp_path):
+    config_path = prep_simple_ctx(stubbed_gcloud_ctx, instances="instances_2")
+    stats_path = tmp_path / "stats.json"
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--all-projects", "--stats", "--stats-json",
+                                      str(stats_path)])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert [line for line in lines if line.startswith("command ")]
+    assert [line for line in lines if line.startswith("gcloud compute instances list")]
+    assert [line for line in lines if line.startswith("slowest projects")]
+
+    data = json.loads(stats_path.read_text())
+    assert data["invocation_count"] == len(data["invocations"])
+    assert len([i for i in data["invocations"]
+                if i["kind"] == "gcloud compute instances list"]) == 3
+    assert {p["project"] for p in data["slowest_projects"]} == \
+        {"stub-project-1", "stub-project-2", "stub-project-3"}
+    assert data["stdout_bytes"] > 0
+
+
+@pytest.mark.parametrize("cpu_only", [[], ["--profile-cpu-only"]])
+def test_profile(caplog, faked_gcloud_ctx, tmp_path, cpu_only):
+    config_path = prep_simple_ctx(faked_gcloud_ctx)
+    profile_path = tmp_path / "run.pstats"
+    result = CliRunner().invoke(cli, ["--ssh-config", config_path, "--not-interactive",
+                                      "--profile", str(profile_path),
+                                      "--profile-top", "5"] + cpu_only)
+    assert result.exit_code == 0
+    assert f"Profile written to {profile_path}" in caplog.messages
+    assert "ncalls" in result.output
+
+    functions = {function for _, _, function in pstats.Stats(str(profile_path)).stats}
+    assert "_parse" in functions
@@ -1,7 +1,14 @@
+import asyncio
+import time
+
 import pytest
 from subprocess import CalledProcessError
 
-from gcloud_sync_ssh.util.cmd import cmd
+from gcloud_sync_ssh.util.aio import run
+from gcloud_sync_ssh.util.cmd import (acmd, acmd_stream, clear_memo, cmd,
+                                      set_concurrency_limit)
+from gcloud_sync_ssh.util.cmd_stats import command_kind, stats
+from gcloud_sync_ssh.util.retry import RetryPolicy, set_retry_policy
 
 
 def test_args_as_string():
@@ -76,3 +83,327 @@ def test_no_pipe(capfd):
     outerr = capfd.readouterr()
     assert outerr.out == "out\n"
     assert outerr.err == "err\n"
+
+
+def test_async_args_as_string():
+    r = run(acmd("echo -n 1 2 3"))
+    assert r.stdout == "1 2 3"
+    assert r.returncode == 0
+
+
+def test_async_log_errors_with_pipe(caplog):
+    with pytest.raises(CalledProcessError) as e:
+        run(acmd(["bash", "-c", "echo $((21 * 2)) >&2; exit 40"]))
+    assert len(caplog.records) == 2
+    assert "status 40" in str(e.value)
+    assert caplog.records[1].levelname == "ERROR"
+    assert "42" in caplog.records[1].message
+
+
+def test_async_no_check(caplog):
+    r = run(acmd(["bash", "-c", "exit 40"], check=False, debuglog=False))
+    assert len(caplog.records) == 0
+    assert r.returncode == 40
+
+
+def test_async_structured():
+    r = run(acmd(["bash", "-c", 'echo "{\\"json-k\\": \\"json-v\\"}"', "--"], structured=True))
+    assert r["json-k"] == "json-v"
+
+
+def test_async_concurrency_limit():
+    async def sleepers(n):
+        return await asyncio.gather(*[acmd("sleep 0.2") for _ in range(n)])
+
+    try:
+        set_concurrency_limit(2)
+        start = time.monotonic()
+        run(sleepers(4))
+        assert time.monotonic() - start >= 0.4  # Two batches of two
+
+        set_concurrency_limit(4)
+        start = time.monotonic()
+        run(sleepers(4))
+        assert time.monotonic() - start < 0.4  # All at once
+    finally:
+        set_concurrency_limit(8)
+
+
+def test_async_cancellation_kills_subprocess(tmp_path):
+    marker = tmp_path.joinpath("marker")
+
+    async def cancelled():
+        task = asyncio.ensure_future(acmd(["bash", "-c", f"sleep 0.5; touch {marker}"]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(cancelled())
+    time.sleep(0.5)
+    assert not marker.exists()
+
+
+def _counting_cmd(counter):
+    return ["bash", "-c", f"echo x >> {counter}; wc -l < {counter}"]
+
+
+def test_readonly_memoized(tmp_path, caplog):
+    args = _counting_cmd(tmp_path.joinpath("counter"))
+    assert cmd(args, readonly=True).stdout == "1\n"
+    assert cmd(args, readonly=True).stdout == "1\n"
+    assert run(acmd(args, readonly=True)).stdout == "1\n"
+    assert len([r for r in caplog.records if r.message.startswith("cmd (memoized)")]) == 2
+
+    clear_memo()
+    assert cmd(args, readonly=True).stdout == "2\n"
+
+
+def test_readonly_structured_memoized():
+    args = ["bash", "-c", """echo '{"a": [1]}'"""]
+    first = cmd(args, readonly=True, structured=True)
+    first["a"].append(2)
+    assert cmd(args, readonly=True, structured=True) == {"a": [1]}
+
+
+def test_mutating_call_invalidates_memo(tmp_path):
+    args = _counting_cmd(tmp_path.joinpath("counter"))
+    assert cmd(args, readonly=True).stdout == "1\n"
+    cmd("true")
+    assert cmd(args, readonly=True).stdout == "2\n"
+    run(acmd("true"))
+    assert run(acmd(args, readonly=True)).stdout == "3\n"
+
+
+def test_readonly_failures_not_memoized(tmp_path):
+    counter = tmp_path.joinpath("counter")
+    args = ["bash", "-c", f"echo x >> {counter}; exit 1"]
+    cmd(args, check=False, readonly=True)
+    cmd(args, check=False, readonly=True)
+    assert len(counter.read_text().splitlines()) == 2
+
+
+def test_env():
+    args = ["bash", "-c", "echo $GCSS_TEST_VAR"]
+    assert cmd(args).stdout == "\n"
+    assert cmd(args, env={"GCSS_TEST_VAR": "a"}).stdout == "a\n"
+    assert run(acmd(args, env={"GCSS_TEST_VAR": "b"})).stdout == "b\n"
+
+
+def test_env_memoized_separately():
+    args = ["bash", "-c", "echo $GCSS_TEST_VAR"]
+    assert cmd(args, readonly=True, env={"GCSS_TEST_VAR": "a"}).stdout == "a\n"
+    assert cmd(args, readonly=True, env={"GCSS_TEST_VAR": "b"}).stdout == "b\n"
+
+
+async def _collect(stream):
+    return [element async for element in stream]
+
+
+def test_stream():
+    r = run(_collect(acmd_stream(["bash", "-c", 'echo "[1, {\\"a\\": [2]}, 3]"', "--"])))
+    assert r == [1, {"a": [2]}, 3]
+
+
+def test_stream_yields_early():
+    async def first_element_time():
+        stream = acmd_stream(["bash", "-c", "echo '[1,'; sleep 0.5; echo '2]'", "--"])
+        start = time.monotonic()
+        elements = []
+        async for element in stream:
+            elements.append((element, time.monotonic() - start))
+        return elements
+
+    (first, first_time), (second, second_time) = run(first_element_time())
+    assert (first, second) == (1, 2)
+    assert first_time < 0.4 <= second_time
+
+
+def test_stream_errors(caplog):
+    with pytest.raises(CalledProcessError) as e:
+        run(_collect(acmd_stream(["bash", "-c", "echo '[]'; echo oops >&2; exit 3", "--"])))
+    assert "status 3" in str(e.value)
+    assert "oops" in caplog.records[1].message
+
+
+def test_stream_truncated():
+    with pytest.raises(ValueError):
+        run(_collect(acmd_stream(["bash", "-c", "echo '[1, 2'", "--"])))
+
+
+def test_stream_early_exit_kills_subprocess(tmp_path):
+    marker = tmp_path.joinpath("marker")
+
+    async def first_only():
+        stream = acmd_stream(["bash", "-c", f"echo '[1,'; sleep 0.5; touch {marker}", "--"])
+        async for element in stream:
+            await stream.aclose()
+            return element
+
+    assert run(first_only()) == 1
+    time.sleep(0.5)
+    assert not marker.exists()
+
+
+def test_stream_env():
+    args = ["bash", "-c", """echo "[\\"$GCSS_TEST_VAR\\"]" #"""]
+    assert run(_collect(acmd_stream(args, env={"GCSS_TEST_VAR": "a"}))) == ["a"]
+
+
+@pytest.fixture
+def retry_policy():
+    """Sets a retry policy (without backoff) for the duration of a test"""
+    previous = []
+
+    def set_policy(**kwargs):
+        previous.append(set_retry_policy(RetryPolicy(backoff=0, **kwargs)))
+
+    stats.reset()
+    yield set_policy
+    if previous:
+        set_retry_policy(previous[0])
+    stats.reset()
+
+
+def _flaky_cmd(counter, failures, stderr="HTTP 503 Service Unavailable", output="ok"):
+    """A command that fails FAILURES times (with STDERR) before it succeeds"""
+    return ["bash", "-c", f"echo x >> {counter}; "
+            f"if [ $(wc -l < {counter}) -le {failures} ]; then echo '{stderr}' >&2; exit 1; fi; "
+            f"echo '{output}'"]
+
+
+def test_retry_transient(tmp_path, retry_policy, caplog):
+    retry_policy(retries=2)
+    args = _flaky_cmd(tmp_path.joinpath("counter"), 2)
+    assert cmd(args, readonly=True).stdout == "ok\n"
+    assert stats.retries == 2
+    assert len([m for m in caplog.messages if "retrying" in m]) == 2
+
+    clear_memo()
+    args = _flaky_cmd(tmp_path.joinpath("counter_async"), 2)
+    assert run(acmd(args, readonly=True)).stdout == "ok\n"
+    assert stats.retries == 4
+
+
+def test_retry_gives_up(tmp_path, retry_policy):
+    retry_policy(retries=1)
+    counter = tmp_path.joinpath("counter")
+    with pytest.raises(CalledProcessError):
+        run(acmd(_flaky_cmd(counter, 5), readonly=True))
+    assert len(counter.read_text().splitlines()) == 2
+
+
+def test_no_retry(tmp_path, retry_policy):
+    retry_policy(retries=2)
+
+    # Permanent failure
+    counter = tmp_path.joinpath("counter")
+    cmd(_flaky_cmd(counter, 1, stderr="PERMISSION_DENIED"), check=False, readonly=True)
+    assert len(counter.read_text().splitlines()) == 1
+
+    # Not read-only
+    counter = tmp_path.joinpath("counter_2")
+    cmd(_flaky_cmd(counter, 1), check=False)
+    assert len(counter.read_text().splitlines()) == 1
+
+    # Interrupted (i.e. Ctrl-C)
+    counter = tmp_path.joinpath("counter_3")
+    args = ["bash", "-c", f"echo x >> {counter}; kill -INT $$"]
+    assert cmd(args, check=False, readonly=True).returncode < 0
+    assert run(acmd(args, check=False, readonly=True)).returncode < 0
+    assert len(counter.read_text().splitlines()) == 2
+
+
+def test_timeout(tmp_path, retry_policy, caplog):
+    retry_policy(timeout=0.2)
+    marker = tmp_path.joinpath("marker")
+    args = ["bash", "-c", f"sleep 1; touch {marker}"]
+    with pytest.raises(CalledProcessError):
+        cmd(args, readonly=True)
+    with pytest.raises(CalledProcessError):
+        run(acmd(args, readonly=True))
+    assert stats.timeouts == 2
+    assert "timed out after 0.2s" in caplog.text
+
+    # Not read-only: no timeout
+    run(acmd(args))
+    assert marker.exists()
+
+
+def _slow_first_cmd(counter, output="ok"):
+    """A command that is slow the first time only"""
+    return ["bash", "-c", f"echo x >> {counter}; "
+            f"if [ $(wc -l < {counter}) -le 1 ]; then exec sleep 2; fi; echo '{output}'"]
+
+
+def test_timeout_retried(tmp_path, retry_policy):
+    retry_policy(timeout=0.5, retries=1)
+    counter = tmp_path.joinpath("counter")
+    assert run(acmd(_slow_first_cmd(counter), readonly=True)).stdout == "ok\n"
+    assert (stats.timeouts, stats.retries) == (1, 1)
+
+
+def test_hedging(tmp_path, retry_policy):
+    retry_policy(hedge_percentile=90)
+    args = _slow_first_cmd(tmp_path.joinpath("counter"))
+    for _ in range(5):
+        stats.record(command_kind(args), 0.1)
+
+    started = time.monotonic()
+    assert run(acmd(args, readonly=True)).stdout == "ok\n"
+    assert time.monotonic() - started < 1.5
+    assert (stats.hedges, stats.hedge_wins) == (1, 1)
+
+
+def test_no_hedging_without_samples(tmp_path, retry_policy):
+    retry_policy(hedge_percentile=90)
+    args = _slow_first_cmd(tmp_path.joinpath("counter"))
+    assert run(acmd(args, readonly=True)).stdout == ""  # The slow one
+    assert stats.hedges == 0
+
+
+def test_stream_retry(tmp_path, retry_policy):
+    retry_policy(retries=1)
+    args = _flaky_cmd(tmp_path.joinpath("counter"), 1, output='[1, 2]')
+    assert run(_collect(acmd_stream(args))) == [1, 2]
+    assert stats.retries == 1
+
+
+def test_stream_timeout(tmp_path, retry_policy):
+    retry_policy(timeout=0.3)
+    with pytest.raises(CalledProcessError):
+        run(_collect(acmd_stream(["bash", "-c", "echo '[1,'; sleep 2; echo '2]' #"])))
+    assert stats.timeouts == 1
+
+
+def test_stream_hedging(tmp_path, retry_policy):
+    retry_policy(hedge_percentile=90)
+    args = _slow_first_cmd(tmp_path.joinpath("counter"), output='[1, 2]')
+    for _ in range(5):
+        stats.record(command_kind(args), 0.1)
+
+    started = time.monotonic()
+    assert run(_collect(acmd_stream(args))) == [1, 2]
+    assert time.monotonic() - started < 1.5
+    assert (stats.hedges, stats.hedge_wins) == (1, 1)
+
+
+def test_invocations(tmp_path, retry_policy):
+    retry_policy(retries=2)
+    args = _flaky_cmd(tmp_path.joinpath("counter"), 1, output="héllo")
+    cmd(args, readonly=True)
+    clear_memo()
+    run(acmd(["bash", "-c", "echo out; echo err >&2; exit 4"], check=False))
+    run(_collect(acmd_stream(["bash", "-c", "echo '[1, 2]'", "--"])))
+
+    sync_call, async_call, stream_call = stats.invocations
+    assert (sync_call.returncode, sync_call.retries, sync_call.stdout_bytes) == (0, 1, 7)
+    assert (async_call.returncode, async_call.retries) == (4, 0)
+    assert (async_call.stdout_bytes, async_call.stderr_bytes) == (4, 4)
+    assert (stream_call.returncode, stream_call.stdout_bytes) == (0, 7)
+    assert stream_call.args[-1] == "--format=json"
+    assert all(i.duration > 0 for i in stats.invocations)
+
+    cmd(["echo"], readonly=True)
+    cmd(["echo"], readonly=True)  # Memoized, not run
+    assert len(stats.invocations) == 4
@@ -0,0 +1,76 @@
+from gcloud_sync_ssh.util.cmd_stats import (CommandStats, command_kind, command_project,
+                                            percentile)
+
+
+def test_command_kind():
+    args = ["gcloud", "--project=p", "--quiet", "compute", "instances", "list", "--format=json"]
+    assert command_kind(args) == "gcloud compute instances list"
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+    assert percentile([1, 2], 100) == 2
+
+
+def test_stats():
+    stats = CommandStats()
+    assert stats.summary() == "gcloud call attempts: 0, 0 failed, 0 retried, 0 timed out, " \
+        "0 hedged (0 won)"
+
+    for duration in [1, 2, 3, 4]:
+        stats.record("a", duration)
+    stats.record("a", 10, success=False)
+    stats.count("retries")
+    assert stats.attempts == 5
+    assert stats.latency_percentile("a", 50) is None  # Not enough samples
+    stats.record("a", 5)
+    assert stats.latency_percentile("a", 50) == 3
+    assert stats.summary().endswith("p50 3.00s, p95 5.00s, max 5.00s")
+    assert "1 retried" in stats.summary()
+
+
+def test_command_project():
+    assert command_project(["gcloud", "compute", "instances", "list", "--project=p"]) == "p"
+    assert command_project(["gcloud", "--project", "p", "compute", "instances", "list"]) == "p"
+    assert command_project(["GET", "https://compute.googleapis.com/compute/v1/projects/p/"
+                            "aggregated/instances?maxResults=500"]) == "p"
+    assert command_project(["gcloud", "projects", "list"]) is None
+
+
+def test_report():
+    stats = CommandStats()
+    assert stats.report() == ["No gcloud calls"]
+    assert stats.to_dict()["invocation_count"] == 0
+
+    stats.record_invocation(["gcloud", "projects", "list"], 1.0, 0, 100)
+    stats.record_invocation(["gcloud", "compute", "instances", "list", "--project=a"],
+                            2.0, 0, 1000, retries=1)
+    stats.record_invocation(["gcloud", "compute", "instances", "list", "--project=b"],
+                            3.0, 1, 0, 50)
+    stats.record_invocation(["gcloud", "compute", "instances", "list", "--project=b"],
+                            0.5, 0, 10)
+
+    lines = stats.report(top=1)
+    assert lines[0].split() == ["command", "invocations", "failed", "retries", "total", "p50",
+                                "p95", "max", "received"]
+    assert lines[1].split() == ["gcloud", "compute", "instances", "list", "3", "1", "1",
+                                "5.50s", "2.00s", "3.00s", "3.00s", "1010B"]
+    assert lines[2].split() == ["gcloud", "projects", "list", "1", "0", "0", "1.00s",
+                                "1.00s", "1.00s", "1.00s", "100B"]
+    assert lines[3].split() == ["all", "4", "1", "1", "6.50s", "1.00s", "3.00s", "3.00s",
+                                "1110B"]
+    assert lines[4] == ""
+    assert lines[5].split() == ["slowest", "projects", "total", "invocations"]
+    assert lines[6].split() == ["b", "3.50s", "2"]
+    assert len(lines) == 7
+
+    data = stats.to_dict(top=5)
+    assert (data["invocation_count"], data["stdout_bytes"], data["stderr_bytes"]) == (4, 1110, 50)
+    assert data["latency"]["max"] == 3.0
+    assert data["attempts"]["count"] == 0  # Only invocations were recorded
+    assert data["slowest_projects"] == [{"project": "b", "duration": 3.5, "invocations": 2},
+                                        {"project": "a", "duration": 2.0, "invocations": 1}]
+    assert data["invocations"][1]["project"] == "a"
+    assert data["invocations"][1]["kind"] == "gcloud compute instances list"
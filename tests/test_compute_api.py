@@ -0,0 +1,150 @@
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from gcloud_sync_ssh.backends import ComputeAPIBackend, ComputeAPIError, GCloudBackend, \
+    set_backend
+from gcloud_sync_ssh.gcloud_instances import build_host_dict
+from gcloud_sync_ssh.gcloud_projects import fetch_projects_data
+from gcloud_sync_ssh.util.aio import run
+from gcloud_sync_ssh.util.cmd_stats import stats
+from gcloud_sync_ssh.util.retry import RetryPolicy, set_retry_policy
+
+
+@pytest.fixture
+def api_backend(stubbed_compute_api):
+    backend = ComputeAPIBackend(token_provider=lambda env=None, refresh=False: "test-token")
+    previous_backend = set_backend(backend)
+    yield backend
+    set_backend(previous_backend)
+    backend.close()
+
+
+def test_list_instances(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("instances", "instances_2")
+    instances = run(api_backend.list_instances("stub-project-1"))
+    assert [i["name"] for i in instances] == ["stubbed_instance_0", "stubbed_instance_1"]
+    # One request per page, each instance being on its own page
+    assert len(stubbed_compute_api.requests) == 2
+
+
+def test_list_projects(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("projects", "projects_1")
+    projects = run(api_backend.list_projects())
+    assert [p["projectId"] for p in projects] == \
+        ["stub-project-1", "stub-project-2", "stub-project-3"]
+
+
+def test_build_host_dict_matches_gcloud(stubbed_gcloud_ctx, stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("instances", "instances_1")
+    api_result = build_host_dict("stub-project-1", [])
+
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    set_backend(GCloudBackend())
+    gcloud_result = build_host_dict("stub-project-1", [])
+
+    assert api_result == gcloud_result
+    assert len(api_result) == 2
+
+
+def test_fetch_projects_data(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("projects", "projects_1")
+    assert len(fetch_projects_data()) == 3
+
+
+def test_connections_are_reused(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("instances", "instances_2")
+    for _ in range(3):
+        run(api_backend.list_instances("stub-project-2"))
+    assert len(stubbed_compute_api.requests) == 6
+    assert len(stubbed_compute_api.client_addresses) == 1
+
+
+def test_api_errors(caplog, stubbed_compute_api, api_backend, raise_on_gcloud_instance_sync):
+    stubbed_compute_api.errors["stub-project-1"] = (403, "Required 'compute.instances.list'")
+    with pytest.raises(ComputeAPIError) as e:
+        build_host_dict("stub-project-1", [])
+    assert e.value.status == 403
+    assert "compute.instances.list" in caplog.text
+
+
+def test_api_errors_usual(stubbed_compute_api, api_backend):
+    stubbed_compute_api.errors["stub-project-1"] = (403, "Required 'compute.instances.list'")
+    assert build_host_dict("stub-project-1", []) is None
+
+
+def test_list_instances_fields(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("instances", "instances_1")
+    run(api_backend.list_instances("stub-project-1",
+                                   fields=["name", "networkInterfaces[].accessConfigs[].natIP"]))
+    query = parse_qs(urlsplit(stubbed_compute_api.requests[0]).query)
+    assert query["fields"] == \
+        ["items/*/instances(name,networkInterfaces/accessConfigs/natIP),nextPageToken"]
+
+
+def test_list_instances_name_regex(stubbed_compute_api, api_backend):
+    stubbed_compute_api.seed("instances", "instances_1")
+    instances = run(api_backend.list_instances("stub-project-1",
+                                               name_regex="^(?:stubbed_instance_1)$"))
+    assert [i["name"] for i in instances] == ["stubbed_instance_1"]
+    query = parse_qs(urlsplit(stubbed_compute_api.requests[0]).query)
+    assert query["filter"] == ["name eq '^(?:stubbed_instance_1)$'"]
+
+
+def test_expired_token_renewed(stubbed_compute_api):
+    issued = []
+
+    def token_provider(env=None, refresh=False):
+        issued.append(refresh)
+        return f"token-{len(issued)}"
+
+    stubbed_compute_api.seed("instances", "instances_2")
+    stubbed_compute_api.expired_tokens.add("token-1")
+    backend = ComputeAPIBackend(token_provider=token_provider)
+    try:
+        instances = run(backend.list_instances("stub-project-1"))
+    finally:
+        backend.close()
+    assert len(instances) == 2
+    assert issued == [False, True]
+    assert stubbed_compute_api.tokens == ["token-1", "token-2", "token-2"]
+
+
+@pytest.fixture
+def retrying_api_backend(stubbed_compute_api):
+    previous_policy = set_retry_policy(RetryPolicy(retries=2, backoff=0))
+    backend = ComputeAPIBackend(token_provider=lambda env=None, refresh=False: "test-token")
+    previous_backend = set_backend(backend)
+    stats.reset()
+    yield backend
+    set_backend(previous_backend)
+    set_retry_policy(previous_policy)
+    backend.close()
+
+
+def test_api_transient_errors_retried(stubbed_compute_api, retrying_api_backend):
+    stubbed_compute_api.seed("instances", "instances_1")
+    stubbed_compute_api.errors["stub-project-1"] = (503, "Backend Error")
+    stubbed_compute_api.error_counts["stub-project-1"] = 2
+    assert len(build_host_dict("stub-project-1", [])) == 2
+    assert stats.retries == 2
+    invocation = stats.invocations[0]  # First page
+    assert (invocation.project, invocation.returncode, invocation.retries) == \
+        ("stub-project-1", 0, 2)
+    assert invocation.stdout_bytes > 0
+
+
+def test_api_permanent_errors_not_retried(stubbed_compute_api, retrying_api_backend):
+    stubbed_compute_api.errors["stub-project-1"] = (403, "Required 'compute.instances.list'")
+    assert build_host_dict("stub-project-1", []) is None
+    assert len(stubbed_compute_api.requests) == 1
+    assert stats.retries == 0
+
+
+def test_api_unreachable_projects_cached(stubbed_gcloud_ctx, stubbed_compute_api, api_backend):
+    stubbed_compute_api.errors["stub-project-1"] = \
+        (403, "Compute Engine API has not been used in project 111111111111 before or it is "
+         "disabled.")
+    for _ in range(2):
+        assert build_host_dict("stub-project-1", [], unreachable_ttl=60) is None
+    assert len(stubbed_compute_api.requests) == 1
@@ -0,0 +1,66 @@
+import os
+import time
+
+import pytest
+
+from gcloud_sync_ssh.util.disk_cache import JSONFileCache, cache_dir
+
+
+def test_cache_dir(tmp_path):
+    with pytest.helpers.env_override("GCSS_CACHE_DIR", ""):
+        with pytest.helpers.env_override("XDG_CACHE_HOME", str(tmp_path)):
+            assert cache_dir() == os.path.join(str(tmp_path), "gcloud_sync_ssh")
+    with pytest.helpers.env_override("GCSS_CACHE_DIR", str(tmp_path)):
+        assert cache_dir() == str(tmp_path)
+
+
+def test_get_set(stubbed_gcloud_ctx):
+    cache = JSONFileCache("test.json")
+    assert cache.get("k", ttl=60) is None
+    cache.set("k", [1, {"a": 2}])
+    cache.set("l", "v")
+    assert JSONFileCache("test.json").get("k", ttl=60) == [1, {"a": 2}]
+    assert JSONFileCache("test.json").get("l", ttl=60) == "v"
+
+    cache.delete("k")
+    assert cache.get("k", ttl=60) is None
+    assert cache.get("l", ttl=60) == "v"
+
+
+def test_expiry(stubbed_gcloud_ctx):
+    cache = JSONFileCache("test.json")
+    cache.set("k", "v")
+    time.sleep(0.05)
+    assert cache.get("k", ttl=60) == "v"
+    assert cache.get("k", ttl=0.01) is None
+
+
+def test_atomic_writes(stubbed_gcloud_ctx):
+    cache = JSONFileCache("test.json")
+    for i in range(5):
+        cache.set(f"k{i}", i)
+    # No temporary files are left behind
+    assert os.listdir(os.path.dirname(cache.path)) == ["test.json"]
+
+
+def test_corrupted_file(caplog, stubbed_gcloud_ctx):
+    cache = JSONFileCache("test.json")
+    os.makedirs(os.path.dirname(cache.path))
+    with open(cache.path, "w") as fh:
+        fh.write('{"k": {"timest')
+    assert cache.get("k", ttl=60) is None
+    assert "corrupted" in caplog.text
+    cache.set("k", "v")
+    assert cache.get("k", ttl=60) == "v"
+
+
+def test_malformed_entries(stubbed_gcloud_ctx):
+    cache = JSONFileCache("test.json")
+    os.makedirs(os.path.dirname(cache.path))
+    with open(cache.path, "w") as fh:
+        fh.write('{"a": {"value": 1}, "b": {"timestamp": "x", "value": 2}, "c": 3, '
+                 '"d": {"timestamp": 1e12}}')
+    for key in ["a", "b", "c", "d"]:
+        assert cache.get(key, ttl=60) is None
+    cache.set("a", "v")
+    assert cache.get("a", ttl=60) == "v"
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from gcloud_sync_ssh.backends.base import Backend
+from gcloud_sync_ssh.gcloud_auth import GCloudServiceAccountAuth, list_accounts
+from gcloud_sync_ssh.gcloud_config import gcloud_config_get
+from gcloud_sync_ssh.gcloud_instances import build_host_dict
+from gcloud_sync_ssh.gcloud_projects import fetch_projects_data
+from gcloud_sync_ssh.util.disk_cache import JSONFileCache
+
+
+def test_host_dict(faked_gcloud_ctx):
+    faked_gcloud_ctx.seed_db("instances", "instances_2")
+    res = build_host_dict("stub-project-1", [])
+    assert res == {"stubbed_instance_0.us-central1-b.stub-project-1":
+                   {"ip": None, "id": "0000000000000000001", "status": "TERMINATED"},
+                   "stubbed_instance_1.us-central1-b.stub-project-1":
+                   {"ip": "127.127.127.3", "id": "0000000000000000002",
+                    "status": "RUNNING"}}
+    assert list(build_host_dict("stub-project-2", ["*_3"]).keys()) == \
+        ["stubbed_instance_3.us-central1-b.stub-project-2"]
+    assert build_host_dict("stub-project-3", []) == {}
+
+
+def test_unreachable_projects(faked_gcloud_ctx):
+    faked_gcloud_ctx.seed_db("instances", "instances_2")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com",
+                   "disabled_apis": ["stub-project-1"],
+                   "project_access": {"test-a@gmail.com": ["stub-project-1"]}})
+    for project_id in ["stub-project-1", "stub-project-2"]:
+        assert build_host_dict(project_id, [], unreachable_ttl=60) is None
+
+    cache = JSONFileCache("unreachable_projects.json")
+    assert cache.get("stub-project-1", 60)["reason"] == "api-disabled"
+    assert cache.get("stub-project-2", 60)["reason"] == "forbidden"
+
+
+def test_projects(faked_gcloud_ctx):
+    faked_gcloud_ctx.seed_db("projects", "projects_1")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com",
+                   "project_access": {"test-b@gmail.com": ["stub-project-2"]}})
+    assert len(fetch_projects_data()) == 3
+    projects = fetch_projects_data(env={"CLOUDSDK_CORE_ACCOUNT": "test-b@gmail.com"})
+    assert [datum["projectId"] for datum in projects] == ["stub-project-2"]
+
+
+def test_config_and_auth(faked_gcloud_ctx):
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"accounts": ["test-a@gmail.com", "test-b@gmail.com"],
+                   "account": "test-a@gmail.com", "project": "stub-project-1"})
+    assert gcloud_config_get("core/project") == "stub-project-1"
+    assert gcloud_config_get("core/project",
+                             env={"CLOUDSDK_CORE_PROJECT": "stub-project-2"}) == "stub-project-2"
+    assert gcloud_config_get("compute/zone") is None
+    assert list_accounts() == ["test-a@gmail.com", "test-b@gmail.com"]
+
+    sa_email = "dummy-sa@dummy-proj.iam.gserviceaccount.com"
+    with faked_gcloud_ctx.tmpfile("credentials.json") as f:
+        f.write(json.dumps({"client_email": sa_email}))
+    with GCloudServiceAccountAuth(str(faked_gcloud_ctx.tmp_path.joinpath("credentials.json"))):
+        with faked_gcloud_ctx.db("config") as db:
+            assert db["account"] == sa_email
+    with faked_gcloud_ctx.db("config") as db:
+        assert db["account"] == "test-a@gmail.com"
+
+
+def test_faked_runs_nothing(faked_gcloud_ctx):
+    faked_gcloud_ctx.seed_db("instances", "instances_2")
+    faked_gcloud_ctx.seed_db("projects", "projects_1")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com"})
+    for datum in fetch_projects_data():
+        build_host_dict(datum["projectId"], [], unreachable_ttl=60)
+
+    with faked_gcloud_ctx.db("cmd_log") as db:
+        assert len(db) == 0
+    assert [call for call, _ in faked_gcloud_ctx.backend.calls] == \
+        ["list_projects"] + ["iter_instances"] * 3
+
+
+def test_incomplete_backend():
+    class ListingOnlyBackend(Backend):
+        async def list_projects(self, env=None):
+            return []
+
+    with pytest.raises(TypeError):
+        ListingOnlyBackend()
@@ -1,6 +1,7 @@
 import json
 
-from gcloud_sync_ssh.gcloud_auth import GCloudAccountIdAuth, GCloudServiceAccountAuth
+from gcloud_sync_ssh.gcloud_auth import (GCloudAccountIdAuth, GCloudIsolatedAuth,
+                                         GCloudServiceAccountAuth, list_accounts)
 
 
 def test_login(stubbed_gcloud_ctx):
@@ -47,3 +48,19 @@ def test_service_account(stubbed_gcloud_ctx):
     # Ensure we ran the expected amount of commands
     with stubbed_gcloud_ctx.db("cmd_log") as db:
         assert len(db) == 3
+
+
+def test_isolated_auth(stubbed_gcloud_ctx):
+    with GCloudIsolatedAuth(account_id="test-b@gmail.com") as auth:
+        assert auth.env == {"CLOUDSDK_CORE_ACCOUNT": "test-b@gmail.com"}
+
+    # Nothing was run
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert len(db) == 0
+
+
+def test_list_accounts(stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"accounts": ["test-a@gmail.com", "test-b@gmail.com"],
+                   "account": "test-a@gmail.com"})
+    assert list_accounts() == ["test-a@gmail.com", "test-b@gmail.com"]
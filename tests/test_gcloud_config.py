@@ -1,4 +1,13 @@
-from gcloud_sync_ssh.gcloud_config import gcloud_config_get
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from gcloud_sync_ssh.backends import get_backend
+from gcloud_sync_ssh.gcloud_config import gcloud_config_get, gcloud_config_read
+from gcloud_sync_ssh.util.aio import run
 
 
 def test_gcloud_config_get(stubbed_gcloud_ctx):
@@ -20,3 +29,98 @@ def test_gcloud_config_get(stubbed_gcloud_ctx):
 
     retrieved_c = gcloud_config_get("c")
     assert retrieved_c is None
+
+
+_CONFIGURATION = """[core]
+account = test-a@gmail.com
+project = stub-project-1
+
+[compute]
+zone = europe-west1-b
+"""
+
+_KEYS = ["account", "core/account", "core/project", "compute/zone", "compute/region"]
+
+# What `gcloud config get-value KEY --format=json` prints for _KEYS, with _CONFIGURATION as
+# the active configuration "work", and a configuration "other" that only sets a project
+_EXPECTED_VALUES = [
+    (None, ["test-a@gmail.com", "test-a@gmail.com", "stub-project-1", "europe-west1-b",
+            None]),
+    ({"CLOUDSDK_CORE_ACCOUNT": "test-b@gmail.com"},
+     ["test-b@gmail.com", "test-b@gmail.com", "stub-project-1", "europe-west1-b", None]),
+    ({"CLOUDSDK_ACTIVE_CONFIG_NAME": "other"}, [None, None, "other-project", None, None]),
+]
+
+
+def test_gcloud_config_read(stubbed_gcloud_ctx):
+    assert gcloud_config_read("core/account") is None
+
+    stubbed_gcloud_ctx.write_gcloud_configuration("work", _CONFIGURATION)
+    assert gcloud_config_read("account") == "test-a@gmail.com"
+    assert gcloud_config_read("compute/zone") == "europe-west1-b"
+    assert gcloud_config_read("compute/region") is None
+
+    # Environment overrides
+    assert gcloud_config_read("core/project", env={"CLOUDSDK_CORE_PROJECT": "p"}) == "p"
+    assert gcloud_config_read("core/project", env={"CLOUDSDK_ACTIVE_CONFIG_NAME": "x"}) is None
+
+
+def test_gcloud_config_get_fast_path(stubbed_gcloud_ctx):
+    stubbed_gcloud_ctx.write_gcloud_configuration("work", _CONFIGURATION)
+    assert gcloud_config_get("core/project") == "stub-project-1"
+    assert gcloud_config_get("core/project", env={"CLOUDSDK_CORE_PROJECT": "p"}) == "p"
+
+    # gcloud was never run
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert len(db) == 0
+
+
+@pytest.mark.parametrize("env, expected_values", _EXPECTED_VALUES)
+def test_gcloud_config_parity(stubbed_gcloud_ctx, env, expected_values):
+    stubbed_gcloud_ctx.write_gcloud_configuration("work", _CONFIGURATION)
+    stubbed_gcloud_ctx.write_gcloud_configuration("other", "[core]\nproject = other-project\n",
+                                                  activate=False)
+    assert [gcloud_config_get(key, env=env) for key in _KEYS] == expected_values
+
+
+@pytest.mark.parametrize("env", [e for e, _ in _EXPECTED_VALUES] + [
+    {"CLOUDSDK_COMPUTE_ZONE": "us-east1-c", "CLOUDSDK_COMPUTE_REGION": "us-east1"},
+    {"CLOUDSDK_ACTIVE_CONFIG_NAME": "other", "CLOUDSDK_CORE_ACCOUNT": "test-b@gmail.com"},
+    {"CLOUDSDK_ACTIVE_CONFIG_NAME": "missing"},
+])
+def test_gcloud_config_read_backend_parity(stubbed_gcloud_ctx, env):
+    # The in-process fast path and `gcloud config get-value` (the stub reads the same
+    # configuration files) agree, including on missing properties (i.e. compute/region)
+    stubbed_gcloud_ctx.write_gcloud_configuration("work", _CONFIGURATION)
+    stubbed_gcloud_ctx.write_gcloud_configuration("other", "[core]\nproject = other-project\n",
+                                                  activate=False)
+    backend_values = [run(get_backend().config_get(key, env=env)) for key in _KEYS]
+    assert [gcloud_config_read(key, env=env) for key in _KEYS] == backend_values
+
+
+def _real_gcloud():
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = os.pathsep.join(p for p in os.getenv("PATH", "").split(os.pathsep)
+                           if os.path.abspath(p) != here)
+    return shutil.which("gcloud", path=path)
+
+
+@pytest.mark.skipif(not _real_gcloud(), reason="gcloud is not installed")
+@pytest.mark.parametrize("env, expected_values", _EXPECTED_VALUES)
+def test_gcloud_config_expected_values_real_gcloud(tmp_path, env, expected_values):
+    # Checks _EXPECTED_VALUES against gcloud itself
+    config_dir = tmp_path.joinpath("gcloud_config")
+    config_dir.joinpath("configurations").mkdir(parents=True)
+    config_dir.joinpath("configurations", "config_work").write_text(_CONFIGURATION)
+    config_dir.joinpath("configurations", "config_other").write_text(
+        "[core]\nproject = other-project\n")
+    config_dir.joinpath("active_config").write_text("work")
+
+    env = dict(env or {}, CLOUDSDK_CONFIG=str(config_dir))
+    values = []
+    for key in _KEYS:
+        res = subprocess.run([_real_gcloud(), "config", "get-value", key, "--format=json"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             env=dict(os.environ, **env), encoding="UTF-8", check=True)
+        values.append(json.loads(res.stdout) if res.stdout.strip() else None)
+    assert values == expected_values
@@ -3,6 +3,8 @@ from subprocess import CalledProcessError
 import pytest
 
 from gcloud_sync_ssh.gcloud_instances import build_host_dict
+from gcloud_sync_ssh.util.cmd import clear_memo
+from gcloud_sync_ssh.util.disk_cache import JSONFileCache
 
 
 def test_simple_host_dict(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
@@ -24,7 +26,7 @@ def test_simple_host_dict(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
 
 
 def test_crash_behavior_usual(stubbed_gcloud_ctx):
-    assert build_host_dict("crashme", []) == {}
+    assert build_host_dict("crashme", []) is None
 
 
 def test_crash_behavior_testmode(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
@@ -49,3 +51,83 @@ def test_instance_globbing(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
 @pytest.mark.skip(reason="I have yet to make realistic stubs for this")
 def test_multiple_external_ips(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
     pass
+
+
+def test_projected_listing(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    build_host_dict("stub-project-1", [])
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert list(db.values())[0].endswith(
+            "--format=json(name,id,status,zone,networkInterfaces[].accessConfigs[].natIP)")
+
+
+def test_instance_globbing_server_side(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    res = build_host_dict("stub-project-1", ["stubbed_instance_1", "nothing-*"])
+    assert list(res.keys()) == ["stubbed_instance_1.us-central1-b.stub-project-1"]
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert "--filter=name~'^(?:stubbed_instance_1|nothing-.*)$'" in list(db.values())[0]
+
+
+def test_instance_globbing_client_side(stubbed_gcloud_ctx, raise_on_gcloud_instance_sync):
+    # Globs that can't be translated are only matched client side
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    res = build_host_dict("stub-project-1", ["stubbed_instance_[0"])
+    assert len(res) == 0
+    res = build_host_dict("stub-project-1", ["stubbed.instance_0"])
+    assert len(res) == 0
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        assert not [c for c in db.values() if "--filter" in c]
+
+
+def _instances_list_calls(stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        return len([c for c in db.values() if "instances list" in c])
+
+
+def test_unreachable_projects_cached(caplog, stubbed_gcloud_ctx):
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com",
+                   "disabled_apis": ["stub-project-1"],
+                   "project_access": {"test-a@gmail.com": ["stub-project-1"]}})
+
+    for project_id in ["stub-project-1", "stub-project-2", "stub-project-1", "stub-project-2"]:
+        assert build_host_dict(project_id, [], unreachable_ttl=60) is None
+    assert _instances_list_calls(stubbed_gcloud_ctx) == 2
+    assert "Skipping project stub-project-1: api-disabled " \
+        "(cached, see --reprobe-projects)" in caplog.messages
+    assert "Skipping project stub-project-2: forbidden " \
+        "(cached, see --reprobe-projects)" in caplog.messages
+
+    cache = JSONFileCache("unreachable_projects.json")
+    assert cache.get("stub-project-1", 60) == \
+        {"reason": "api-disabled", "account": "test-a@gmail.com"}
+
+    # Cached per account (switched behind our back, so memoized calls must go)
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-b@gmail.com"})
+    clear_memo()
+    build_host_dict("stub-project-2", [], unreachable_ttl=60)
+    assert _instances_list_calls(stubbed_gcloud_ctx) == 3
+
+
+def test_unreachable_projects_reprobe(stubbed_gcloud_ctx):
+    stubbed_gcloud_ctx.seed_db("instances", "instances_1")
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com", "disabled_apis": ["stub-project-1"]})
+    assert build_host_dict("stub-project-1", [], unreachable_ttl=60) is None
+
+    # The API got enabled since
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"disabled_apis": []})
+    assert build_host_dict("stub-project-1", [], unreachable_ttl=60) is None  # Still skipped
+    assert len(build_host_dict("stub-project-1", [], unreachable_ttl=60, reprobe=True)) == 2
+    assert len(build_host_dict("stub-project-1", [], unreachable_ttl=60)) == 2
+    assert _instances_list_calls(stubbed_gcloud_ctx) == 3
+
+
+def test_transient_failures_not_cached(stubbed_gcloud_ctx):
+    assert build_host_dict("crashme", [], unreachable_ttl=60) is None
+    assert build_host_dict("crashme", [], unreachable_ttl=60) is None
+    assert _instances_list_calls(stubbed_gcloud_ctx) == 2
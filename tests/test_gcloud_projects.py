@@ -1,4 +1,5 @@
-from gcloud_sync_ssh.gcloud_projects import fetch_projects_data
+from gcloud_sync_ssh.gcloud_projects import fetch_accounts_projects_data, fetch_projects_data
+from gcloud_sync_ssh.util.cmd import clear_memo
 
 
 def test_simple_fetch(stubbed_gcloud_ctx):
@@ -6,3 +7,58 @@ def test_simple_fetch(stubbed_gcloud_ctx):
     res = fetch_projects_data()
     assert len(res) == 3
     assert type(res) == list
+
+
+def _projects_list_calls(stubbed_gcloud_ctx):
+    with stubbed_gcloud_ctx.db("cmd_log") as db:
+        return len([c for c in db.values() if "projects list" in c])
+
+
+def _list_projects_calls(faked_gcloud_ctx):
+    return len([call for call, _ in faked_gcloud_ctx.backend.calls if call == "list_projects"])
+
+
+def test_cached_fetch(faked_gcloud_ctx):
+    faked_gcloud_ctx.seed_db("projects", "projects_1")
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-a@gmail.com"})
+
+    assert len(fetch_projects_data(ttl=60)) == 3
+    assert len(fetch_projects_data(ttl=60)) == 3
+    assert _list_projects_calls(faked_gcloud_ctx) == 1
+
+    # Refreshing
+    assert len(fetch_projects_data(ttl=60, refresh=True)) == 3
+    assert _list_projects_calls(faked_gcloud_ctx) == 2
+
+    # Cache is per account (switched behind our back, so memoized calls must go)
+    with faked_gcloud_ctx.db("config") as db:
+        db.update({"account": "test-b@gmail.com"})
+    clear_memo()
+    assert len(fetch_projects_data(ttl=60)) == 3
+    assert _list_projects_calls(faked_gcloud_ctx) == 3
+
+    # Not caching
+    clear_memo()
+    assert len(fetch_projects_data()) == 3
+    assert _list_projects_calls(faked_gcloud_ctx) == 4
+
+
+def test_memoized_fetch(stubbed_gcloud_ctx):
+    stubbed_gcloud_ctx.seed_db("projects", "projects_1")
+    assert len(fetch_projects_data()) == 3
+    assert len(fetch_projects_data()) == 3
+    assert _projects_list_calls(stubbed_gcloud_ctx) == 1
+
+
+def test_accounts_fetch(stubbed_gcloud_ctx):
+    stubbed_gcloud_ctx.seed_db("projects", "projects_1")
+    with stubbed_gcloud_ctx.db("config") as db:
+        db.update({"project_access": {"a@x.com": ["stub-project-1", "stub-project-2"],
+                                      "b@x.com": ["stub-project-3", "stub-project-2"]}})
+
+    res = fetch_accounts_projects_data(["b@x.com", "a@x.com"])
+    assert [(account, datum["projectId"]) for account, datum in res] == [
+        ("b@x.com", "stub-project-2"), ("b@x.com", "stub-project-3"),
+        ("a@x.com", "stub-project-1")]
+    assert _projects_list_calls(stubbed_gcloud_ctx) == 2
@@ -1,4 +1,9 @@
-from gcloud_sync_ssh.util.globbing import matches_any, looks_like_pattern, has_pattern
+import re
+
+import pytest
+
+from gcloud_sync_ssh.util.globbing import matches_any, looks_like_pattern, has_pattern, \
+    glob_to_regex, globs_to_regex
 
 
 def test_looks_like_pattern():
@@ -32,3 +37,32 @@ def test_matches_any():
     assert not matches_any("aab", ["bb?"])
     assert not matches_any("aab", ["b*b"])
     assert not matches_any("aab", ["[cb][cd][ce]"])
+
+
+def test_glob_to_regex():
+    assert glob_to_regex("web-*") == "web-.*"
+    assert glob_to_regex("web-?") == "web-."
+    assert glob_to_regex("web-[ab]") == "web-[ab]"
+    assert glob_to_regex("web-[!a-c]x") == "web-[^a-c]x"
+    assert glob_to_regex("web") == "web"
+
+
+@pytest.mark.parametrize("glob", ["web.*", "web-[", "web-[]]", "web-[!]", "we'b", "a\\b*"])
+def test_glob_to_regex_untranslatable(glob):
+    assert glob_to_regex(glob) is None
+
+
+def test_globs_to_regex():
+    assert globs_to_regex([]) is None
+    assert globs_to_regex(None) is None
+    assert globs_to_regex(["web-*", "db-?"]) == "^(?:web-.*|db-.)$"
+    assert globs_to_regex(["web-*", "db.*"]) is None
+    assert globs_to_regex(["web-*", "[z-a]*"]) is None  # Bad range: client side matching only
+
+
+@pytest.mark.parametrize("globs", [["web-*"], ["*-1", "db?"], ["w[a-e]b*"], ["[!w]*"], ["*"]])
+def test_globs_to_regex_equivalence(globs):
+    regex = re.compile(globs_to_regex(globs))
+    names = ["web-1", "web-2", "db1", "db-1", "wab", "x", "", "web", "aweb-1", "db12"]
+    for name in names:
+        assert bool(regex.search(name)) == matches_any(name, globs), name
@@ -0,0 +1,48 @@
+from gcloud_sync_ssh.inventory import InventoryStore
+
+
+_RUNNING = {"ip": "1.1.1.1", "id": "1", "status": "RUNNING"}
+_TERMINATED = {"ip": None, "id": "2", "status": "TERMINATED"}
+
+
+def test_empty(stubbed_gcloud_ctx):
+    store = InventoryStore("~/.ssh/config")
+    assert store.load("p") == {}
+    delta = store.diff("p", {"a.z.p": _RUNNING})
+    assert delta
+    assert delta.added == {"a.z.p": _RUNNING}
+    assert delta.summary() == "1 new, 0 changed, 0 gone"
+
+
+def test_stage_and_commit(stubbed_gcloud_ctx):
+    store = InventoryStore("~/.ssh/config")
+    store.stage("p", {"a.z.p": _RUNNING, "b.z.p": _TERMINATED})
+    assert store.load("p") == {}  # Not committed yet
+    store.commit()
+    store.close()
+
+    store = InventoryStore("~/.ssh/config")
+    assert store.load("p") == {"a.z.p": _RUNNING, "b.z.p": _TERMINATED}
+    assert store.load("q") == {}
+    assert not store.diff("p", {"a.z.p": _RUNNING, "b.z.p": _TERMINATED})
+
+    # Changes
+    new_ip = dict(_RUNNING, ip="2.2.2.2")
+    delta = store.diff("p", {"a.z.p": new_ip, "c.z.p": _RUNNING})
+    assert delta.added == {"c.z.p": _RUNNING}
+    assert delta.changed == {"a.z.p": new_ip}
+    assert delta.removed == {"b.z.p": _TERMINATED}
+    assert delta.unchanged == {}
+
+    # Replacing a listing
+    store.stage("p", {"c.z.p": _RUNNING})
+    store.commit()
+    assert store.load("p") == {"c.z.p": _RUNNING}
+
+
+def test_separate_configs(stubbed_gcloud_ctx):
+    store = InventoryStore("/tmp/config-a")
+    store.stage("p", {"a.z.p": _RUNNING})
+    store.commit()
+    assert InventoryStore("/tmp/config-b").load("p") == {}
+    assert InventoryStore("/tmp/config-a").load("p") == {"a.z.p": _RUNNING}
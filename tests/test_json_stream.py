@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from gcloud_sync_ssh.util.json_stream import JSONArrayStreamDecoder
+
+
+def _decode(text, chunk_size):
+    decoder = JSONArrayStreamDecoder()
+    result = []
+    for i in range(0, len(text), chunk_size):
+        result += decoder.feed(text[i:i + chunk_size])
+    decoder.close()
+    return result
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1000])
+def test_decode(chunk_size):
+    data = [{"a": [1, 2, {"b": "]},["}]}, 12345, "x,y", [], {}, None, True, -1.5e3]
+    assert _decode(json.dumps(data, indent=4), chunk_size) == data
+    assert _decode(json.dumps(data), chunk_size) == data
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] \n", "[\n]"])
+def test_decode_empty(text):
+    assert _decode(text, 1) == []
+
+
+def test_elements_come_early():
+    decoder = JSONArrayStreamDecoder()
+    assert decoder.feed('[{"a": 1}, {"b"') == [{"a": 1}]
+    assert decoder.feed(': 2}, 3') == [{"b": 2}]
+    assert decoder.feed('4]') == [34]
+    decoder.close()
+
+
+@pytest.mark.parametrize("text", ["", "[", '[{"a": 1}', '[{"a": 1},'])
+def test_truncated(text):
+    decoder = JSONArrayStreamDecoder()
+    decoder.feed(text)
+    with pytest.raises(ValueError):
+        decoder.close()
+
+
+@pytest.mark.parametrize("text", ["{}", "[1 2]", "[1] 2"])
+def test_invalid(text):
+    with pytest.raises(ValueError):
+        JSONArrayStreamDecoder().feed(text)
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gcloud_sync_ssh.util.profiling import Profiler
+
+
+def _in_main_thread():
+    return sum(range(1000))
+
+
+def _in_worker_thread():
+    return sum(range(1000))
+
+
+@pytest.mark.parametrize("cpu_only", [False, True])
+def test_profiler(cpu_only):
+    profiler = Profiler(cpu_only=cpu_only)
+    profiler.start()
+    _in_main_thread()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(lambda _: _in_worker_thread(), range(4))) == [499500] * 4
+    profile_stats = profiler.stop()
+
+    calls = {function: stat[1] for (_, _, function), stat in profile_stats.stats.items()}
+    assert calls["_in_main_thread"] == 1
+    assert calls["_in_worker_thread"] == 4
@@ -0,0 +1,39 @@
+import pytest
+
+from gcloud_sync_ssh.util.retry import RetryPolicy, is_transient
+
+
+@pytest.mark.parametrize("returncode, stderr, transient", [
+    (1, "ERROR: (gcloud.compute.instances.list) HTTP 503 Service Unavailable", True),
+    (1, "ERROR: (gcloud.projects.list) HTTPError 429: Quota exceeded", True),
+    (1, "ERROR: (gcloud.compute.instances.list) Some requests did not succeed:\n"
+        " - Internal error. Please try again or contact Google Support. (Code: '500')", True),
+    (1, "code: 502", True),
+    (1, "ERROR: Rate Limit Exceeded", True),
+    (1, "ERROR: [Errno 104] Connection reset by peer", True),
+    (1, "ERROR: The read operation timed out", True),
+    (1, "ERROR: Required 'compute.instances.list' permission for 'projects/x'", False),
+    (1, "ERROR: Project 'projects/5030' not found", False),
+    (1, "", False),
+    (1, None, False),
+    (1, "ERROR: Invalid value for field 'resource.name': 'vm-500'", False),
+    (1, "ERROR: The resource is not ready, try again later", False),
+    (-9, None, False),
+    (-2, "HTTP 503 Service Unavailable", True),
+])
+def test_is_transient(returncode, stderr, transient):
+    assert is_transient(returncode, stderr) == transient
+
+
+def test_is_transient_timed_out():
+    assert is_transient(-9, "timed out after 30s", timed_out=True)
+    assert not is_transient(-2, "timed out after 30s")
+    assert not is_transient(0, "", timed_out=True)
+
+
+def test_delay():
+    policy = RetryPolicy(backoff=1, max_backoff=5)
+    for attempt, cap in [(0, 1), (1, 2), (2, 4), (3, 5), (10, 5)]:
+        delays = [policy.delay(attempt) for _ in range(50)]
+        assert all(0 <= d <= cap for d in delays)
+        assert len(set(delays)) > 1  # Jitter
@@ -1,13 +1,16 @@
 import os
 import pytest
 import re
+import shutil
 import stat
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from gcloud_sync_ssh.ssh_config import SSHConfig, SSHConfigParseError, \
     _GCSS_COMMENT, _BEGIN_MARKER, _END_MARKER
 
+from gcloud_sync_ssh.changeset import ChangeSet
 from gcloud_sync_ssh.host_config import HostConfig, StrictHostKeyCheckingParam
+from gcloud_sync_ssh.util.color_diff import pretty_diff
 
 _GCSS_LINECOUNT = _GCSS_COMMENT.count("\n") + 1
 _RE_ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
@@ -138,6 +141,178 @@ def test_backup_no_overwrite():
         assert "file exists" in str(e.value)
 
 
+@pytest.mark.parametrize("exhibit", ["exhibit_1", None])
+def test_save_then_edit(exhibit):
+    with TemporaryDirectory() as d:
+        conf_path = os.path.join(d, "test")
+        if exhibit:
+            shutil.copy(_test_file_path(exhibit), conf_path)
+        else:
+            open(conf_path, "w").close()
+
+        conf = SSHConfig(conf_path)
+        conf.update_host("test-c.us-central1-b.project-name-1", "30.30.30.30", "1234321",
+                         HostConfig.default_config())
+        conf.save()
+        assert not conf.dirty
+        assert not conf.diff()
+
+        # State is the same as if the saved file had been parsed again
+        saved = SSHConfig(conf_path)
+        assert conf._lines == saved._lines
+        assert conf.host_ip("test-c.us-central1-b.project-name-1") == "30.30.30.30"
+
+        conf.update_host("test-c.us-central1-b.project-name-1", "4.4.4.4", "1234321")
+        saved.update_host("test-c.us-central1-b.project-name-1", "4.4.4.4", "1234321")
+        assert list(conf.diff()) == list(saved.diff())
+        conf.save()
+        with open(conf_path, "r") as f:
+            assert f.read() == "".join(saved._lines)
+
+
+def test_diff_line_numbers():
+    conf = SSHConfig(_test_file_path("exhibit_1"))
+    conf.update_host('test-b.europe-west4-b.project-name-2', ip="4.4.4.4", id=None)
+    diff = [_RE_ANSI_ESCAPE.sub('', line) for line in conf.diff()]
+    changed = [line for line in diff if "4.4.4.4" in line]
+    assert len(changed) == 1
+    assert changed[0].split()[0] == "33"  # Line numbers are the file's, starting at 1
+
+
+@pytest.mark.parametrize("exhibit, change", [
+    ("exhibit_1", "update"), ("exhibit_1", "remove"), ("exhibit_3", "remove"),
+    ("exhibit_4", "add"), ("exhibit_5", "add"), (None, "add")])
+def test_diff_is_whole_file_diff(tmp_path, exhibit, change):
+    conf_path = tmp_path / "config"
+    if exhibit:
+        shutil.copy(_test_file_path(exhibit), str(conf_path))
+    else:  # No section yet, it gets appended
+        conf_path.write_text("Host a\n  HostName 1.1.1.1\n\nHost b\n  HostName 2.2.2.2\n")
+    conf = SSHConfig(str(conf_path))
+    hostname = next(iter(conf._hosts), None)
+    if change == "update":
+        conf.update_host(hostname, "4.4.4.4", None)
+    elif change == "remove":
+        conf.remove_host(hostname)
+    else:
+        conf.update_host("test-c.us-central1-b.project-name-1", "30.30.30.30", "1234321",
+                         HostConfig.default_config())
+
+    with open(str(conf_path), "r") as f:
+        original_lines = f.readlines()
+    assert list(conf.diff()) == \
+        list(pretty_diff(original_lines, conf._lines, fromdesc=str(conf_path),
+                         todesc="proposed changes", context_lines=2))
+
+
+_BEFORE_SECTION = """Host outside_before
+  Port 22
+
+"""
+_SECTION = """# Google Compute Engine Section
+# hand written comment
+
+Host a.us-central1-b.project-1
+    HostName 1.1.1.1
+    # note about a
+    HostKeyAlias compute.1
+
+# between hosts
+Host b.us-central1-b.project-1
+    HostName 2.2.2.2
+    # note about b
+# End of Google Compute Engine Section
+"""
+_AFTER_SECTION = """Host outside_after
+  Port 22
+"""
+
+
+def test_section_comments_survive(tmp_path):
+    conf_path = tmp_path / "config"
+    conf_path.write_text(_BEFORE_SECTION + _SECTION + _AFTER_SECTION)
+    conf = SSHConfig(str(conf_path))
+    conf.remove_host("b.us-central1-b.project-1")
+    conf.update_host("c.us-central1-b.project-1", "3.3.3.3", "3", HostConfig())
+    conf.save()
+
+    # Only the Host line and parameters of b went away, c was appended after what was left
+    assert conf_path.read_text() == _BEFORE_SECTION + """# Google Compute Engine Section
+# hand written comment
+
+Host a.us-central1-b.project-1
+    HostName 1.1.1.1
+    # note about a
+    HostKeyAlias compute.1
+
+# between hosts
+    # note about b
+
+Host c.us-central1-b.project-1
+    HostName 3.3.3.3
+    HostKeyAlias compute.3
+# End of Google Compute Engine Section
+""" + _AFTER_SECTION
+
+
+def test_outside_of_section_untouched(tmp_path):
+    conf_path = tmp_path / "config"
+    before = "# handwritten\n\n\nHost x\n\tHostName  10.0.0.1  \n  # odd  spacing\n"
+    after = "\nHost y\n  Port=22\n# no final newline"
+    conf_path.write_text(before + _SECTION + after)
+    conf = SSHConfig(str(conf_path))
+    for hostname in list(conf._hosts):
+        conf.remove_host(hostname)
+    conf.update_host("c.us-central1-b.project-1", "3.3.3.3", "3", HostConfig())
+    conf.save()
+
+    text = conf_path.read_text()
+    assert text.startswith(before + _BEGIN_MARKER)
+    assert text.endswith(_END_MARKER + "\n" + after)
+
+
+def test_markers_added_once(tmp_path):
+    conf_path = tmp_path / "config"
+    conf_path.write_text("Host x\n  HostName 10.0.0.1\n")
+    conf = SSHConfig(str(conf_path))
+    conf.update_host("c.us-central1-b.project-1", "3.3.3.3", "3", HostConfig())
+    conf.save()
+    conf.update_host("d.us-central1-b.project-1", "4.4.4.4", "4", HostConfig())
+    conf.save()
+    conf = SSHConfig(str(conf_path))
+    conf.update_host("e.us-central1-b.project-1", "5.5.5.5", "5", HostConfig())
+    conf.save()
+
+    lines = conf_path.read_text().splitlines()
+    assert lines[:2] == ["Host x", "  HostName 10.0.0.1"]
+    assert len([line for line in lines if line.startswith(_BEGIN_MARKER)]) == 1
+    assert len([line for line in lines if line.startswith(_END_MARKER)]) == 1
+    assert lines[-1] == _END_MARKER
+    assert [line for line in lines if line.startswith("Host ")] == \
+        ["Host x", "Host c.us-central1-b.project-1", "Host d.us-central1-b.project-1",
+         "Host e.us-central1-b.project-1"]
+
+
+def test_blocks_without_blank_lines(tmp_path):
+    conf_path = tmp_path / "config"
+    conf_path.write_text(f"{_BEGIN_MARKER}\n"
+                         "Host a.us-central1-b.project-1\n    HostName 1.1.1.1\n"
+                         "Host b.us-central1-b.project-1\n    HostName 2.2.2.2\n"
+                         f"{_END_MARKER}\n")
+    conf = SSHConfig(str(conf_path))
+    assert conf._hosts["a.us-central1-b.project-1"].lines == \
+        ["Host a.us-central1-b.project-1\n", "    HostName 1.1.1.1\n"]
+    assert conf._hosts["b.us-central1-b.project-1"].lines == \
+        ["Host b.us-central1-b.project-1\n", "    HostName 2.2.2.2\n"]
+
+    conf.remove_host("a.us-central1-b.project-1")
+    conf.update_host("b.us-central1-b.project-1", "4.4.4.4", None)
+    conf.save()
+    assert conf_path.read_text() == f"{_BEGIN_MARKER}\n" \
+        "Host b.us-central1-b.project-1\n    HostName 4.4.4.4\n" \
+        f"{_END_MARKER}\n"
+
+
 def test_infer_host_config():
     conf = SSHConfig(_test_file_path("exhibit_3"))
     hc = conf.infer_host_config()
@@ -222,6 +397,19 @@ def test_remove_host():
     assert conf._lines == [f'{_BEGIN_MARKER}\n', f"{_END_MARKER}\n", "\n"]
 
 
+def test_remove_hosts():
+    conf = SSHConfig(_test_file_path("exhibit_3"))
+    assert conf.remove_hosts(["this_host_does_not_exist"]) == 0
+    assert not conf.dirty
+
+    assert conf.remove_hosts(["test_host_a", "test_host_c", "this_host_does_not_exist"]) > 0
+    assert conf.dirty
+    assert list(conf._hosts) == ['test_host_b']
+
+    conf.remove_hosts(["test_host_b"])
+    assert conf._lines == [f'{_BEGIN_MARKER}\n', f"{_END_MARKER}\n", "\n"]
+
+
 # XXX add a test and an exhibit to test behavior around comments inside the fenced block
 
 
@@ -234,3 +422,56 @@ def test_hosts_of_project():
     result = conf.hosts_of_project("project-name-2")
     assert len(result) == 1
     assert result['test-b.europe-west4-b.project-name-2']
+
+
+def test_apply():
+    conf = SSHConfig(_test_file_path("exhibit_1"))
+    original = list(conf._lines)
+
+    changeset = ChangeSet()
+    changeset.update_ip("test-a.us-central1-b.project-name-1", "4.4.4.4")
+    changeset.remove("test-b.europe-west4-b.project-name-2")
+    changeset.add("test-c.us-central1-b.project-name-1", "30.30.30.30", "1234321")
+    conf.apply(changeset, HostConfig.default_config())
+
+    assert conf.dirty
+    assert conf.host_ip("test-a.us-central1-b.project-name-1") == "4.4.4.4"
+    assert conf.host_ip("test-c.us-central1-b.project-name-1") == "30.30.30.30"
+    assert "test-b.europe-west4-b.project-name-2" not in conf
+
+    # Untouched lines are kept as they were, in the same order
+    lines = conf._lines
+    assert lines[:24] == original[:24]
+    assert lines[24] == "    HostName 4.4.4.4\n"
+    assert lines[25:31] == original[25:31]
+    assert lines[31] == original[38]  # The blank line that followed the removed host
+    assert lines[32:34] == ["\n", "Host test-c.us-central1-b.project-name-1\n"]
+    assert lines[-len(original[39:]):] == original[39:]
+
+
+def test_apply_nothing():
+    conf = SSHConfig(_test_file_path("exhibit_1"))
+    original = list(conf._lines)
+    conf.apply(ChangeSet())
+    assert not conf.dirty
+    assert conf._lines == original
+
+
+def test_hosts_of_project_after_changes():
+    conf = SSHConfig(_test_file_path("exhibit_1"))
+    conf.update_host("test-c.us-central1-b.project-name-1", "30.30.30.30", "1234321",
+                     HostConfig.default_config())
+    conf.remove_host("test-b.europe-west4-b.project-name-2")
+
+    assert set(conf.hosts_of_project("project-name-1")) == {
+        "test-a.us-central1-b.project-name-1", "test-c.us-central1-b.project-name-1"}
+    assert conf.hosts_of_project("project-name-2") == {}
+    assert conf.hosts_of_project("project-name-3") == {}
+
+
+def test_host_ip():
+    conf = SSHConfig(_test_file_path("exhibit_1"))
+    assert 'test-a.us-central1-b.project-name-1' in conf
+    assert 'defined_before_block' not in conf
+    assert conf.host_ip('test-a.us-central1-b.project-name-1') == "34.1.11.111"
+    assert conf.host_ip('defined_before_block') is None
@@ -0,0 +1,60 @@
+import asyncio
+import json
+
+from gcloud_sync_ssh.util import tracing
+from gcloud_sync_ssh.util.aio import run
+from gcloud_sync_ssh.util.tracing import span
+
+
+def _spans(tracer):
+    return [e for e in tracer.events if e["ph"] == "X"]
+
+
+def test_disabled():
+    assert tracing.disable() is None
+    with span("nothing"):
+        pass
+    assert tracing.disable() is None
+
+
+def test_spans(tmp_path):
+    tracer = tracing.enable()
+    try:
+        with span("outer", answer=42):
+            with span("inner", cat="cmd"):
+                pass
+    finally:
+        assert tracing.disable() is tracer
+
+    inner, outer = _spans(tracer)
+    assert (outer["name"], outer["cat"], outer["args"]) == ("outer", "phase", {"answer": 42})
+    assert (inner["name"], inner["cat"]) == ("inner", "cmd")
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    assert inner["tid"] == outer["tid"]
+
+    path = tmp_path / "trace.json"
+    tracer.save(str(path))
+    data = json.loads(path.read_text())
+    assert data["traceEvents"] == tracer.events
+
+
+def test_concurrent_tasks():
+    async def work(i):
+        with span("work", i=i):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*[work(i) for i in range(3)])
+
+    tracer = tracing.enable()
+    try:
+        run(main())
+    finally:
+        tracing.disable()
+
+    spans = _spans(tracer)
+    assert sorted(e["args"]["i"] for e in spans) == [0, 1, 2]
+    assert len({e["tid"] for e in spans}) == 3  # One track per task
+    names = [e for e in tracer.events if e["ph"] == "M" and e["name"] == "thread_name"]
+    assert {e["tid"] for e in names} >= {e["tid"] for e in spans}